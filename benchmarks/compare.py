@@ -0,0 +1,100 @@
+"""Compare the results of two runs of the throughput benchmark suite, e.g., across commits.
+
+For each benchmark being run in both, it reports the ratio between the new and the baseline
+measurements, and it marks the regressions exceeding a relative threshold.
+
+Example:
+    python -m benchmarks.compare baseline.json results.json --threshold 0.1
+"""
+
+import argparse
+import json
+from typing import Any
+
+# The measurements being compared, and whether larger values are better
+METRICS = {
+    "compile_time_s": False,
+    "forward_samples_per_s": True,
+    "backward_samples_per_s": True,
+    "peak_activation_bytes": False,
+    "saved_tensor_bytes": False,
+}
+
+
+def compare_results(
+    baseline: dict[str, Any], results: dict[str, Any], *, threshold: float
+) -> list[dict[str, Any]]:
+    """Compare the results of two runs of the throughput benchmark suite.
+
+    Args:
+        baseline: The baseline results.
+        results: The new results.
+        threshold: The relative change beyond which a measurement is a regression.
+
+    Returns:
+        For each benchmark and measurement in both runs, the baseline and new values,
+            their ratio, and whether it is a regression.
+    """
+    baseline_by_name = {r["name"]: r for r in baseline["results"]}
+    rows: list[dict[str, Any]] = []
+    for r in results["results"]:
+        b = baseline_by_name.get(r["name"])
+        if b is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in r or metric not in b or not b[metric]:
+                continue
+            ratio = r[metric] / b[metric]
+            if higher_is_better:
+                regression = ratio < 1.0 - threshold
+            else:
+                regression = ratio > 1.0 + threshold
+            rows.append(
+                {
+                    "name": r["name"],
+                    "metric": metric,
+                    "baseline": b[metric],
+                    "value": r[metric],
+                    "ratio": ratio,
+                    "regression": regression,
+                }
+            )
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("baseline", type=str)
+    parser.add_argument("results", type=str)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--only-regressions", action="store_true")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.results, encoding="utf-8") as f:
+        results = json.load(f)
+    rows = compare_results(baseline, results, threshold=args.threshold)
+    print(
+        f"Baseline {baseline['metadata'].get('commit')} vs "
+        f"results {results['metadata'].get('commit')}"
+    )
+    name_width = max((len(row["name"]) for row in rows), default=0)
+    metric_width = max(map(len, METRICS))
+    for row in rows:
+        if args.only_regressions and not row["regression"]:
+            continue
+        print(
+            f"{row['name']:<{name_width}}  {row['metric']:<{metric_width}}  "
+            f"{row['baseline']:>14.4g}  {row['value']:>14.4g}  {row['ratio']:>7.3f}x"
+            + ("  REGRESSION" if row["regression"] else "")
+        )
+    num_regressions = sum(row["regression"] for row in rows)
+    print(f"{num_regressions} regressions out of {len(rows)} measurements")
+    if args.fail_on_regression and num_regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
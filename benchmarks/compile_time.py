@@ -0,0 +1,254 @@
+"""Compile-time benchmark of image circuits, broken down by compilation phase.
+
+The phases being timed are the compilation of the symbolic layers, each step of the circuit
+optimization (i.e., fusing parameter nodes, shattering and fusing layers), the construction of
+the folded graph, the folding of the parameters, the construction of the compiled circuits
+(including their address books) and the initialization of the parameters. Each phase is timed
+exclusively, i.e., the time spent in a nested phase is only attributed to the nested one.
+The circuits are built for increasing image sizes, and the scaling exponent of each phase
+w.r.t. the number of symbolic layers is estimated between consecutive sizes.
+
+Example:
+    python -m benchmarks.compile_time --image-sizes 8 16 32 --output compile_time.json
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import math
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from typing import Any
+from unittest import mock
+
+import cirkit.backend.torch.compiler as torch_compiler
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.templates import data_modalities, utils
+
+PHASES = (
+    "compile_layers",
+    "optimize_parameter_nodes",
+    "optimize_shatter_layers",
+    "optimize_fuse_layers",
+    "build_folded_graph",
+    "fold_parameters",
+    "construct_circuit",
+    "reset_parameters",
+)
+
+
+class PhaseTimer:
+    """Accumulate the exclusive time spent in each compilation phase."""
+
+    def __init__(self) -> None:
+        self.times: dict[str, float] = defaultdict(float)
+        self._stack: list[list[Any]] = []
+
+    def wrap(self, phase: str | Callable[..., str], fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def _timed_fn(*args: Any, **kwargs: Any) -> Any:
+            name = phase(*args, **kwargs) if callable(phase) else phase
+            # The folded graphs of the parameters are built while folding the parameters
+            if name == "build_folded_graph" and any(f[0] == "fold_parameters" for f in self._stack):
+                name = "fold_parameters"
+            frame = [name, 0.0]
+            self._stack.append(frame)
+            start_time = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed_time = time.perf_counter() - start_time
+                self._stack.pop()
+                self.times[name] += elapsed_time - frame[1]
+                if self._stack:
+                    self._stack[-1][1] += elapsed_time
+
+        return _timed_fn
+
+    @contextlib.contextmanager
+    def patch(self) -> Iterator["PhaseTimer"]:
+        def _optimize_layers_phase(*args: Any, shatter: bool, **kwargs: Any) -> str:
+            return "optimize_shatter_layers" if shatter else "optimize_fuse_layers"
+
+        patches = [
+            mock.patch.object(
+                TorchCompiler,
+                "compile_layer",
+                self.wrap("compile_layers", TorchCompiler.compile_layer),
+            ),
+            mock.patch.object(
+                torch_compiler,
+                "_optimize_parameter_nodes",
+                self.wrap("optimize_parameter_nodes", torch_compiler._optimize_parameter_nodes),
+            ),
+            mock.patch.object(
+                torch_compiler,
+                "_optimize_layers",
+                self.wrap(_optimize_layers_phase, torch_compiler._optimize_layers),
+            ),
+            mock.patch.object(
+                torch_compiler,
+                "build_folded_graph",
+                self.wrap("build_folded_graph", torch_compiler.build_folded_graph),
+            ),
+            mock.patch.object(
+                torch_compiler,
+                "_fold_parameters",
+                self.wrap("fold_parameters", torch_compiler._fold_parameters),
+            ),
+            mock.patch.object(
+                TorchCircuit,
+                "__init__",
+                self.wrap("construct_circuit", TorchCircuit.__init__),
+            ),
+            mock.patch.object(
+                TorchCircuit,
+                "reset_parameters",
+                self.wrap("reset_parameters", TorchCircuit.reset_parameters),
+            ),
+        ]
+        with contextlib.ExitStack() as stack:
+            for p in patches:
+                stack.enter_context(p)
+            yield self
+
+
+def measure_compile_time(
+    image_size: int,
+    *,
+    num_channels: int,
+    region_graph: str,
+    num_units: int,
+    fold: bool,
+    optimize: bool,
+) -> dict[str, Any]:
+    """Measure the time spent in each phase of the compilation of an image circuit.
+
+    Args:
+        image_size: The height and width of the images.
+        num_channels: The number of channels of the images.
+        region_graph: The region graph.
+        num_units: The number of units of the layers.
+        fold: Whether to fold the circuit.
+        optimize: Whether to optimize the circuit.
+
+    Returns:
+        The results of the benchmark.
+    """
+    sc = data_modalities.image_data(
+        (num_channels, image_size, image_size),
+        region_graph=region_graph,
+        input_layer="categorical",
+        num_input_units=num_units,
+        sum_product_layer="cp",
+        num_sum_units=num_units,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    timer = PhaseTimer()
+    with timer.patch():
+        start_time = time.perf_counter()
+        tc = compiler.compile(sc)
+        total_time = time.perf_counter() - start_time
+    phase_times = {phase: timer.times.get(phase, 0.0) for phase in PHASES}
+    return {
+        "image_size": image_size,
+        "num_symbolic_layers": len(list(sc.layers)),
+        "num_compiled_layers": len(list(tc.layers)),
+        "total_time_s": total_time,
+        "phase_times_s": {
+            **phase_times,
+            "other": max(total_time - sum(phase_times.values()), 0.0),
+        },
+    }
+
+
+def scaling_exponents(results: list[dict[str, Any]]) -> list[dict[str, float]]:
+    """Estimate the scaling exponent of the total time and of each phase w.r.t. the number of
+    symbolic layers, i.e., the slope in log-log scale between consecutive circuit sizes.
+
+    Args:
+        results: The results of the benchmark, sorted by circuit size.
+
+    Returns:
+        For each pair of consecutive circuit sizes, the scaling exponents.
+    """
+    exponents: list[dict[str, float]] = []
+    for prev, cur in zip(results, results[1:]):
+        log_size_ratio = math.log(cur["num_symbolic_layers"] / prev["num_symbolic_layers"])
+        if log_size_ratio <= 0.0:
+            continue
+        times = {"total": (prev["total_time_s"], cur["total_time_s"])}
+        times.update(
+            (phase, (prev["phase_times_s"][phase], cur["phase_times_s"][phase]))
+            for phase in cur["phase_times_s"]
+        )
+        exponents.append(
+            {
+                "from_image_size": prev["image_size"],
+                "to_image_size": cur["image_size"],
+                **{
+                    name: math.log(t / prev_t) / log_size_ratio
+                    for name, (prev_t, t) in times.items()
+                    if prev_t > 0.0 and t > 0.0
+                },
+            }
+        )
+    return exponents
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--image-sizes", type=int, nargs="+", default=(8, 16, 32))
+    parser.add_argument("--num-channels", type=int, default=1)
+    parser.add_argument("--region-graph", type=str, default="quad-graph")
+    parser.add_argument("--num-units", type=int, default=8)
+    parser.add_argument("--no-fold", action="store_true")
+    parser.add_argument("--no-optimize", action="store_true")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    results: list[dict[str, Any]] = []
+    for image_size in sorted(args.image_sizes):
+        result = measure_compile_time(
+            image_size,
+            num_channels=args.num_channels,
+            region_graph=args.region_graph,
+            num_units=args.num_units,
+            fold=not args.no_fold,
+            optimize=not args.no_optimize,
+        )
+        phases = ", ".join(
+            f"{phase} {t:.3f}s" for phase, t in result["phase_times_s"].items() if t > 0.0
+        )
+        print(
+            f"{args.num_channels}x{image_size}x{image_size}: "
+            f"{result['num_symbolic_layers']} layers, "
+            f"total {result['total_time_s']:.3f}s ({phases})",
+            flush=True,
+        )
+        results.append(result)
+
+    report = {
+        "config": {
+            "num_channels": args.num_channels,
+            "region_graph": args.region_graph,
+            "num_units": args.num_units,
+            "fold": not args.no_fold,
+            "optimize": not args.no_optimize,
+        },
+        "results": results,
+        "scaling_exponents": scaling_exponents(results),
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Peak activation memory benchmark of the evaluation of compiled circuits.
+
+The peak activation memory is measured by tracking the bytes of the outputs of each (possibly
+folded) layer that are alive at any point of the evaluation. This is compared with the total
+number of bytes of all the layer outputs, i.e., the memory that would be required if all the
+layer outputs were kept alive until the end of the evaluation.
+
+Example:
+    python -m benchmarks.peak_memory --image-shape 1 28 28 --num-units 512 --batch-size 64
+"""
+
+import argparse
+import json
+import weakref
+from typing import Any
+
+import torch
+from torch import Tensor
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.layers import TorchLayer
+from cirkit.templates import data_modalities, utils
+
+
+class ActivationMemoryTracker:
+    """Track the number of bytes of the layer outputs that are alive during an evaluation."""
+
+    def __init__(self) -> None:
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.total_bytes = 0
+        self.num_layers = 0
+
+    def _release(self, nbytes: int) -> None:
+        self.live_bytes -= nbytes
+
+    def __call__(self, layer: TorchLayer, *inputs: Tensor) -> Tensor:
+        y = layer(*inputs)
+        nbytes = y.numel() * y.element_size()
+        self.live_bytes += nbytes
+        self.total_bytes += nbytes
+        self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+        self.num_layers += 1
+        weakref.finalize(y, self._release, nbytes)
+        return y
+
+
+def build_circuit(
+    image_shape: tuple[int, int, int],
+    region_graph: str,
+    num_units: int,
+    *,
+    semiring: str = "lse-sum",
+    fold: bool = True,
+    optimize: bool = True,
+) -> TorchCircuit:
+    sc = data_modalities.image_data(
+        image_shape,
+        region_graph=region_graph,
+        input_layer="categorical",
+        num_input_units=num_units,
+        sum_product_layer="cp",
+        num_sum_units=num_units,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    return compiler.compile(sc)
+
+
+def measure_peak_memory(tc: TorchCircuit, x: Tensor) -> dict[str, Any]:
+    tracker = ActivationMemoryTracker()
+    with torch.no_grad():
+        tc.evaluate(x, module_fn=tracker)
+    return {
+        "num_layers": tracker.num_layers,
+        "peak_activation_bytes": tracker.peak_bytes,
+        "total_activation_bytes": tracker.total_bytes,
+        "peak_ratio": tracker.peak_bytes / tracker.total_bytes,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--image-shape", type=int, nargs=3, default=(1, 28, 28))
+    parser.add_argument("--region-graph", type=str, default="quad-graph")
+    parser.add_argument("--num-units", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--no-fold", action="store_true")
+    parser.add_argument("--max-peak-ratio", type=float, default=None)
+    args = parser.parse_args()
+
+    tc = build_circuit(
+        tuple(args.image_shape), args.region_graph, args.num_units, fold=not args.no_fold
+    )
+    x = torch.randint(256, size=(args.batch_size, tc.num_variables))
+    results = measure_peak_memory(tc, x)
+    print(json.dumps(results, indent=2))
+    if args.max_peak_ratio is not None and results["peak_ratio"] > args.max_peak_ratio:
+        raise SystemExit(
+            f"Peak activation memory ratio {results['peak_ratio']:.3f} "
+            f"exceeds the threshold {args.max_peak_ratio:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
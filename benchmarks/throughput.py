@@ -0,0 +1,314 @@
+"""Throughput benchmark suite of the evaluation of compiled circuits on CPU.
+
+Representative circuits are built from the templates, i.e., image_data with each region graph,
+tabular_data, hmm, tensor_train, cp and tucker. Each circuit is compiled with and without
+folding and optimizations, and for each semiring. For each configuration, the suite measures
+the compile time, the forward and backward throughputs (in samples per second), the peak
+bytes of the layer outputs being alive during the forward pass and the bytes saved by
+autograd for the backward pass. The results are saved as JSON, such that they can be compared
+across commits with benchmarks.compare.
+
+Example:
+    python -m benchmarks.throughput --filter image_data --output results.json
+"""
+
+import argparse
+import json
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import time
+from collections.abc import Callable
+from typing import Any
+
+import torch
+from torch import Tensor
+
+from benchmarks.peak_memory import ActivationMemoryTracker
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.symbolic.circuit import Circuit
+from cirkit.templates import data_modalities, pgms, tensor_factorizations, utils
+
+SEMIRINGS = ("sum-product", "lse-sum", "complex-lse-sum")
+IMAGE_REGION_GRAPHS = (
+    "quad-tree-2",
+    "quad-tree-4",
+    "quad-graph",
+    "random-binary-tree",
+    "poon-domingos",
+)
+
+
+def _image_data(region_graph: str, num_units: int) -> tuple[Circuit, Callable[[int], Tensor]]:
+    # The Poon-Domingos region graph is much larger than the others for the same image size
+    image_shape = (1, 8, 8) if region_graph == "poon-domingos" else (1, 16, 16)
+    sc = data_modalities.image_data(
+        image_shape,
+        region_graph=region_graph,
+        input_layer="categorical",
+        num_input_units=num_units,
+        sum_product_layer="cp",
+        num_sum_units=num_units,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    return sc, lambda batch_size: torch.randint(256, size=(batch_size, sc.num_variables))
+
+
+def _tabular_data(num_units: int) -> tuple[Circuit, Callable[[int], Tensor]]:
+    num_features, num_categories = 32, 8
+    sc = data_modalities.tabular_data(
+        num_features=num_features,
+        input_layers=[
+            {"name": "categorical", "args": {"num_categories": num_categories}}
+            for _ in range(num_features)
+        ],
+        num_input_units=num_units,
+        sum_product_layer="cp",
+        num_sum_units=num_units,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    return sc, lambda batch_size: torch.randint(num_categories, size=(batch_size, num_features))
+
+
+def _hmm(num_units: int) -> tuple[Circuit, Callable[[int], Tensor]]:
+    num_variables, num_categories = 64, 8
+    sc = pgms.hmm(
+        list(range(num_variables)),
+        input_layer="categorical",
+        num_latent_states=num_units,
+        input_layer_kwargs={"num_categories": num_categories},
+    )
+    return sc, lambda batch_size: torch.randint(num_categories, size=(batch_size, num_variables))
+
+
+def _tensor_factorization(name: str, num_units: int) -> tuple[Circuit, Callable[[int], Tensor]]:
+    # The factors are initialized to be positive, such that the circuit can be evaluated
+    # in any semiring
+    positive_param = utils.Parameterization(initialization="uniform")
+    match name:
+        case "tensor_train":
+            shape = (16,) * 8
+            sc = tensor_factorizations.tensor_train(shape, num_units, factor_param=positive_param)
+        case "cp":
+            shape = (64,) * 4
+            sc = tensor_factorizations.cp(
+                shape,
+                num_units,
+                input_params={"weight": positive_param},
+                weight_param=positive_param,
+            )
+        case "tucker":
+            shape = (32,) * 3
+            sc = tensor_factorizations.tucker(
+                shape,
+                max(num_units // 4, 1),
+                input_params={"weight": positive_param},
+                core_param=positive_param,
+            )
+        case _:
+            raise ValueError(f"Unknown tensor factorization '{name}'")
+    return sc, lambda batch_size: torch.stack(
+        [torch.randint(dim, size=(batch_size,)) for dim in shape], dim=1
+    )
+
+
+def build_circuits(num_units: int) -> dict[str, tuple[Circuit, Callable[[int], Tensor]]]:
+    """Build the symbolic circuits being benchmarked.
+
+    Args:
+        num_units: The number of units of the layers, or the rank of the factorizations.
+
+    Returns:
+        A dictionary mapping the name of each circuit to both the symbolic circuit and
+            a function sampling a batch of inputs of a given size.
+    """
+    circuits: dict[str, tuple[Circuit, Callable[[int], Tensor]]] = {}
+    for region_graph in IMAGE_REGION_GRAPHS:
+        circuits[f"image_data-{region_graph}"] = _image_data(region_graph, num_units)
+    circuits["tabular_data"] = _tabular_data(num_units)
+    circuits["hmm"] = _hmm(num_units)
+    for name in ("tensor_train", "cp", "tucker"):
+        circuits[name] = _tensor_factorization(name, num_units)
+    return circuits
+
+
+def _median_time(fn: Callable[[], Any], *, repeat: int, warmup: int) -> float:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def _saved_tensor_bytes(tc: TorchCircuit, x: Tensor) -> int:
+    saved_bytes = 0
+
+    def _pack_hook(t: Tensor) -> Tensor:
+        nonlocal saved_bytes
+        saved_bytes += t.numel() * t.element_size()
+        return t
+
+    with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(_pack_hook, lambda t: t):
+        tc(x)
+    return saved_bytes
+
+
+def _backward(tc: TorchCircuit, x: Tensor) -> None:
+    with torch.enable_grad():
+        tc(x).real.sum().backward()
+    tc.zero_grad(set_to_none=True)
+
+
+def run_benchmark(
+    sc: Circuit,
+    x: Tensor,
+    *,
+    semiring: str,
+    fold: bool,
+    optimize: bool,
+    repeat: int,
+    warmup: int,
+    compile_repeat: int = 1,
+) -> dict[str, Any]:
+    """Run the benchmark of a circuit compiled with a given configuration.
+
+    Args:
+        sc: The symbolic circuit.
+        x: The batch of inputs.
+        semiring: The semiring.
+        fold: Whether to fold the circuit.
+        optimize: Whether to optimize the circuit.
+        repeat: The number of measurements whose median is reported.
+        warmup: The number of evaluations before each measurement.
+        compile_repeat: The number of compilations whose median time is reported.
+
+    Returns:
+        The results of the benchmark.
+    """
+
+    # The last compiled circuit is the one being evaluated
+    compile_times = []
+    for _ in range(compile_repeat):
+        start_time = time.perf_counter()
+        tc = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize).compile(sc)
+        compile_times.append(time.perf_counter() - start_time)
+    compile_time = statistics.median(compile_times)
+    batch_size = x.shape[0]
+    with torch.no_grad():
+        forward_time = _median_time(lambda: tc(x), repeat=repeat, warmup=warmup)
+        tracker = ActivationMemoryTracker()
+        tc.evaluate(x, module_fn=tracker)
+    backward_time = _median_time(lambda: _backward(tc, x), repeat=repeat, warmup=warmup)
+    return {
+        "num_layers": len(tc.address_book) - 1,
+        "num_parameters": sum(p.numel() for p in tc.parameters()),
+        "compile_time_s": compile_time,
+        "forward_samples_per_s": batch_size / forward_time,
+        "backward_samples_per_s": batch_size / backward_time,
+        "peak_activation_bytes": tracker.peak_bytes,
+        "saved_tensor_bytes": _saved_tensor_bytes(tc, x),
+    }
+
+
+def _metadata(args: argparse.Namespace) -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "num_threads": torch.get_num_threads(),
+        "batch_size": args.batch_size,
+        "num_units": args.num_units,
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "compile_repeat": args.compile_repeat,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-units", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--compile-repeat", type=int, default=1)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--semirings", type=str, nargs="+", default=SEMIRINGS, choices=SEMIRINGS)
+    parser.add_argument(
+        "--filter", type=str, default=None, help="A regex the benchmark names must match"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+    results: list[dict[str, Any]] = []
+    for circuit_name, (sc, sample_fn) in build_circuits(args.num_units).items():
+        x = sample_fn(args.batch_size)
+        for semiring in args.semirings:
+            for fold in (False, True):
+                for optimize in (False, True):
+                    name = (
+                        f"{circuit_name}/{semiring}/"
+                        f"{'fold' if fold else 'no-fold'}/"
+                        f"{'optimize' if optimize else 'no-optimize'}"
+                    )
+                    if args.filter is not None and re.search(args.filter, name) is None:
+                        continue
+                    result = run_benchmark(
+                        sc,
+                        x,
+                        semiring=semiring,
+                        fold=fold,
+                        optimize=optimize,
+                        repeat=args.repeat,
+                        warmup=args.warmup,
+                        compile_repeat=args.compile_repeat,
+                    )
+                    print(
+                        f"{name}: "
+                        f"compile {result['compile_time_s'] * 1e3:.1f} ms, "
+                        f"forward {result['forward_samples_per_s']:.1f} samples/s, "
+                        f"backward {result['backward_samples_per_s']:.1f} samples/s, "
+                        f"peak {result['peak_activation_bytes'] / 2**20:.2f} MiB",
+                        flush=True,
+                    )
+                    results.append(
+                        {
+                            "name": name,
+                            "circuit": circuit_name,
+                            "semiring": semiring,
+                            "fold": fold,
+                            "optimize": optimize,
+                            **result,
+                        }
+                    )
+
+    metadata = _metadata(args)
+    # The maximum resident set size is reported in kilobytes on Linux
+    metadata["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    report = {"metadata": metadata, "results": results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
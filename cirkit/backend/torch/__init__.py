@@ -0,0 +1 @@
+from cirkit.backend.torch.profiling import profile as profile
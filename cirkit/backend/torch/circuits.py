@@ -1,7 +1,9 @@
-from collections import deque
-from collections.abc import Callable, Iterator, Mapping, Sequence
+import itertools
+from collections.abc import Callable, Hashable, Iterator, Mapping, Sequence
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, NamedTuple
 
 import torch
 from torch import Tensor
@@ -17,17 +19,76 @@ from cirkit.backend.torch.graph.modules import (
     TorchDiAcyclicGraph,
 )
 from cirkit.backend.torch.layers import (
+    TorchCPTLayer,
     TorchHadamardLayer,
     TorchInputLayer,
+    TorchKroneckerLayer,
     TorchLayer,
     TorchSumLayer,
 )
+from cirkit.backend.torch.layers.input import TorchConstantLayer
+from cirkit.backend.torch.parameters.nodes import TorchGateFunctionParameter, TorchTensorParameter
+from cirkit.backend.torch.parameters.parameter import TorchParameter
 from cirkit.backend.torch.utils import CachedGateFunctionEval
 from cirkit.symbolic.circuit import CircuitOperation, StructuralProperties
 from cirkit.utils.conditional import GateFunctionParameterSpecs
 from cirkit.utils.scope import Scope
 
 
+class ArenaSlice(NamedTuple):
+    """A contiguous slice of an activation arena that can be viewed as the input of a layer,
+    without gathering. The view has shape $(F, H, B, K)$, where $F$ is the number of folds
+    and $H$ is the arity. If it is not transposed, then the $h$-th input of the $f$-th fold
+    is stored at position ```start + f * H + h``` of the arena, otherwise it is stored at
+    position ```start + h * F + f```."""
+
+    start: int
+    num_folds: int
+    arity: int
+    transposed: bool
+
+
+@dataclass(frozen=True)
+class ArenaPlan:
+    """The static gather plan of a circuit, which lays the outputs of the layers that are
+    input to multiple other (possibly folded) layers contiguously in activation arenas, i.e.,
+    tensors of shape $(F, B, K)$, one for each number of units $K$. By doing so, the inputs
+    to each layer can be retrieved with either a strided view or a single gather over an arena,
+    instead of concatenating the outputs of the input layers at every evaluation.
+    """
+
+    arena_num_folds: list[int]
+    """For each arena, the total number of folds it stores."""
+    arena_num_units: list[int]
+    """For each arena, the number of units of each fold it stores."""
+    out_slots: list[tuple[int, int] | None]
+    """For each layer, it stores a tuple of (1) the arena index and (2) the fold offset
+    where the output of the layer is stored. It is None if the output of the layer is
+    not stored in any arena."""
+    in_arena_ids: list[int | None]
+    """For each address book entry, the index of the arena its input is retrieved from.
+    It is None if the input is not retrieved from any arena."""
+
+
+@dataclass(frozen=True)
+class SparseEvidence:
+    """The input of a univariate input layer when the circuit is evaluated on a sparse input
+    batch, i.e., the observed values of the variables in the scope of the folds of the layer.
+    Differently from the dense input of shape $(F, B, 1)$, it stores the $N$ observed values
+    only, together with the batch element and the fold of each of them.
+    """
+
+    batch_size: int
+    """The batch size $B$."""
+    values: Tensor
+    """The observed values, a tensor of shape $(N,)$."""
+    batch_idx: Tensor
+    """The batch element of each observed value, a tensor of shape $(N,)$."""
+    fold_idx: Tensor
+    """The fold of the layer whose scope contains the variable of each observed value,
+    a tensor of shape $(N,)$."""
+
+
 class LayerAddressBook(AddressBook[TorchLayer]):
     """The address book data structure for the circuits.
     See [TorchCircuit][cirkit.backend.torch.circuits.TorchCircuit].
@@ -37,86 +98,334 @@ class LayerAddressBook(AddressBook[TorchLayer]):
     circuit layer.
     """
 
-    def backtrack(self, state, module_idxs: list[Tensor]) -> Tensor:
-        # entry queue holds a tuple of the form:
-        # (module address book id, idxs of module, previous module address book id)
-        entry_queue = deque([(len(self._entries) - 1, None, None, None)])
-        while entry_queue:
-            entry_id, p_fold_idx, p_batch_idx, p_unit_idx = entry_queue.popleft()
-
-            entry = self._entries[entry_id]
-            module = entry.module
-            in_module_ids = entry.in_module_ids
-
-            if in_module_ids:
-                in_modules_ids_h = in_module_ids[0]
-
-                if module is None:
-                    entry_queue.extend(
-                        [
-                            (
-                                next_m_id,
-                                0,
-                                torch.arange(state.size(0), device=state.device),
-                                0,
-                            )
-                            for next_m_id in in_modules_ids_h
-                        ]
-                    )
-                    continue
+    def __init__(
+        self,
+        entries: list[AddressBookEntry[TorchLayer]],
+        fold_idx_info: FoldIndexInfo | None = None,
+    ) -> None:
+        """Initializes a layers address book.
+
+        Args:
+            entries: The list of address book entries.
+            fold_idx_info: The fold index information.
+        """
+        super().__init__(entries, fold_idx_info=fold_idx_info)
+        self._arena_plan: ArenaPlan | None = None
+        self._arena_in_idx_targets: list[str | None] = []
+        # The plan used to backtrack over the circuit, whose indices are registered as buffers
+        # such that they are transferred to the device together with the circuit
+        self._backtrack_plan: list[list[list[tuple[int, str, str]]]] | None = None
+        if fold_idx_info is not None:
+            self._backtrack_plan = self._build_backtrack_plan()
+        # The univariate input layers, and the folds having each variable in their scope,
+        # which are used to partition the entries of sparse input batches over the layers
+        self._sparse_layers: list[TorchInputLayer] = []
+        self._sparse_occurrences: tuple[torch.device, Tensor, Tensor, Tensor] | None = None
 
-                match module:
-                    case TorchSumLayer():
-                        in_fold_info = self._fold_idx_info.in_fold_idx[entry_id][p_fold_idx]
+    @property
+    def arena_plan(self) -> ArenaPlan | None:
+        """Retrieve the static gather plan over activation arenas, if any.
+        See [build_arena_plan][cirkit.backend.torch.circuits.LayerAddressBook.build_arena_plan].
 
-                        # retrieve arity and unit indexes by unraveling each batch
-                        raveled_idxs = module_idxs[entry_id][p_fold_idx, p_batch_idx, p_unit_idx]
-                        arity_idxs, unit_idxs = torch.unravel_index(
-                            raveled_idxs, (module.arity, module.num_input_units)
-                        )
+        Returns:
+            The arena plan, or None if it has not been built.
+        """
+        return self._arena_plan
+
+    def build_arena_plan(self) -> ArenaPlan:
+        """Build the static gather plan over activation arenas. The outputs of the layers that
+        are input to some layer together with the outputs of other layers are stored
+        contiguously in activation arenas, one for each number of units. Then, the input
+        of such layers is retrieved by using either a strided view over an arena or a single
+        gather, instead of concatenating the outputs of the input layers.
+
+        The arena plan is used only if autograd is disabled, e.g., within
+        [torch.no_grad][torch.no_grad], since writing the outputs of layers in-place into
+        the arenas would make the backward pass much more expensive.
+
+        Returns:
+            The arena plan.
+        """
+        assert self._fold_idx_info is not None
+        fold_idx_info = self._fold_idx_info
+        ordering = fold_idx_info.ordering
+        num_entries = len(self._entries)
+
+        # Retrieve the entries whose input is computed by concatenating multiple layer outputs
+        stacked_entry_ids = [
+            i for i, mids in enumerate(self._entry_in_module_ids) if mids and len(mids[0]) > 1
+        ]
+        arena_layer_ids = sorted(
+            {mid for i in stacked_entry_ids for mid in self._entry_in_module_ids[i][0]}
+        )
+
+        # Assign the output of each layer to an arena (one for each number of units),
+        # by following the topological ordering
+        arena_ids: dict[int, int] = {}
+        arena_num_folds: list[int] = []
+        arena_num_units: list[int] = []
+        arena_slots: dict[int, tuple[int, int]] = {}
+        for mid in arena_layer_ids:
+            num_units = ordering[mid].num_output_units
+            if num_units not in arena_ids:
+                arena_ids[num_units] = len(arena_num_folds)
+                arena_num_folds.append(0)
+                arena_num_units.append(num_units)
+            aid = arena_ids[num_units]
+            arena_slots[mid] = (aid, arena_num_folds[aid])
+            arena_num_folds[aid] += ordering[mid].num_folds
+        out_slots = [arena_slots.get(mid) for mid in range(num_entries - 1)]
+
+        # Build the index over an arena to retrieve the input of each entry
+        in_arena_ids: list[int | None] = [None] * num_entries
+        self._arena_in_idx_targets = [None] * num_entries
+        for i in stacked_entry_ids:
+            if i == num_entries - 1:
+                in_fold_idx = [fold_idx_info.out_fold_idx]
+            else:
+                in_fold_idx = fold_idx_info.in_fold_idx[i]
+            aid = arena_slots[in_fold_idx[0][0][0]][0]
+            arena_idx = [[arena_slots[mid][1] + idx for mid, idx in fi] for fi in in_fold_idx]
+            in_arena_ids[i] = aid
+            target = f"_arena_in_idx_{i}"
+            if i == num_entries - 1:
+                # The output of the whole circuit must not be a view over an arena
+                self.register_buffer(target, torch.tensor(arena_idx[0]), persistent=False)
+            else:
+                arena_slice = _arena_slice(arena_idx)
+                if arena_slice is None:
+                    self.register_buffer(target, torch.tensor(arena_idx), persistent=False)
+                else:
+                    setattr(self, target, arena_slice)
+            self._arena_in_idx_targets[i] = target
+
+        self._arena_plan = ArenaPlan(arena_num_folds, arena_num_units, out_slots, in_arena_ids)
+        return self._arena_plan
+
+    def backtrack(self, state: Tensor, module_idxs: list[Tensor | None]) -> Tensor:
+        """Assign the variables by top-down backtracking over the circuit, given the indices
+        computed by each layer in a bottom-up evaluation (e.g., the maximizers or the samples).
+        See [backtrack_select][cirkit.backend.torch.circuits.LayerAddressBook.backtrack_select].
+
+        Args:
+            state: The tensor of variable assignments of shape $(B, D)$, where $B$ is the batch
+                size and $D$ is the number of variables. It is updated in-place.
+            module_idxs: For each address book entry, the indices computed by the layer, i.e.,
+                a tensor of shape $(F, B, K)$ where $K$ is the number of output units.
+
+        Returns:
+            The updated tensor of variable assignments.
+        """
+        layer_ids = {id(entry.module): i for i, entry in enumerate(self._entries)}
+        batch_size = state.size(0)
+
+        def _select_fn(layer: TorchLayer, units: Tensor) -> Tensor:
+            idxs = module_idxs[layer_ids[id(layer)]]
+            assert idxs is not None
+            # idxs: (F, B, K), where B might be 1; units: (F, B) -> (F, B)
+            idxs = idxs.expand(-1, batch_size, -1)
+            return idxs.gather(dim=2, index=units.unsqueeze(dim=2)).squeeze(dim=2)
+
+        return self.backtrack_select(state, _select_fn)
+
+    def backtrack_select(
+        self,
+        state: Tensor,
+        select_fn: Callable[[TorchLayer, Tensor], Tensor | Sequence[Tensor]],
+        *,
+        out_units: Tensor | None = None,
+        units_per_input: bool = False,
+    ) -> Tensor:
+        """Assign the variables by top-down backtracking over the circuit, where the index
+        selected by each unit being visited is given by a function (e.g., a sampler).
+
+        The backtracking visits one folded layer at a time in reverse topological order.
+        For each folded layer, it keeps a tensor of shape $(F, B)$ storing the unit being
+        selected for each fold and batch element (or -1 if none is selected), which is then
+        scattered to the input layers with a few gather and scatter operations.
+
+        Args:
+            state: The tensor of variable assignments of shape $(B, D)$, where $B$ is the batch
+                size and $D$ is the number of variables. It is updated in-place.
+            select_fn: A function that, given a layer and the tensor of shape $(F, B)$ of the
+                units being selected (where the units not being selected are set to 0), returns
+                a tensor of shape $(F, B)$ with the index selected by each unit. For input
+                layers, this is the assignment to the variables. For sum layers, this is the
+                raveled index of the input unit, i.e., $h K_i + k$ where $h$ is the index of
+                the input and $k$ is the index of the unit within that input.
+            out_units: The units being selected at the outputs of the circuit for each batch
+                element, i.e., a tensor of shape $(B,)$. If it is None, then the first unit of
+                each output is selected.
+            units_per_input: Whether the select function is also called for the inner layers
+                that are not sum layers, and it returns a sequence of tensors of shape $(F, B)$
+                with the units being selected within each input of the layer (or -1 if none is
+                selected), rather than a single index. This allows to backtrack over units
+                that do not map one-to-one to the units of the layers, e.g., the ranked units
+                of top-k MAP.
+
+        Returns:
+            The updated tensor of variable assignments.
+        """
+        assert self._backtrack_plan is not None and self._fold_idx_info is not None
+        batch_size = state.size(0)
+        unit_idxs: list[Tensor | None] = [None] * (len(self._entries) - 1)
+
+        def _selected_units(mid: int) -> Tensor:
+            mid_units = unit_idxs[mid]
+            if mid_units is None:
+                layer = self._entries[mid].module
+                assert layer is not None
+                mid_units = torch.full(
+                    (layer.num_folds, batch_size), -1, dtype=torch.long, device=state.device
+                )
+                unit_idxs[mid] = mid_units
+            return mid_units
+
+        # The first unit of each circuit output is selected for all the batch elements, if not given
+        for mid, out_fold_id in self._fold_idx_info.out_fold_idx:
+            _selected_units(mid)[out_fold_id] = 0 if out_units is None else out_units
 
-                        for arity_i, (next_module_id, fold_idx) in enumerate(in_fold_info):
-                            batch_idxs_at_arity = arity_idxs == arity_i
-
-                            if batch_idxs_at_arity.any():
-                                # specify which states are interested in the input module i
-                                # and for each state which unit they are interested in
-                                entry_queue.append(
-                                    (
-                                        next_module_id,
-                                        fold_idx,
-                                        p_batch_idx[batch_idxs_at_arity],
-                                        unit_idxs[batch_idxs_at_arity],
-                                    )
-                                )
-
-                        continue
-                    case _:
-                        in_fold_info = self._fold_idx_info.in_fold_idx[entry_id][p_fold_idx]
-                        # for product layers we visit all the children
-                        for next_module_id, fold_idx in in_fold_info:
-                            entry_queue.append((next_module_id, fold_idx, p_batch_idx, p_unit_idx))
-                        continue
-            # catch the case where we are at an input unit
-            elif module is not None:
-                assert isinstance(module, TorchInputLayer)
-                # set state
-                input_idxs = module_idxs[entry_id]
+        for entry_id in reversed(range(len(self._entries) - 1)):
+            units = unit_idxs[entry_id]
+            if units is None:
+                continue
+            unit_idxs[entry_id] = None
+            module = self._entries[entry_id].module
+            assert module is not None
+            selected = units >= 0
 
+            # Catch the case where we are at an input layer
+            if isinstance(module, TorchInputLayer):
                 # check that the module is not a marginalized input
                 # in that case ignore the update of this element
-                if module.scope_idx.nelement() > 0:
-                    state[p_batch_idx, module.scope_idx[p_fold_idx]] = input_idxs[
-                        p_fold_idx, 0 if input_idxs.size(1) == 1 else p_batch_idx, p_unit_idx
-                    ].to(state.dtype)
+                if not module.scope_idx.nelement():
+                    continue
+                # input_idxs: (F, B, K) -> (F, B)
+                input_idxs = select_fn(module, units.clamp(min=0))
+                assert isinstance(input_idxs, Tensor)
+                fold_idx, batch_idx = selected.nonzero(as_tuple=True)
+                state[batch_idx.unsqueeze(dim=1), module.scope_idx[fold_idx]] = (
+                    input_idxs[fold_idx, batch_idx].unsqueeze(dim=1).to(state.dtype)
+                )
+                continue
+
+            # Compute the units being selected within each input of the layer
+            in_units: list[Tensor]
+            match module:
+                case _ if units_per_input:
+                    # the select function gives the units being selected within each input
+                    in_units = [
+                        torch.where(selected, in_units_h, -1)
+                        for in_units_h in select_fn(module, units.clamp(min=0))
+                    ]
+                case TorchSumLayer():
+                    # retrieve arity and unit indexes by unraveling the index of each batch
+                    raveled_idxs = select_fn(module, units.clamp(min=0))
+                    assert isinstance(raveled_idxs, Tensor)
+                    arity_idxs = torch.div(
+                        raveled_idxs, module.num_input_units, rounding_mode="floor"
+                    )
+                    unit_idxs_h = torch.remainder(raveled_idxs, module.num_input_units)
+                    in_units = [
+                        torch.where(selected & (arity_idxs == h), unit_idxs_h, -1)
+                        for h in range(module.arity)
+                    ]
+                case TorchCPTLayer():
+                    # all the inputs share the unit being selected by the sum
+                    shared_units = select_fn(module, units.clamp(min=0))
+                    assert isinstance(shared_units, Tensor)
+                    in_units = [torch.where(selected, shared_units, -1)] * module.arity
+                case TorchKroneckerLayer():
+                    # unravel the output unit into the units of the inputs
+                    in_units = [
+                        torch.where(
+                            selected,
+                            torch.remainder(
+                                torch.div(
+                                    units,
+                                    module.num_input_units ** (module.arity - h - 1),
+                                    rounding_mode="floor",
+                                ),
+                                module.num_input_units,
+                            ),
+                            -1,
+                        )
+                        for h in range(module.arity)
+                    ]
+                case _:
+                    # for (Hadamard) product layers we visit all the inputs with the same unit
+                    in_units = [units] * len(self._backtrack_plan[entry_id])
+
+            # Scatter the selected units to the folds of the input layers
+            for in_units_h, plan_h in zip(in_units, self._backtrack_plan[entry_id]):
+                for in_mid, fold_idx_target, in_fold_idx_target in plan_h:
+                    plan_fold_idx = getattr(self, fold_idx_target)
+                    plan_in_fold_idx = getattr(self, in_fold_idx_target)
+                    _selected_units(in_mid).scatter_reduce_(
+                        0,
+                        plan_in_fold_idx.unsqueeze(dim=1).expand(-1, batch_size),
+                        in_units_h[plan_fold_idx],
+                        reduce="amax",
+                    )
 
         return state
 
+    def _build_backtrack_plan(self) -> list[list[list[tuple[int, str, str]]]]:
+        # For each entry and for each input of the layer (i.e., arity), a list of tuples
+        # (input module id, folds of the layer, folds of the input module), where the folds
+        # are given as the names of the buffers storing them
+        assert self._fold_idx_info is not None
+        plan: list[list[list[tuple[int, str, str]]]] = []
+        for entry_id in range(len(self._entries) - 1):
+            in_fold_idx = self._fold_idx_info.in_fold_idx[entry_id]
+            arity = len(in_fold_idx[0]) if in_fold_idx else 0
+            plan_e: list[list[tuple[int, str, str]]] = []
+            for h in range(arity):
+                groups: dict[int, tuple[list[int], list[int]]] = {}
+                for fold_id, fold_in_idx in enumerate(in_fold_idx):
+                    in_mid, in_fold_id = fold_in_idx[h]
+                    fold_ids, in_fold_ids = groups.setdefault(in_mid, ([], []))
+                    fold_ids.append(fold_id)
+                    in_fold_ids.append(in_fold_id)
+                plan_h: list[tuple[int, str, str]] = []
+                for g, (in_mid, (fold_ids, in_fold_ids)) in enumerate(groups.items()):
+                    fold_idx_target = f"_backtrack_fold_idx_{entry_id}_{h}_{g}"
+                    in_fold_idx_target = f"_backtrack_in_fold_idx_{entry_id}_{h}_{g}"
+                    self.register_buffer(fold_idx_target, torch.tensor(fold_ids), persistent=False)
+                    self.register_buffer(
+                        in_fold_idx_target, torch.tensor(in_fold_ids), persistent=False
+                    )
+                    plan_h.append((in_mid, fold_idx_target, in_fold_idx_target))
+                plan_e.append(plan_h)
+            plan.append(plan_e)
+        return plan
+
     def lookup(
-        self, module_outputs: list[Tensor], *, in_graph: Tensor | None = None
+        self,
+        module_outputs: list[Tensor | None],
+        *,
+        in_graph: Tensor | None = None,
+        start: int = 0,
     ) -> Iterator[tuple[TorchLayer | None, tuple]]:
+        # Use the static gather plan over activation arenas, if possible
+        if (
+            self._arena_plan is not None
+            and in_graph is not None
+            and not start
+            and not torch.is_grad_enabled()
+        ):
+            yield from self._lookup_arena(module_outputs, in_graph=in_graph)
+            return
+
+        # Partition the observed entries of a sparse input batch over the input layers
+        sparse_inputs = (
+            self._partition_sparse_evidence(in_graph)
+            if in_graph is not None and in_graph.layout != torch.strided
+            else None
+        )
+
         # Loop through the entries and yield inputs
-        for entry in self:
+        for entry in itertools.islice(self, start, None):
             layer = entry.module
             in_layer_ids = entry.in_module_ids
             in_fold_idx = entry.in_fold_idx
@@ -125,12 +434,12 @@ class LayerAddressBook(AddressBook[TorchLayer]):
                 in_fold_idx_h = in_fold_idx[0]
                 in_layer_ids_h = in_layer_ids[0]
                 if len(in_layer_ids_h) == 1:
-                    x = module_outputs[in_layer_ids_h[0]]
+                    (x,) = self.retrieve_outputs(module_outputs, in_layer_ids_h)
                 else:
                     # when parameters are batched inputs from constant layers
                     # might have a batch size of 1 if in_graph is always None
                     # we have expand those inputs to match the others
-                    module_inputs = [module_outputs[mid] for mid in in_layer_ids_h]
+                    module_inputs = self.retrieve_outputs(module_outputs, in_layer_ids_h)
 
                     # make sure that all inputs have the same batch size
                     # if they do not, then it must be possible to partition them
@@ -156,25 +465,182 @@ class LayerAddressBook(AddressBook[TorchLayer]):
             # Catch the case there are no inputs coming from other modules
             # That is, we are gathering the inputs of input layers
             assert isinstance(layer, TorchInputLayer)
-            if layer.num_variables:
-                if in_graph is None:
-                    yield layer, ()
-                    continue
-                # in_graph: An input batch (assignments to variables) of shape (B, D)
-                # scope_idx: The scope of the layers in each fold, a tensor of shape (F, D'), D' < D
-                # x: (B, D) -> (B, F, D') -> (F, B, D')
-                if len(in_graph.shape) != 2:
-                    raise ValueError(
-                        "The input to the circuit should have shape (B, D), "
-                        "where B is the batch size and D is the number of variables "
-                        "the circuit is defined on"
-                    )
-                x = in_graph[..., layer.scope_idx].permute(1, 0, 2)
+            yield layer, self._lookup_input_layer(layer, in_graph, sparse_inputs)
+
+    def dependencies(self, i: int) -> Sequence[int]:
+        dependencies = super().dependencies(i)
+        # The lookup over activation arenas stores the output of the previous layer in its arena
+        if self._arena_plan is not None and i > 0 and self._arena_plan.out_slots[i - 1] is not None:
+            return [*dependencies, i - 1]
+        return dependencies
+
+    def _lookup_arena(
+        self, module_outputs: list[Tensor | None], *, in_graph: Tensor
+    ) -> Iterator[tuple[TorchLayer | None, tuple]]:
+        assert self._arena_plan is not None
+        plan = self._arena_plan
+        batch_size = in_graph.shape[0]
+        arenas: list[Tensor | None] = [None] * len(plan.arena_num_folds)
+        sparse_inputs = (
+            self._partition_sparse_evidence(in_graph) if in_graph.layout != torch.strided else None
+        )
+        for i, entry in enumerate(self):
+            # Store the output of the previous layer into its arena, if needed,
+            # and replace it with a view over the arena
+            if i > 0 and (slot := plan.out_slots[i - 1]) is not None:
+                aid, offset = slot
+                y = module_outputs[i - 1]
+                assert y is not None
+                arena = _write_arena(
+                    arenas[aid],
+                    y,
+                    offset,
+                    shape=(plan.arena_num_folds[aid], batch_size, plan.arena_num_units[aid]),
+                )
+                arenas[aid] = arena
+                module_outputs[i - 1] = arena[offset : offset + y.shape[0]]
+            layer = entry.module
+
+            # Catch the case the input is retrieved from an arena
+            if (in_aid := plan.in_arena_ids[i]) is not None:
+                in_arena = arenas[in_aid]
+                target = self._arena_in_idx_targets[i]
+                assert in_arena is not None and target is not None
+                arena_idx = getattr(self, target)
+                if isinstance(arena_idx, ArenaSlice):
+                    start, num_folds, arity, transposed = arena_idx
+                    x = in_arena[start : start + num_folds * arity]
+                    if transposed:
+                        x = x.unflatten(0, (arity, num_folds)).transpose(0, 1)
+                    else:
+                        x = x.unflatten(0, (num_folds, arity))
+                else:
+                    x = in_arena[arena_idx]
                 yield layer, (x,)
                 continue
 
-            # Pass the wanted batch dimension to constant layers
-            yield layer, (1 if in_graph is None else in_graph.shape[0],)
+            # Catch the case the input is the output of a single layer
+            if entry.in_module_ids:
+                (in_layer_ids_h,) = entry.in_module_ids
+                (in_fold_idx_h,) = entry.in_fold_idx
+                (x,) = self.retrieve_outputs(module_outputs, in_layer_ids_h)
+                yield layer, (x[in_fold_idx_h],)
+                continue
+
+            assert isinstance(layer, TorchInputLayer)
+            yield layer, self._lookup_input_layer(layer, in_graph, sparse_inputs)
+
+    def _partition_sparse_evidence(self, x: Tensor) -> dict[TorchInputLayer, SparseEvidence]:
+        """Partition the observed entries of a sparse input batch over the univariate input
+        layers, i.e., for each layer retrieve the observed values of the variables in the scope
+        of its folds. The partition is computed once for all the layers, and its size is linear
+        in the number of observed entries times the number of folds having each variable in
+        their scope. It synchronizes with the device twice, regardless of the number of layers.
+
+        Args:
+            x: A coalesced sparse tensor in COO layout of shape $(B, D)$, whose specified
+                entries are the observed values of the variables.
+
+        Returns:
+            A dictionary mapping each univariate input layer to its input.
+        """
+        var_ptr, occ_layer_idx, occ_fold_idx = self._sparse_evidence_occurrences(x)
+        batch_idx, var_idx = x.indices()
+        values = x.values()
+        # Repeat each observed entry for each fold having its variable in the scope,
+        # and retrieve the index of the corresponding occurrence
+        # entry_idx, occ_idx: (E,)
+        occ_start = var_ptr[var_idx]
+        num_occs = var_ptr[var_idx + 1] - occ_start
+        entry_idx = torch.repeat_interleave(num_occs)
+        occ_offset = torch.cumsum(num_occs, dim=0) - num_occs
+        occ_idx = (
+            occ_start[entry_idx]
+            + torch.arange(len(entry_idx), device=x.device)
+            - occ_offset[entry_idx]
+        )
+        # Sort the occurrences by input layer, and split them
+        layer_idx = occ_layer_idx[occ_idx]
+        perm = torch.argsort(layer_idx, stable=True)
+        entry_idx, occ_idx = entry_idx[perm], occ_idx[perm]
+        sizes = torch.bincount(layer_idx, minlength=len(self._sparse_layers)).tolist()
+        return {
+            layer: SparseEvidence(x.shape[0], values[eidx], batch_idx[eidx], occ_fold_idx[oidx])
+            for layer, eidx, oidx in zip(
+                self._sparse_layers, entry_idx.split(sizes), occ_idx.split(sizes)
+            )
+        }
+
+    def _sparse_evidence_occurrences(self, x: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        # The occurrences of the variables in the scope of the folds of the univariate input
+        # layers, which are sorted by variable and built once on the host. For each variable v,
+        # its occurrences are in the range [var_ptr[v], var_ptr[v + 1]), and for each
+        # occurrence we store the index of the input layer and the fold
+        num_variables = x.shape[1]
+        if (
+            self._sparse_occurrences is not None
+            and self._sparse_occurrences[0] == x.device
+            and len(self._sparse_occurrences[1]) == num_variables + 1
+        ):
+            return self._sparse_occurrences[1:]
+        self._sparse_layers = [
+            e.module
+            for e in self._entries
+            if isinstance(e.module, TorchInputLayer) and e.module.num_variables == 1
+        ]
+        if not self._sparse_layers:
+            occ_var_idx = occ_layer_idx = occ_fold_idx = torch.zeros(0, dtype=torch.long)
+        else:
+            occ_var_idx = torch.cat([layer.scope_idx[:, 0].cpu() for layer in self._sparse_layers])
+            occ_layer_idx = torch.cat(
+                [torch.full((layer.num_folds,), i) for i, layer in enumerate(self._sparse_layers)]
+            )
+            occ_fold_idx = torch.cat(
+                [torch.arange(layer.num_folds) for layer in self._sparse_layers]
+            )
+        perm = torch.argsort(occ_var_idx, stable=True)
+        var_ptr = torch.zeros(num_variables + 1, dtype=torch.long)
+        var_ptr[1:] = torch.cumsum(torch.bincount(occ_var_idx, minlength=num_variables), dim=0)
+        self._sparse_occurrences = (
+            x.device,
+            var_ptr.to(x.device),
+            occ_layer_idx[perm].to(x.device),
+            occ_fold_idx[perm].to(x.device),
+        )
+        return self._sparse_occurrences[1:]
+
+    @staticmethod
+    def _lookup_input_layer(
+        layer: TorchInputLayer,
+        in_graph: Tensor | None,
+        sparse_inputs: Mapping[TorchInputLayer, SparseEvidence] | None = None,
+    ) -> tuple:
+        if layer.num_variables:
+            if in_graph is None:
+                return ()
+            # in_graph: An input batch (assignments to variables) of shape (B, D)
+            # scope_idx: The scope of the layers in each fold, a tensor of shape (F, D'), D' < D
+            # x: (B, D) -> (B, F, D') -> (F, B, D')
+            if len(in_graph.shape) != 2:
+                raise ValueError(
+                    "The input to the circuit should have shape (B, D), "
+                    "where B is the batch size and D is the number of variables "
+                    "the circuit is defined on"
+                )
+            if in_graph.layout != torch.strided:
+                # Retrieve the observed values of the variables in the scope of the layer,
+                # which have been partitioned over the input layers
+                assert sparse_inputs is not None
+                if layer not in sparse_inputs:
+                    raise NotImplementedError(
+                        "Sparse inputs to multivariate input layers are not supported"
+                    )
+                return (sparse_inputs[layer],)
+            x = in_graph[..., layer.scope_idx].permute(1, 0, 2)
+            return (x,)
+
+        # Pass the wanted batch dimension to constant layers
+        return (1 if in_graph is None else in_graph.shape[0],)
 
     @classmethod
     def from_index_info(
@@ -225,6 +691,39 @@ class LayerAddressBook(AddressBook[TorchLayer]):
         return LayerAddressBook(entries, fold_idx_info=fold_idx_info)
 
 
+def _arena_slice(arena_idx: list[list[int]]) -> ArenaSlice | None:
+    # Check whether gathering the given indices over an arena is equivalent to a strided view
+    num_folds, arity = len(arena_idx), len(arena_idx[0])
+    start = arena_idx[0][0]
+    if all(
+        idx == start + f * arity + h for f, fi in enumerate(arena_idx) for h, idx in enumerate(fi)
+    ):
+        return ArenaSlice(start, num_folds, arity, transposed=False)
+    if all(
+        idx == start + h * num_folds + f
+        for f, fi in enumerate(arena_idx)
+        for h, idx in enumerate(fi)
+    ):
+        return ArenaSlice(start, num_folds, arity, transposed=True)
+    return None
+
+
+def _write_arena(
+    arena: Tensor | None, y: Tensor, offset: int, *, shape: tuple[int, int, int]
+) -> Tensor:
+    # Lazily allocate the arena, and then copy the output of a layer into it
+    if arena is None:
+        arena = torch.empty(shape, dtype=y.dtype, device=y.device)
+    elif arena.dtype != y.dtype:
+        raise ValueError(
+            f"Found inconsistent data types {arena.dtype} and {y.dtype} between layer outputs"
+        )
+    if y.shape[1] not in (1, shape[1]):
+        raise ValueError("Found an inconsistent batch dimension between units.")
+    arena[offset : offset + y.shape[0]].copy_(y)
+    return arena
+
+
 class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
     """The torch circuit implementation. It is a (possibly folded)
     computational graph of torch layers implementations."""
@@ -265,6 +764,12 @@ class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
         gate_function_evals = {} if gate_function_evals is None else gate_function_evals
         self._gate_function_evals = gate_function_evals
         self._symbolic_operation = symbolic_operation
+        self._generated_forward: Callable[[TorchCircuit, Tensor | None], Tensor] | None = None
+        self._generated_code: str | None = None
+        self._checkpoints: list[int] | None = None
+        self._executor: Executor | None = None
+        self._tensor_parameters: list[TorchTensorParameter] | None = None
+        self._constants_cache: dict[Hashable, tuple[tuple, Tensor]] = {}
 
     @property
     def scope(self) -> Scope:
@@ -293,6 +798,16 @@ class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
         """
         return self._properties
 
+    @property
+    def address_book(self) -> LayerAddressBook:
+        """Retrieve the address book object of the circuit.
+
+        Returns:
+            The layers address book.
+        """
+        assert isinstance(self._address_book, LayerAddressBook)
+        return self._address_book
+
     @property
     def device(self) -> torch.device:
         """Retrieve the device on which the circuit is loaded.
@@ -373,6 +888,121 @@ class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
         """
         return self._gate_function_evals
 
+    @property
+    def generated_code(self) -> str | None:
+        """Retrieve the source of the generated code used to evaluate the circuit, if any.
+
+        Returns:
+            The generated Python source, or None if the circuit is evaluated by looking up
+                its address book.
+        """
+        return self._generated_code
+
+    @property
+    def generated_forward(self) -> Callable[["TorchCircuit", Tensor | None], Tensor] | None:
+        """Retrieve the generated function used to evaluate the circuit, if any.
+
+        Returns:
+            The generated function, or None if the circuit is evaluated by looking up
+                its address book.
+        """
+        return self._generated_forward
+
+    def set_generated_forward(
+        self,
+        forward_fn: Callable[["TorchCircuit", Tensor | None], Tensor] | None,
+        code: str | None = None,
+    ) -> None:
+        """Set the generated code used to evaluate the circuit.
+        See [generate_code][cirkit.backend.torch.codegen.generate_code] for details.
+
+        Args:
+            forward_fn: The generated function, taking as input the circuit itself and the
+                input of the circuit. If it is None, then the circuit will be evaluated by
+                looking up its address book.
+            code: The generated Python source of the function. It is ignored if the function
+                is None.
+        """
+        self._generated_forward = forward_fn
+        self._generated_code = None if forward_fn is None else code
+
+    @property
+    def checkpoints(self) -> Sequence[int] | None:
+        """Retrieve the indices of the address book entries used as activation checkpoints
+        when evaluating the circuit with gradients enabled, if any.
+
+        Returns:
+            The checkpoints, or None if activation checkpointing is disabled.
+        """
+        return self._checkpoints
+
+    def set_checkpoints(self, checkpoints: Sequence[int] | None) -> None:
+        """Set the activation checkpoints used when evaluating the circuit with gradients
+        enabled. See [TorchDiAcyclicGraph.evaluate]
+        [cirkit.backend.torch.graph.modules.TorchDiAcyclicGraph.evaluate] for details.
+
+        Args:
+            checkpoints: The indices of the address book entries at which the evaluation
+                is split into segments, e.g., as computed by [TorchCircuit.checkpoint_frontiers]
+                [cirkit.backend.torch.circuits.TorchCircuit.checkpoint_frontiers].
+                If it is None, then activation checkpointing is disabled.
+        """
+        self._checkpoints = None if checkpoints is None else sorted(checkpoints)
+
+    def checkpoint_frontiers(
+        self, *, every: int | None = None, memory_budget: int | None = None
+    ) -> list[int]:
+        """Select the frontiers of the layerwise topological ordering to use as activation
+        checkpoints, either every $k$ frontiers or by a memory budget. In the latter case,
+        the frontiers are selected greedily such that the activations computed between two
+        consecutive checkpoints, i.e., the ones being recomputed at once during the backward
+        pass, require at most the given number of bytes per batch element, if possible.
+
+        Args:
+            every: The number $k$ of frontiers between two consecutive checkpoints.
+            memory_budget: The maximum number of bytes per batch element required to store
+                the activations between two consecutive checkpoints.
+
+        Returns:
+            The indices of the address book entries to use as checkpoints.
+
+        Raises:
+            ValueError: If not exactly one between the number of frontiers and
+                the memory budget is given, or if it is not a positive integer.
+        """
+        if (every is None) == (memory_budget is None):
+            raise ValueError("Exactly one between 'every' and 'memory_budget' must be given")
+        cuts = self.frontier_cuts()
+        if every is not None:
+            if every <= 0:
+                raise ValueError(f"The number of frontiers must be positive, but found {every}")
+            return cuts[every - 1 :: every]
+        assert memory_budget is not None
+        if memory_budget <= 0:
+            raise ValueError(f"The memory budget must be positive, but found {memory_budget}")
+        # Estimate the number of bytes per batch element of the output of each layer
+        # Note that this depends on the data type the semiring casts the parameters to
+        try:
+            dtype = next(self.parameters()).dtype
+        except StopIteration:
+            dtype = torch.get_default_dtype()
+        entry_bytes = [
+            entry.module.num_folds
+            * entry.module.num_output_units
+            * entry.module.semiring.cast(torch.zeros((), dtype=dtype)).element_size()
+            for entry in self._address_book
+            if entry.module is not None
+        ]
+        checkpoints: list[int] = []
+        segment_bytes = 0
+        for start, stop in zip([0, *cuts], [*cuts, len(entry_bytes)]):
+            frontier_bytes = sum(entry_bytes[start:stop])
+            if segment_bytes and segment_bytes + frontier_bytes > memory_budget:
+                checkpoints.append(start)
+                segment_bytes = 0
+            segment_bytes += frontier_bytes
+        return checkpoints
+
     def reset_parameters(self) -> None:
         """Reset the parameters of the circuit in-place."""
         # For each layer, initialize its parameters, if any
@@ -394,18 +1024,178 @@ class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
             # memoize the gate function execution
             gate_function_eval.memoize(**kwargs)
 
+    @contextmanager
+    def thread_pool(
+        self, max_workers: int, *, intra_op_threads: int | None = None
+    ) -> Iterator[ThreadPoolExecutor]:
+        """A context manager within which the circuit layers that do not depend on each other
+        (e.g., the folded layers of the same frontier) are evaluated concurrently on a pool
+        of threads. The number of threads used by torch for intra-op parallelism is capped
+        within the context, in order to avoid oversubscribing the CPU cores.
+
+        Args:
+            max_workers: The maximum number of threads evaluating the layers.
+            intra_op_threads: The number of threads used by torch for intra-op parallelism
+                within the context. If it is None, then the current number of threads
+                is divided among the workers.
+
+        Yields:
+            The thread pool executor.
+
+        Raises:
+            ValueError: If the maximum number of threads or the number of intra-op threads
+                is not a positive integer.
+        """
+        if max_workers <= 0:
+            raise ValueError(
+                f"The maximum number of workers must be positive, but found {max_workers}"
+            )
+        num_threads = torch.get_num_threads()
+        if intra_op_threads is None:
+            intra_op_threads = max(1, num_threads // max_workers)
+        elif intra_op_threads <= 0:
+            raise ValueError(
+                f"The number of intra-op threads must be positive, but found {intra_op_threads}"
+            )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            torch.set_num_threads(intra_op_threads)
+            self._executor = executor
+            try:
+                yield executor
+            finally:
+                self._executor = None
+                torch.set_num_threads(num_threads)
+
+    @contextmanager
+    def memoize_parameters(self) -> Iterator[None]:
+        """A context manager memoizing the output of the parameters of the circuit, i.e.,
+        within the context each parameter computational graph is evaluated only once.
+        The parameters depending on gate functions are not memoized, since their outputs
+        depend on the gate function inputs.
+
+        Yields:
+            Nothing.
+        """
+        params = [
+            p
+            for p in self.modules()
+            if isinstance(p, TorchParameter)
+            and not p.is_memoized
+            and not any(isinstance(n, TorchGateFunctionParameter) for n in p.nodes)
+        ]
+        try:
+            for p in params:
+                p.memoize()
+            yield
+        finally:
+            for p in params:
+                p.reset_cache()
+
+    def cached_constant(self, key: Hashable, fn: Callable[[], Tensor]) -> Tensor:
+        """Compute a tensor that depends on the parameters of the circuit only, e.g., the
+        integral of an input layer, by reusing the tensor computed by a previous call with the
+        same key if the parameter tensors have not changed since then. The changes are detected
+        by means of the version counters of the parameter tensors, which are increased by any
+        in-place update (e.g., an optimizer step or loading a state dictionary), as well as by
+        their devices and data types. The tensors are cached only if gradients are disabled
+        and the circuit does not depend on gate functions, otherwise the function is simply
+        evaluated.
+
+        Args:
+            key: The key identifying the tensor to compute.
+            fn: The function computing the tensor.
+
+        Returns:
+            Tensor: The tensor computed by the function.
+        """
+        if torch.is_grad_enabled() or self._gate_function_evals:
+            return fn()
+        versions = self.parameter_versions()
+        cached = self._constants_cache.get(key)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+        y = fn()
+        self._constants_cache[key] = (versions, y)
+        return y
+
+    def parameter_versions(self) -> tuple[tuple[int, torch.device, torch.dtype, int], ...]:
+        """Retrieve the versions of the tensor parameters of the circuit, i.e., for each of
+        them, its data pointer, device, data type and in-place version counter. Two equal
+        results guarantee that the parameters have not been changed in between.
+
+        Returns:
+            The versions of the tensor parameters of the circuit.
+        """
+        # The tensor parameters include the ones pointed to by parameters of other circuits,
+        # since pointer parameters register them as sub-modules
+        if self._tensor_parameters is None:
+            self._tensor_parameters = [
+                p for p in self.modules() if isinstance(p, TorchTensorParameter)
+            ]
+        return tuple(
+            (t.data_ptr(), t.device, t.dtype, t._version)
+            for p in self._tensor_parameters
+            if (t := p._ptensor) is not None
+        )
+
+    def evaluate_chunks(
+        self,
+        chunk_fn: Callable[[slice, Mapping[str, Mapping[str, Any]] | None], Tensor],
+        batch_size: int,
+        *,
+        chunk_size: int,
+        gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None,
+    ) -> Tensor:
+        """Evaluate a function over chunks of a batch, and concatenate the results along the
+        batch dimension. The parameters of the circuit are memoized across the chunks (see
+        [memoize_parameters][cirkit.backend.torch.circuits.TorchCircuit.memoize_parameters]),
+        such that the peak memory is bounded by the one required to evaluate a single chunk.
+
+        Args:
+            chunk_fn: The function to evaluate on each chunk. It takes as input the slice
+                of the batch to evaluate, and the gate function keyword arguments of the chunk,
+                and it returns a tensor whose first dimension is the batch dimension.
+            batch_size: The batch size $B$.
+            chunk_size: The maximum number of batch elements in each chunk.
+            gate_function_kwargs: The keyword arguments of the gate functions. Each tensor
+                argument whose first dimension is equal to the batch size is chunked as well,
+                while any other argument is passed as it is to each chunk.
+
+        Returns:
+            Tensor: The concatenation of the tensors computed on each chunk.
+
+        Raises:
+            ValueError: If the chunk size is not a positive integer.
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"The chunk size must be a positive integer, but found {chunk_size}")
+        with self.memoize_parameters():
+            ys = []
+            for start in range(0, batch_size, chunk_size):
+                chunk = slice(start, min(start + chunk_size, batch_size))
+                chunk_gate_function_kwargs = (
+                    None
+                    if gate_function_kwargs is None
+                    else _chunk_gate_function_kwargs(gate_function_kwargs, chunk, batch_size)
+                )
+                ys.append(chunk_fn(chunk, chunk_gate_function_kwargs))
+        return torch.cat(ys, dim=0)
+
     def __call__(
         self,
         x: Tensor | None = None,
         gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None,
+        *,
+        chunk_size: int | None = None,
     ) -> Tensor:
-        # IGNORE: Idiom for nn.Module.__call__.
-        return super().__call__(x, gate_function_kwargs=gate_function_kwargs)  # type: ignore[no-any-return,misc]
+        return super().__call__(x, gate_function_kwargs=gate_function_kwargs, chunk_size=chunk_size)
 
     def forward(
         self,
         x: Tensor | None = None,
         gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None,
+        *,
+        chunk_size: int | None = None,
     ) -> Tensor:
         """Evaluate the circuit layers in forward mode, i.e., by evaluating each layer by
         following the topological ordering.
@@ -414,6 +1204,19 @@ class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
             x: The tensor input of the circuit, with shape $(B, D)$, where B is the batch size,
                 and $D$ is the number of variables. It can be None if the circuit has empty scope,
                 i.e., it computes a constant tensor. Defaults to None.
+                It can also be a sparse tensor (either in COO or CSR layout), whose specified
+                entries are the observed values of the variables. In such a case, the variables
+                that are not observed are integrated, and the univariate input layers are
+                evaluated on the observed values only, i.e., without ever building the dense
+                input tensor. The cost of retrieving their inputs is linear in the number of
+                observed values.
+            gate_function_kwargs: The keyword arguments of the gate functions, if any.
+            chunk_size: The maximum number of batch elements to evaluate at once. If it is
+                not None, then the input batch is split into chunks that are evaluated one
+                after the other, and whose outputs are then concatenated. The parameters are
+                computed only once, and the gate functions are memoized on each chunk (see
+                [evaluate_chunks][cirkit.backend.torch.circuits.TorchCircuit.evaluate_chunks]).
+                Defaults to None, i.e., the whole batch is evaluated at once.
 
         Returns:
             Tensor: The tensor output of the circuit, with shape $(B, O, K)$,
@@ -422,22 +1225,188 @@ class TorchCircuit(TorchDiAcyclicGraph[TorchLayer]):
 
         Raises:
             ValueError: If the scope is not empty and the tensor input to the circuit is None.
+            ValueError: If the tensor input is sparse, but the circuit is not smooth or not
+                decomposable, i.e., if the variables that are not observed cannot be integrated.
         """
         if self._scope and x is None:
             raise ValueError(f"Expected some input 'x', as the circuit has scope '{self._scope}'")
-        return self._evaluate_layers(x, gate_function_kwargs=gate_function_kwargs)
+        if x is not None and x.layout != torch.strided:
+            if not self._properties.smooth or not self._properties.decomposable:
+                raise ValueError(
+                    f"The circuit must be smooth and decomposable to be evaluated on sparse "
+                    f"inputs, but found {self._properties}"
+                )
+            x = coalesce_evidence(x)
+        if chunk_size is None or x is None:
+            return self._evaluate_layers(x, gate_function_kwargs=gate_function_kwargs)
+        return self.evaluate_chunks(
+            lambda chunk, chunk_kwargs: self._evaluate_layers(
+                slice_batch(x, chunk), gate_function_kwargs=chunk_kwargs
+            ),
+            x.shape[0],
+            chunk_size=chunk_size,
+            gate_function_kwargs=gate_function_kwargs,
+        )
 
     def _evaluate_layers(
         self, x: Tensor | None, gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None
+    ) -> Tensor:
+        # If the circuit has empty scope (e.g., it computes a partition function), then its
+        # output is reused as long as its parameters are not changed
+        if not self._scope and x is None:
+            return self.cached_constant(
+                "output", lambda: self._evaluate_layers_uncached(x, gate_function_kwargs)
+            )
+        return self._evaluate_layers_uncached(x, gate_function_kwargs)
+
+    def _evaluate_layers_uncached(
+        self, x: Tensor | None, gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None
     ) -> Tensor:
         # Memoize the gate functions.This will be called just before the invocation of the
         # [evaluate][cirkit.backend.torch.graph.modules.TorchDiAcyclicGraph.evaluate] method.
         self._memoize_gate_functions({} if gate_function_kwargs is None else gate_function_kwargs)
 
-        # Evaluate layers on the given input
-        y = self.evaluate(x)  # (O, B, K)
+        # Evaluate the straight-line generated code, if any
+        # Note that activation checkpointing requires evaluating the circuit by segments,
+        # and that the concurrent evaluation of the layers requires an executor
+        if (
+            self._generated_forward is not None
+            and self._executor is None
+            and not (self._checkpoints and torch.is_grad_enabled())
+            and (x is None or x.layout == torch.strided)
+        ):
+            return self._generated_forward(self, x)
+
+        # Evaluate layers on the given input, while reusing the outputs of the constant
+        # layers (e.g., the integrals of the input layers of marginal circuits)
+        y = self.evaluate(
+            x,
+            module_fn=(
+                self._cached_layer_fn
+                if x is None or x.layout == torch.strided
+                else self._sparse_evidence_layer_fn
+            ),
+            checkpoints=self._checkpoints,
+            executor=self._executor,
+        )  # (O, B, K)
         y = y.transpose(0, 1)  # (B, O, K)
         # If the circuit has empty scope, we squeeze the batch dimension, as it is 1
         if not self._scope:
             y = y.squeeze(dim=0)  # (O, K)
         return y
+
+    def _cached_layer_fn(self, layer: TorchLayer, *inputs: Tensor | int) -> Tensor:
+        if (
+            not isinstance(layer, TorchConstantLayer)
+            or torch.is_grad_enabled()
+            or self._gate_function_evals
+        ):
+            return layer(*inputs)
+        # Constant layers receive the wanted batch dimension only
+        (batch_size,) = inputs
+        assert isinstance(batch_size, int)
+        y = self.cached_constant(("layer", layer), lambda: layer(1))  # (F, 1, Ko)
+        return y.expand(-1, batch_size, -1) if y.shape[1] == 1 else y
+
+    def _sparse_evidence_layer_fn(
+        self, layer: TorchLayer, *inputs: Tensor | int | SparseEvidence
+    ) -> Tensor:
+        # Only the input layers depending on variables receive the sparse evidence,
+        # while the other layers receive either dense tensors or the wanted batch dimension
+        if isinstance(layer, TorchInputLayer) and len(inputs) == 1:
+            (evidence,) = inputs
+            if isinstance(evidence, SparseEvidence):
+                integral = self.cached_constant(("integrate", layer), layer.integrate)  # (F, 1, K)
+                return evaluate_sparse_evidence(layer, evidence, integral)
+        dense_inputs = [x for x in inputs if not isinstance(x, SparseEvidence)]
+        assert len(dense_inputs) == len(inputs)
+        return self._cached_layer_fn(layer, *dense_inputs)
+
+
+def coalesce_evidence(x: Tensor) -> Tensor:
+    """Convert a sparse input tensor to a coalesced sparse tensor in COO layout.
+
+    Args:
+        x: A sparse input tensor of shape $(B, D)$, either in COO or CSR layout.
+
+    Returns:
+        Tensor: The coalesced sparse tensor in COO layout.
+
+    Raises:
+        ValueError: If the sparse input tensor is not a matrix.
+    """
+    if len(x.shape) != 2:
+        raise ValueError(
+            "The sparse input to the circuit should have shape (B, D), "
+            "where B is the batch size and D is the number of variables "
+            "the circuit is defined on"
+        )
+    if x.layout != torch.sparse_coo:
+        x = x.to_sparse_coo()
+    return x.coalesce()
+
+
+def evaluate_sparse_evidence(
+    layer: TorchInputLayer,
+    evidence: SparseEvidence,
+    integral: Tensor,
+    *,
+    integrate: Tensor | None = None,
+) -> Tensor:
+    """Evaluate a univariate input layer on the observed values of a sparse input batch,
+    where the variables that are not observed are integrated. The layer is evaluated on the
+    observed values only, each one with the parameters of its fold, and the results are
+    scattered over the integrals of the folds.
+
+    Args:
+        layer: The univariate input layer.
+        evidence: The observed values of the variables in the scope of the layer.
+        integral: The integral of the layer, a tensor of shape $(F, 1, K)$.
+        integrate: A boolean mask of shape $(N,)$ being True for the observed values to be
+            integrated nonetheless. If it is None, then no observed value is integrated.
+
+    Returns:
+        Tensor: The output of the layer, having shape $(F, B, K)$.
+    """
+    # y: (F, B, K)
+    y = integral.expand(-1, evidence.batch_size, -1)
+    if not len(evidence.values):
+        return y
+    # Evaluate the layer on the observed values, as if each of them was a fold
+    # observed_y: (N, 1, K) -> (N, K)
+    with layer.select_folds(evidence.fold_idx):
+        observed_y = layer(evidence.values.view(-1, 1, 1))[:, 0]
+    if integrate is not None:
+        observed_y = torch.where(
+            integrate.unsqueeze(dim=1), integral[evidence.fold_idx, 0], observed_y
+        )
+    return y.index_put((evidence.fold_idx, evidence.batch_idx), observed_y)
+
+
+def slice_batch(x: Tensor, chunk: slice) -> Tensor:
+    """Slice an input tensor along the batch dimension, where the input tensor can be sparse.
+
+    Args:
+        x: The input tensor of shape $(B, D)$, possibly a coalesced sparse tensor in COO layout.
+        chunk: The slice of the batch.
+
+    Returns:
+        Tensor: The sliced input tensor.
+    """
+    if x.layout == torch.strided:
+        return x[chunk]
+    start, stop, step = chunk.indices(x.shape[0])
+    return x.index_select(0, torch.arange(start, stop, step, device=x.device)).coalesce()
+
+
+def _chunk_gate_function_kwargs(
+    gate_function_kwargs: Mapping[str, Mapping[str, Any]], chunk: slice, batch_size: int
+) -> Mapping[str, Mapping[str, Any]]:
+    # Slice the tensor arguments of the gate functions that are batched
+    return {
+        gate_function_id: {
+            k: v[chunk] if isinstance(v, Tensor) and v.dim() and v.shape[0] == batch_size else v
+            for k, v in kwargs.items()
+        }
+        for gate_function_id, kwargs in gate_function_kwargs.items()
+    }
@@ -0,0 +1,292 @@
+from collections.abc import Callable, Mapping
+from typing import Any
+
+import torch
+from torch import Tensor, fx, nn
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.layers import TorchInputLayer, TorchLayer
+from cirkit.backend.torch.parameters.nodes import TorchGateFunctionParameter
+from cirkit.backend.torch.parameters.parameter import TorchParameter
+
+
+class _ExampleProxy(fx.Proxy):
+    """A proxy carrying the value computed on an example input, which is used to resolve
+    the tensor properties (e.g., the data type) that the semiring operations dispatch on.
+    The shapes are instead kept symbolic, such that the generated code works for any
+    batch size."""
+
+    @property
+    def example_value(self) -> Any:
+        return self.node.meta.get("example_value")
+
+    @property
+    def dtype(self) -> Any:
+        value = self.example_value
+        if not isinstance(value, Tensor):
+            return self.__getattr__("dtype")
+        return value.dtype
+
+    def is_floating_point(self) -> Any:
+        value = self.example_value
+        if not isinstance(value, Tensor):
+            return self.__getattr__("is_floating_point")()
+        return value.is_floating_point()
+
+    def is_complex(self) -> Any:
+        value = self.example_value
+        if not isinstance(value, Tensor):
+            return self.__getattr__("is_complex")()
+        return value.is_complex()
+
+    def __getattr__(self, k: str) -> Any:
+        # Tensor attributes (e.g., the real part of a complex tensor) are recorded eagerly,
+        # such that the proxy returned carries an example value too
+        value = self.__dict__.get("node", None)
+        value = None if value is None else value.meta.get("example_value")
+        if k.startswith("_") or not isinstance(value, Tensor) or callable(getattr(value, k, None)):
+            return super().__getattr__(k)
+        return self.tracer.create_proxy("call_function", getattr, (self, k), {})
+
+
+class _CircuitTracer(fx.Tracer):
+    """The tracer used to unroll the evaluation of a circuit. Parameters and input layers
+    are kept as modules to call, while the inner layers are inlined, unless tracing
+    them fails, e.g., because of data-dependent control flow."""
+
+    def __init__(self, example_outputs: Mapping[nn.Module, Any], example_input: Tensor | None):
+        super().__init__()
+        self._example_outputs = example_outputs
+        self._example_input = example_input
+        self._attributes: dict[str, Any] = {}
+        self._modules: dict[str, nn.Module] = {}
+
+    def trace(self, root: nn.Module | Callable[..., Any], *args: Any, **kwargs: Any) -> fx.Graph:
+        assert isinstance(root, nn.Module)
+        self._attributes = dict(root.named_parameters(remove_duplicate=False))
+        self._attributes.update(root.named_buffers(remove_duplicate=False))
+        self._modules = dict(root.named_modules(remove_duplicate=False))
+        return super().trace(root, *args, **kwargs)
+
+    def proxy(self, node: fx.Node) -> fx.Proxy:
+        return _ExampleProxy(node, self)
+
+    def is_leaf_module(self, m: nn.Module, module_qualified_name: str) -> bool:
+        if isinstance(m, (TorchParameter, TorchInputLayer)):
+            return True
+        return super().is_leaf_module(m, module_qualified_name)
+
+    def call_module(
+        self,
+        m: nn.Module,
+        forward: Callable[..., Any],
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+    ) -> Any:
+        module_qualified_name = self.path_of_module(m)
+        if not self.is_leaf_module(m, module_qualified_name):
+            try:
+                return forward(*args, **kwargs)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Fallback to calling the layer as a module. The nodes that have been recorded
+                # before the failure are removed, as they are dead code
+                if not isinstance(m, TorchLayer):
+                    raise
+        return self.create_proxy("call_module", module_qualified_name, args, kwargs)
+
+    def create_proxy(
+        self,
+        kind: str,
+        target: Any,
+        args: tuple[Any, ...],
+        kwargs: dict[str, Any],
+        *p_args: Any,
+        **p_kwargs: Any,
+    ) -> fx.Proxy:
+        proxy = super().create_proxy(kind, target, args, kwargs, *p_args, **p_kwargs)
+        proxy.node.meta["example_value"] = self._example_value(kind, target, args, kwargs)
+        return proxy
+
+    def _example_value(
+        self, kind: str, target: Any, args: tuple[Any, ...], kwargs: dict[str, Any]
+    ) -> Any:
+        match kind:
+            case "placeholder":
+                return self._example_input
+            case "get_attr":
+                return self._attributes.get(target)
+            case "call_module":
+                return self._example_outputs.get(self._modules[target])
+        example_args = [fx.node.map_aggregate(a, _example_value_of) for a in args]
+        example_kwargs = {k: fx.node.map_aggregate(v, _example_value_of) for k, v in kwargs.items()}
+        try:
+            if kind == "call_method":
+                obj, *method_args = example_args
+                return getattr(obj, target)(*method_args, **example_kwargs)
+            return target(*example_args, **example_kwargs)
+        except Exception:  # pylint: disable=broad-exception-caught
+            return None
+
+
+class _UnrolledCircuit(nn.Module):
+    """A module evaluating a circuit by unrolling its address book. It is traced with
+    concrete Python control flow, and therefore only the tensor operations are recorded."""
+
+    def __init__(self, cc: TorchCircuit) -> None:
+        super().__init__()
+        self.circuit = cc
+
+    def forward(self, x: Tensor | None = None) -> Tensor:
+        cc = self.circuit
+        module_outputs: list[Any] = []
+        for entry in cc.address_book:
+            layer = entry.module
+            if entry.in_module_ids:
+                (in_layer_ids_h,) = entry.in_module_ids
+                (in_fold_idx_h,) = entry.in_fold_idx
+                if len(in_layer_ids_h) == 1:
+                    y = module_outputs[in_layer_ids_h[0]]
+                else:
+                    y = torch.cat([module_outputs[mid] for mid in in_layer_ids_h], dim=0)
+                y = y[in_fold_idx_h]
+                if layer is None:
+                    break
+                module_outputs.append(layer(y))
+                continue
+            assert isinstance(layer, TorchInputLayer)
+            if not layer.num_variables:
+                module_outputs.append(layer(1 if x is None else x.size(0)))
+                continue
+            assert x is not None
+            # x: (B, D) -> (B, F, D') -> (F, B, D')
+            module_outputs.append(layer(x[..., layer.scope_idx].permute(1, 0, 2)))
+        y = y.transpose(0, 1)  # (B, O, K)
+        if not cc.scope:
+            y = y.squeeze(dim=0)  # (O, K)
+        return y
+
+
+def trace_circuit(cc: TorchCircuit, *, example_input: Tensor | None = None) -> fx.Graph:
+    """Trace the evaluation of a circuit into a straight-line graph of tensor operations.
+    The address book of the circuit is unrolled, and the layers and semiring operations
+    are inlined, such that no Python dispatch is performed when the graph is executed.
+    Parameters and input layers are kept as modules to call, and the same holds for any
+    inner layer whose evaluation cannot be traced.
+
+    Args:
+        cc: The circuit. It cannot depend on gate functions.
+        example_input: An example input of shape $(B, D)$, which is evaluated to resolve
+            properties such as the data types of the intermediate tensors.
+            If it is None, then an input of zeros is used. It is ignored if the circuit
+            has empty scope.
+
+    Returns:
+        The traced graph, whose targets are relative to the given circuit.
+
+    Raises:
+        ValueError: If the circuit depends on gate functions.
+    """
+    if has_gate_functions(cc):
+        raise ValueError("Cannot trace circuits whose parameters depend on gate functions")
+    if not cc.scope:
+        example_input = None
+    elif example_input is None:
+        example_input = torch.zeros(2, max(cc.scope) + 1, device=cc.device)
+
+    # Compute the outputs of the parameters and layers on the example input.
+    # These are used as example values of the modules that are called by the traced graph
+    example_outputs: dict[nn.Module, Any] = {}
+
+    def _layer_fn(layer: TorchLayer, *inputs: Tensor | int) -> Tensor:
+        y = layer(*inputs)
+        example_outputs[layer] = y
+        return y
+
+    with torch.no_grad():
+        for p in cc.modules():
+            if isinstance(p, TorchParameter):
+                example_outputs[p] = p()
+        cc.evaluate(example_input, module_fn=_layer_fn)
+
+        unrolled_cc = _UnrolledCircuit(cc)
+        tracer = _CircuitTracer(example_outputs, example_input)
+        concrete_args = None if cc.scope else {"x": None}
+        graph = tracer.trace(unrolled_cc, concrete_args=concrete_args)
+
+    # Make the targets relative to the circuit, and remove the nodes that have been recorded
+    # while tracing layers that are eventually called as modules
+    for node in graph.nodes:
+        if node.op in ("call_module", "get_attr"):
+            assert node.target.startswith("circuit.")
+            node.target = node.target[len("circuit.") :]
+        node.meta.pop("example_value", None)
+    # The graph must be owned by a module sharing the submodules of the circuit,
+    # such that the purity of the modules being called can be checked
+    owning_module = fx.GraphModule(cc, graph)
+    owning_module.graph.eliminate_dead_code()
+    owning_module.graph.lint()
+    return owning_module.graph
+
+
+def generate_code(
+    cc: TorchCircuit, *, example_input: Tensor | None = None
+) -> tuple[Callable[[TorchCircuit, Tensor | None], Tensor], str]:
+    """Generate the Python code evaluating a circuit, by tracing it with
+    [trace_circuit][cirkit.backend.torch.codegen.trace_circuit]. The generated code retrieves
+    the parameters, buffers and modules to call from the circuit given as first argument.
+
+    Args:
+        cc: The circuit. It cannot depend on gate functions.
+        example_input: An example input of shape $(B, D)$. See
+            [trace_circuit][cirkit.backend.torch.codegen.trace_circuit].
+
+    Returns:
+        A tuple of (1) a function taking as input the circuit and a batch of shape $(B, D)$
+            (or None, if the circuit has empty scope), and returning a tensor of shape
+            $(B, O, K)$, and (2) the generated Python source of the function.
+    """
+    graph = trace_circuit(cc, example_input=example_input)
+    code = graph.python_code(root_module="self")
+    fn_globals = dict(code.globals)
+    exec(compile(code.src, f"<generated {type(cc).__name__}>", "exec"), fn_globals)
+    return fn_globals["forward"], code.src
+
+
+def generate_graph_module(
+    cc: TorchCircuit, *, example_input: Tensor | None = None
+) -> fx.GraphModule:
+    """Generate a [torch.fx.GraphModule][torch.fx.GraphModule] that evaluates a circuit,
+    by tracing it with [trace_circuit][cirkit.backend.torch.codegen.trace_circuit].
+    The generated module shares the parameters and the modules to call with the circuit,
+    while it stores a reference to the buffers being used. Its generated Python source is
+    available via the ```code``` attribute.
+
+    Args:
+        cc: The circuit. It cannot depend on gate functions.
+        example_input: An example input of shape $(B, D)$. See
+            [trace_circuit][cirkit.backend.torch.codegen.trace_circuit].
+
+    Returns:
+        The generated module, taking as input a batch of shape $(B, D)$ and returning
+            a tensor of shape $(B, O, K)$, like the circuit does.
+    """
+    graph = trace_circuit(cc, example_input=example_input)
+    return fx.GraphModule(cc, graph, class_name=f"Generated{type(cc).__name__}")
+
+
+def has_gate_functions(cc: TorchCircuit) -> bool:
+    """Check whether the parameters of a circuit depend on gate functions.
+
+    Args:
+        cc: The circuit.
+
+    Returns:
+        True if some parameter of the circuit depends on a gate function, and False otherwise.
+    """
+    return any(isinstance(m, TorchGateFunctionParameter) for m in cc.modules())
+
+
+def _example_value_of(a: Any) -> Any:
+    if isinstance(a, fx.Proxy):
+        return a.node.meta.get("example_value")
+    return a
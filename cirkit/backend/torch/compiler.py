@@ -14,6 +14,7 @@ from cirkit.backend.compiler import (
     CompilerParameterRegistry,
 )
 from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.codegen import generate_code, has_gate_functions
 from cirkit.backend.torch.graph.folding import build_folded_graph
 from cirkit.backend.torch.graph.optimize import match_optimization_patterns, optimize_graph
 from cirkit.backend.torch.initializers import foldwise_initializer_
@@ -128,7 +129,12 @@ class TorchCompilerState:
 
 class TorchCompiler(AbstractCompiler[TorchCircuit]):
     def __init__(
-        self, semiring: str = "sum-product", fold: bool = False, optimize: bool = False
+        self,
+        semiring: str = "sum-product",
+        fold: bool = False,
+        optimize: bool = False,
+        arena: bool = False,
+        codegen: bool = False,
     ) -> None:
         super().__init__(
             CompilerLayerRegistry(DEFAULT_LAYER_COMPILATION_RULES),
@@ -136,6 +142,8 @@ class TorchCompiler(AbstractCompiler[TorchCircuit]):
             CompilerInitializerRegistry(DEFAULT_INITIALIZER_COMPILATION_RULES),
             fold=fold,
             optimize=optimize,
+            arena=arena,
+            codegen=codegen,
         )
 
         # The semiring being used at compile time
@@ -178,6 +186,14 @@ class TorchCompiler(AbstractCompiler[TorchCircuit]):
     def is_optimize_enabled(self) -> bool:
         return self._flags["optimize"]
 
+    @property
+    def is_arena_enabled(self) -> bool:
+        return self._flags["arena"]
+
+    @property
+    def is_codegen_enabled(self) -> bool:
+        return self._flags["codegen"]
+
     @property
     def state(self) -> TorchCompilerState:
         return self._state
@@ -279,6 +295,10 @@ class TorchCompiler(AbstractCompiler[TorchCircuit]):
         # Allocate & initialize the parameters
         cc.reset_parameters()
 
+        # Generate the straight-line code evaluating the circuit, if possible
+        if self.is_codegen_enabled and not has_gate_functions(cc):
+            cc.set_generated_forward(*generate_code(cc))
+
         # Register the compiled circuit
         self.register_compiled_circuit(sc, cc)
 
@@ -297,6 +317,9 @@ class TorchCompiler(AbstractCompiler[TorchCircuit]):
             opt_cc = _fold_circuit(self, cc)
             del cc
             cc = opt_cc
+        if self.is_arena_enabled:
+            # Build the static gather plan over activation arenas
+            cc.address_book.build_arena_plan()
         return cc
 
 
@@ -0,0 +1,209 @@
+from dataclasses import dataclass
+
+import torch
+from torch import Tensor
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.layers import (
+    TorchCPTLayer,
+    TorchHadamardLayer,
+    TorchInputLayer,
+    TorchKroneckerLayer,
+    TorchLayer,
+    TorchSumLayer,
+    TorchTuckerLayer,
+)
+from cirkit.backend.torch.layers.optimized import TorchTensorDotLayer
+
+
+@dataclass(frozen=True)
+class LayerCost:
+    """The estimated cost of evaluating a (possibly folded) circuit layer on a batch."""
+
+    entry_id: int
+    """The index of the entry of the address book the layer belongs to."""
+    layer: str
+    """The name of the layer type."""
+    num_folds: int
+    """The number of folds of the layer."""
+    arity: int
+    """The arity of the layer."""
+    num_input_units: int
+    """The number of input units of the layer."""
+    num_output_units: int
+    """The number of output units of the layer."""
+    flops: int
+    """The estimated number of floating point operations."""
+    param_bytes: int
+    """The number of bytes of the parameters of the layer."""
+    input_bytes: int
+    """The number of bytes of the input gathered from the outputs of other layers.
+    It is zero for input layers, and for the layers whose input is a view."""
+    output_bytes: int
+    """The number of bytes of the output of the layer."""
+    live_bytes: int
+    """The number of bytes of the activations being alive while the layer is evaluated,
+    i.e., the ones of the outputs of the layers that have not been released yet, together
+    with the ones of the input and the output of the layer."""
+
+
+@dataclass(frozen=True)
+class CircuitCost:
+    """The estimated cost of evaluating a circuit on a batch."""
+
+    batch_size: int
+    """The batch size."""
+    layers: list[LayerCost]
+    """The estimated costs of the layers, in address book order."""
+    flops: int
+    """The estimated number of floating point operations."""
+    param_bytes: int
+    """The number of bytes of the parameters of the circuit."""
+    output_bytes: int
+    """The number of bytes of the output of the circuit."""
+    peak_activation_bytes: int
+    """The maximum number of bytes of the activations being alive at the same time."""
+    peak_entry_id: int
+    """The index of the address book entry at which the activations reach their peak."""
+
+
+def estimate_cost(cc: TorchCircuit, batch_size: int) -> CircuitCost:
+    """Estimate the cost of evaluating a circuit on a batch, without evaluating it.
+    The cost is computed by walking the address book of the circuit, and by using the
+    configuration of each layer, i.e., its number of folds, arity, number of input and output
+    units, and the shapes of its parameters.
+
+    The peak activation bytes are computed by following the order the layers are evaluated
+    in, and by assuming the output of each layer is released after its last use, as done by
+    [evaluate][cirkit.backend.torch.graph.modules.TorchDiAcyclicGraph.evaluate]. The
+    activations saved by autograd for the backward pass, the temporary tensors allocated
+    within each layer and the outputs of the parameters are not counted.
+
+    Args:
+        cc: The circuit.
+        batch_size: The batch size.
+
+    Returns:
+        The estimated cost.
+
+    Raises:
+        ValueError: If the batch size is not positive.
+    """
+    if batch_size <= 0:
+        raise ValueError(f"The batch size must be positive, but found {batch_size}")
+    # The data type of the activations depends on the one the semiring casts the parameters to
+    try:
+        dtype = next(cc.parameters()).dtype
+    except StopIteration:
+        dtype = torch.get_default_dtype()
+    book = cc.address_book
+    num_entries = len(book)
+
+    layer_costs: list[LayerCost] = []
+    live_bytes = 0
+    peak_bytes, peak_entry_id = 0, 0
+    for i, entry in enumerate(book):
+        # The output of the previous layer is alive until its last use
+        if i > 0:
+            live_bytes += layer_costs[i - 1].output_bytes
+        layer = entry.module
+        if layer is None:
+            # The output of the circuit is gathered from the outputs of the output layers
+            (in_layer_ids_h,) = entry.in_module_ids
+            (in_fold_idx_h,) = entry.in_fold_idx
+            if not isinstance(in_fold_idx_h, Tensor):
+                # Recover the index tensor from the slices that would unsqueeze the inputs
+                num_in_folds = sum(layer_costs[mid].num_folds for mid in in_layer_ids_h)
+                in_fold_idx_h = torch.arange(num_in_folds)[in_fold_idx_h]
+            out_cost = layer_costs[in_layer_ids_h[0]]
+            output_bytes = in_fold_idx_h.shape[0] * out_cost.output_bytes // out_cost.num_folds
+            if live_bytes + output_bytes > peak_bytes:
+                peak_bytes, peak_entry_id = live_bytes + output_bytes, i
+            break
+        element_size = layer.semiring.cast(torch.zeros((), dtype=dtype)).element_size()
+        if isinstance(layer, TorchInputLayer) or not any(
+            isinstance(fi, Tensor) for fi in entry.in_fold_idx
+        ):
+            # The inputs of input layers are not activations, and the inputs of the layers
+            # that are retrieved without a fold index tensor are views of other outputs
+            input_bytes = 0
+        else:
+            input_bytes = (
+                layer.num_folds * layer.arity * batch_size * layer.num_input_units * element_size
+            )
+        output_bytes = layer.num_folds * batch_size * layer.num_output_units * element_size
+        step_bytes = live_bytes + input_bytes + output_bytes
+        if step_bytes > peak_bytes:
+            peak_bytes, peak_entry_id = step_bytes, i
+        layer_costs.append(
+            LayerCost(
+                entry_id=i,
+                layer=type(layer).__name__,
+                num_folds=layer.num_folds,
+                arity=layer.arity,
+                num_input_units=layer.num_input_units,
+                num_output_units=layer.num_output_units,
+                flops=estimate_flops(layer, batch_size),
+                param_bytes=sum(_num_bytes(p) for p in layer.parameters()),
+                input_bytes=input_bytes,
+                output_bytes=output_bytes,
+                live_bytes=step_bytes,
+            )
+        )
+        # Release the outputs that are not used anymore
+        live_bytes -= sum(layer_costs[mid].output_bytes for mid in book.expired_ids(i))
+    assert len(layer_costs) == num_entries - 1
+
+    return CircuitCost(
+        batch_size=batch_size,
+        layers=layer_costs,
+        flops=sum(c.flops for c in layer_costs),
+        param_bytes=sum(_num_bytes(p) for p in cc.parameters()),
+        output_bytes=output_bytes,
+        peak_activation_bytes=peak_bytes,
+        peak_entry_id=peak_entry_id,
+    )
+
+
+def estimate_flops(layer: TorchLayer, batch_size: int) -> int:
+    """Estimate the number of floating point operations needed to evaluate a layer, as if
+    it were evaluated in the sum-product semiring, and by counting a multiply-add as two
+    operations. The additional operations required by other semirings, e.g., the ones needed
+    to stabilize the computations in log-space, are not counted.
+
+    Args:
+        layer: The layer.
+        batch_size: The batch size.
+
+    Returns:
+        The estimated number of floating point operations.
+    """
+    num_folds, arity = layer.num_folds, layer.arity
+    num_input_units, num_output_units = layer.num_input_units, layer.num_output_units
+    size = num_folds * batch_size
+    match layer:
+        case TorchInputLayer():
+            return size * num_output_units * max(layer.num_variables, 1)
+        case TorchHadamardLayer():
+            return size * (arity - 1) * num_input_units
+        case TorchKroneckerLayer():
+            return size * (arity - 1) * num_output_units
+        case TorchSumLayer():
+            return 2 * size * num_output_units * arity * num_input_units
+        case TorchCPTLayer():
+            return size * (arity - 1) * num_input_units + 2 * size * num_output_units * (
+                num_input_units
+            )
+        case TorchTuckerLayer():
+            num_product_units = num_input_units**arity
+            return size * (arity - 1) * num_product_units + 2 * size * num_output_units * (
+                num_product_units
+            )
+        case TorchTensorDotLayer():
+            return 2 * size * num_output_units * layer.weight.shape[-1]
+    # Unknown layers are assumed to compute a dense linear map
+    return 2 * size * num_output_units * arity * num_input_units
+
+
+def _num_bytes(x: Tensor) -> int:
+    return x.numel() * x.element_size()
@@ -1,11 +1,16 @@
+import functools
+import itertools
 from abc import ABC, abstractmethod
 from collections import deque
 from collections.abc import Iterator, Mapping, Sequence
+from concurrent.futures import Executor, Future
 from dataclasses import dataclass
 from typing import Any, Protocol, TypeVar
 from typing_extensions import Generic, Self
 
+import torch
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 
 from cirkit.utils.algorithms import DiAcyclicGraph, subgraph
 
@@ -102,7 +107,7 @@ class AddressBookEntry(Generic[TorchModuleT]):
     gathering the input tensors, i.e., if the indexing operation would act as an unsqueezing
     operation that can be much more efficient."""
 
-    fold_index_info: FoldIndexInfo = None
+    fold_index_info: FoldIndexInfo | None = None
 
 
 class AddressBook(nn.Module, Generic[TorchModuleT], ABC):
@@ -114,7 +119,9 @@ class AddressBook(nn.Module, Generic[TorchModuleT], ABC):
     """
 
     def __init__(
-        self, entries: list[AddressBookEntry[TorchModuleT]], fold_idx_info: FoldIndexInfo = None
+        self,
+        entries: list[AddressBookEntry[TorchModuleT]],
+        fold_idx_info: FoldIndexInfo | None = None,
     ) -> None:
         """Initializes an address book.
 
@@ -151,6 +158,23 @@ class AddressBook(nn.Module, Generic[TorchModuleT], ABC):
         }
         self._entry_modules: list[TorchModuleT | None] = [e.module for e in self._entries]
         self._entry_in_module_ids: list[list[list[int]]] = [e.in_module_ids for e in self._entries]
+        # For each module output, we precompute the index of the last entry consuming it.
+        # Then, for each entry we store the ids of the module outputs that are not needed anymore
+        # after that entry has been evaluated. This allows to release the module outputs as soon
+        # as possible, such that the peak memory is the maximum live set rather than their sum.
+        self._last_use: list[int] = [-1] * (len(self._entries) - 1)
+        for i, in_module_ids in enumerate(self._entry_in_module_ids):
+            for mid in itertools.chain.from_iterable(in_module_ids):
+                self._last_use[mid] = i
+        self._entry_expired_ids: list[list[int]] = [[] for _ in self._entries]
+        for mid, i in enumerate(self._last_use):
+            if i >= 0:
+                self._entry_expired_ids[i].append(mid)
+        # For each entry we also store the unique ids of the modules it depends on
+        self._entry_dependencies: list[list[int]] = [
+            list(dict.fromkeys(itertools.chain.from_iterable(in_module_ids)))
+            for in_module_ids in self._entry_in_module_ids
+        ]
         # We register the book-keeping tensor indices as buffers.
         # By doing so they are automatically transferred to the device
         # This reduces CPU-device communications required to transfer these indices
@@ -196,6 +220,41 @@ class AddressBook(nn.Module, Generic[TorchModuleT], ABC):
                 [getattr(self, target) for target in in_fold_idx_targets],
             )
 
+    @property
+    def last_use(self) -> Sequence[int]:
+        """Retrieve the liveness information of the outputs of each module, i.e., for each module
+        index, the index of the last address book entry that receives its output as input.
+
+        Returns:
+            A sequence of address book entry indices, one for each module. The index is -1 if the
+                output of a module is never used by any other address book entry.
+        """
+        return self._last_use
+
+    def expired_ids(self, i: int) -> Sequence[int]:
+        """Retrieve the indices of the modules whose outputs are not used anymore
+        after the $i$-th address book entry has been evaluated.
+
+        Args:
+            i: The index of the address book entry.
+
+        Returns:
+            A sequence of module indices.
+        """
+        return self._entry_expired_ids[i]
+
+    def dependencies(self, i: int) -> Sequence[int]:
+        """Retrieve the indices of the modules whose outputs must have been computed
+        before looking up the inputs of the $i$-th address book entry.
+
+        Args:
+            i: The index of the address book entry.
+
+        Returns:
+            A sequence of module indices.
+        """
+        return self._entry_dependencies[i]
+
     @property
     def num_outputs(self) -> int:
         """The number of outputs of the whole computational graph represented
@@ -208,19 +267,50 @@ class AddressBook(nn.Module, Generic[TorchModuleT], ABC):
         """
         return self._num_outputs
 
+    @staticmethod
+    def retrieve_outputs(
+        module_outputs: list[Tensor | None], module_ids: Sequence[int]
+    ) -> list[Tensor]:
+        """Retrieve the outputs of some modules, which must not have been released yet.
+
+        Args:
+            module_outputs: A list of the outputs of each torch module, where the outputs that
+                are not needed anymore might have been replaced with None.
+            module_ids: The indices of the modules whose outputs are retrieved.
+
+        Returns:
+            The list of the outputs of the given modules.
+        """
+        outputs: list[Tensor] = []
+        for mid in module_ids:
+            y = module_outputs[mid]
+            assert y is not None, "The output of a module has been released before its last use"
+            outputs.append(y)
+        return outputs
+
     @abstractmethod
     def lookup(
-        self, module_outputs: list[Tensor], *, in_graph: Tensor | None = None
+        self,
+        module_outputs: list[Tensor | None],
+        *,
+        in_graph: Tensor | None = None,
+        start: int = 0,
     ) -> Iterator[tuple[TorchModuleT | None, tuple]]:
         """Retrieve an iterator that iteratively returns a torch module and the tensor inputs to it.
 
         Args:
             module_outputs: A list of the outputs of each torch module. This list is expected to
                 be iteratively expanded as we continue evaluating the modules of the torch
-                computational graph.
+                computational graph. The outputs that are not needed anymore might have been
+                replaced with None (see
+                [AddressBook.last_use][cirkit.backend.torch.graph.modules.AddressBook.last_use]).
             in_graph: An optional tensor input to the whole computational graph. This is used
                 as input to the torch modules that do not receive input from other torch
                 modules within the torch computationa graph.
+            start: The index of the first address book entry to look up. If it is not zero,
+                then the list of module outputs is expected to have this length, and to store
+                the outputs of the modules that are used by the following entries.
+                Defaults to 0.
 
         Returns:
             An iterator of tuples, where the first element is a torch module if we are
@@ -231,10 +321,15 @@ class AddressBook(nn.Module, Generic[TorchModuleT], ABC):
         """
 
 
-class ModuleEvalFunction(Protocol):  # pylint: disable=too-few-public-methods
+TorchModuleT_contra = TypeVar("TorchModuleT_contra", bound=AbstractTorchModule, contravariant=True)
+"""TypeVar: A contravariant torch module type, i.e., the type of the modules a function
+    over torch modules can be applied to."""
+
+
+class ModuleEvalFunction(Protocol[TorchModuleT_contra]):  # pylint: disable=too-few-public-methods
     """The protocol of a function that evaluates a module on some inputs."""
 
-    def __call__(self, module: TorchModuleT, *inputs: Tensor) -> Tensor:
+    def __call__(self, module: TorchModuleT_contra, /, *inputs: Tensor) -> Tensor:
         """Evaluate a module on some inputs.
 
         Args:
@@ -310,8 +405,35 @@ class TorchDiAcyclicGraph(nn.Module, DiAcyclicGraph[TorchModuleT], ABC):
         nodes, in_nodes = subgraph(roots, self.node_inputs)
         return self.__class__(nodes, in_nodes, outputs=roots)
 
+    def frontier_cuts(self) -> list[int]:
+        """Retrieve the indices of the address book entries at which a frontier of the
+        layerwise topological ordering begins, i.e., such that all the modules in the
+        preceding entries belong to previous frontiers. Each of these indices is a valid
+        checkpoint for the evaluation of the computational graph (see
+        [TorchDiAcyclicGraph.evaluate][cirkit.backend.torch.graph.modules.TorchDiAcyclicGraph.evaluate]).
+
+        Returns:
+            The sorted list of entry indices, excluding the first one.
+        """
+        levels = {
+            m: level
+            for level, frontier in enumerate(self.layerwise_topological_ordering())
+            for m in frontier
+        }
+        entry_levels = [levels[e.module] for e in self._address_book if e.module is not None]
+        # A frontier begins at the i-th entry if the levels of the entries before it are
+        # all lower than the levels of the entries after it
+        prefix_max = list(itertools.accumulate(entry_levels, max))
+        suffix_min = list(itertools.accumulate(reversed(entry_levels), min))[::-1]
+        return [i for i in range(1, len(entry_levels)) if prefix_max[i - 1] < suffix_min[i]]
+
     def evaluate(
-        self, x: Tensor | None = None, module_fn: ModuleEvalFunction | None = None
+        self,
+        x: Tensor | None = None,
+        module_fn: ModuleEvalFunction[TorchModuleT] | None = None,
+        *,
+        checkpoints: Sequence[int] | None = None,
+        executor: Executor | None = None,
     ) -> Tensor:
         """Evaluate the Torch graph by following the topological ordering,
             and by using the address book information to retrieve the inputs to each module.
@@ -321,6 +443,18 @@ class TorchDiAcyclicGraph(nn.Module, DiAcyclicGraph[TorchModuleT], ABC):
             module_fn: A functional over modules that overrides the forward method defined by a
                 module. It can be None. If it is None, then the ```__call__``` method defined by
                 the module itself is used.
+            checkpoints: The indices of the address book entries at which the evaluation is
+                split into segments (e.g., see
+                [TorchDiAcyclicGraph.frontier_cuts][cirkit.backend.torch.graph.modules.TorchDiAcyclicGraph.frontier_cuts]).
+                If it is not None and gradients are enabled, then only the module outputs
+                that are used across segments are stored for the backward pass, while the
+                other outputs are recomputed segment by segment during the backward pass.
+                It can be None, i.e., no activation checkpointing is performed.
+            executor: An executor (e.g., a thread pool) to which the evaluation of the modules
+                is submitted. If it is not None, then the modules that do not depend on each
+                other, e.g., the folded modules of the same frontier, are evaluated concurrently.
+                It is ignored if activation checkpointing is performed.
+                It can be None, i.e., the modules are evaluated one after the other.
 
         Returns:
             The output tensor of the Torch graph.
@@ -329,11 +463,19 @@ class TorchDiAcyclicGraph(nn.Module, DiAcyclicGraph[TorchModuleT], ABC):
         Raises:
             RuntimeError: If the address book is somehow not well-formed.
         """
+        if checkpoints and torch.is_grad_enabled():
+            return self._evaluate_checkpointed(x, module_fn=module_fn, checkpoints=checkpoints)
+        if executor is not None:
+            return self._evaluate_concurrent(x, module_fn=module_fn, executor=executor)
+
         # Evaluate the computational graph by following the topological ordering,
         # and by using the book address information to retrieve the inputs to each
         # (possibly folded) torch module.
-        module_outputs: list[Tensor] = []
-        for module, inputs in self._address_book.lookup(module_outputs, in_graph=x):
+        # The output of each module is released as soon as the last module consuming it
+        # has been evaluated. Note that this only drops our own reference to the tensor:
+        # if autograd saved it for the backward pass, then it will be kept alive by autograd.
+        module_outputs: list[Tensor | None] = []
+        for i, (module, inputs) in enumerate(self._address_book.lookup(module_outputs, in_graph=x)):
             if module is None:
                 (output,) = inputs
                 return output
@@ -341,12 +483,131 @@ class TorchDiAcyclicGraph(nn.Module, DiAcyclicGraph[TorchModuleT], ABC):
                 y = module(*inputs)
             else:
                 y = module_fn(module, *inputs)
+            del inputs
             module_outputs.append(y)
+            for mid in self._address_book.expired_ids(i):
+                module_outputs[mid] = None
+        raise RuntimeError("The address book is malformed")
+
+    def _evaluate_concurrent(
+        self,
+        x: Tensor | None,
+        *,
+        module_fn: ModuleEvalFunction[TorchModuleT] | None,
+        executor: Executor,
+    ) -> Tensor:
+        # The evaluation of each module is submitted to the executor as soon as its inputs
+        # have been looked up, i.e., after waiting only for the modules it depends on.
+        # Note that the gradient mode is thread-local, hence it is propagated to the workers
+        grad_enabled = torch.is_grad_enabled()
+
+        def _eval_module(module: TorchModuleT, *inputs: Tensor) -> Tensor:
+            with torch.set_grad_enabled(grad_enabled):
+                if module_fn is None:
+                    return module(*inputs)
+                return module_fn(module, *inputs)
+
+        module_outputs: list[Tensor | None] = []
+        futures: list[Future[Tensor] | None] = []
+        lookup = self._address_book.lookup(module_outputs, in_graph=x)
+        try:
+            for i in range(len(self._address_book)):
+                for mid in self._address_book.dependencies(i):
+                    future = futures[mid]
+                    if future is not None:
+                        module_outputs[mid] = future.result()
+                        futures[mid] = None
+                module, inputs = next(lookup)
+                if module is None:
+                    (output,) = inputs
+                    return output
+                futures.append(executor.submit(_eval_module, module, *inputs))
+                del inputs
+                module_outputs.append(None)
+                for mid in self._address_book.expired_ids(i):
+                    module_outputs[mid] = None
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+        raise RuntimeError("The address book is malformed")
+
+    def _evaluate_checkpointed(
+        self,
+        x: Tensor | None,
+        *,
+        module_fn: ModuleEvalFunction[TorchModuleT] | None,
+        checkpoints: Sequence[int],
+    ) -> Tensor:
+        # Split the address book entries into segments, each one being evaluated as
+        # a checkpointed function whose inputs are the module outputs coming from
+        # the previous segments, and whose outputs are the module outputs that are
+        # used by the following segments
+        num_entries = len(self._address_book)
+        last_use = self._address_book.last_use
+        bounds = sorted({i for i in checkpoints if 0 < i < num_entries})
+        module_outputs: list[Tensor | None] = []
+        for start, stop in zip([0, *bounds], [*bounds, num_entries]):
+            in_ids = [mid for mid in range(start) if last_use[mid] >= start]
+            out_ids = [
+                mid for mid in range(start, min(stop, num_entries - 1)) if last_use[mid] >= stop
+            ]
+            segment_fn = functools.partial(
+                self._evaluate_segment,
+                x,
+                module_fn=module_fn,
+                start=start,
+                stop=stop,
+                in_ids=in_ids,
+                out_ids=out_ids,
+            )
+            outputs = checkpoint(
+                segment_fn, *(module_outputs[mid] for mid in in_ids), use_reentrant=False
+            )
+            if stop == num_entries:
+                (output,) = outputs
+                return output
+            module_outputs.extend([None] * (stop - start))
+            for mid, y in zip(out_ids, outputs):
+                module_outputs[mid] = y
+            for mid in in_ids:
+                if last_use[mid] < stop:
+                    module_outputs[mid] = None
         raise RuntimeError("The address book is malformed")
 
+    def _evaluate_segment(
+        self,
+        x: Tensor | None,
+        *in_outputs: Tensor,
+        module_fn: ModuleEvalFunction[TorchModuleT] | None,
+        start: int,
+        stop: int,
+        in_ids: Sequence[int],
+        out_ids: Sequence[int],
+    ) -> tuple[Tensor, ...]:
+        module_outputs: list[Tensor | None] = [None] * start
+        for mid, y in zip(in_ids, in_outputs):
+            module_outputs[mid] = y
+        del in_outputs
+        lookup = self._address_book.lookup(module_outputs, in_graph=x, start=start)
+        for i, (module, inputs) in enumerate(lookup, start=start):
+            if module is None:
+                return inputs
+            if module_fn is None:
+                y = module(*inputs)
+            else:
+                y = module_fn(module, *inputs)
+            del inputs
+            module_outputs.append(y)
+            for mid in self._address_book.expired_ids(i):
+                module_outputs[mid] = None
+            if i + 1 == stop:
+                break
+        return tuple(self._address_book.retrieve_outputs(module_outputs, out_ids))
+
     def backtrack(
         self,
-        module_fn: ModuleEvalFunction,
+        module_fn: ModuleEvalFunction[TorchModuleT],
         x: Tensor | None = None,
     ) -> tuple[Tensor, Tensor]:
         """Evaluate the Torch graph by top-down traversal first,
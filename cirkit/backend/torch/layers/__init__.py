@@ -3,6 +3,7 @@ from .inner import TorchHadamardLayer as TorchHadamardLayer
 from .inner import TorchInnerLayer as TorchInnerLayer
 from .inner import TorchKroneckerLayer as TorchKroneckerLayer
 from .inner import TorchSumLayer as TorchSumLayer
+from .input import TorchBinomialLayer as TorchBinomialLayer
 from .input import TorchCategoricalLayer as TorchCategoricalLayer
 from .input import TorchConstantValueLayer as TorchLogPartitionLayer
 from .input import TorchExpFamilyLayer as TorchExpFamilyLayer
@@ -1,9 +1,11 @@
 from abc import ABC, abstractmethod
-from collections.abc import Mapping
+from collections.abc import Iterator, Mapping
+from contextlib import ExitStack, contextmanager
 from functools import cached_property
 from typing import Any
 
 import torch
+from torch import Tensor
 
 from cirkit.backend.torch.graph.modules import AbstractTorchModule
 from cirkit.backend.torch.parameters.parameter import TorchParameter
@@ -82,6 +84,33 @@ class TorchLayer(AbstractTorchModule, ABC):
         """
         return {}
 
+    @contextmanager
+    def select_folds(
+        self, fold_idx: Tensor, *, params: Mapping[str, Tensor] | None = None
+    ) -> Iterator[None]:
+        """A context manager within which the layer computes the selected folds only, i.e.,
+        both its input and output tensors have the selected folds only. Within the context,
+        the parameters of the layer return the selected folds of their outputs.
+
+        Args:
+            fold_idx: The indices of the selected folds, a tensor of shape $(F',)$.
+            params: The outputs of the parameters of the layer, indexed by their names.
+                If it is None, then the parameters are evaluated.
+
+        Yields:
+            Nothing.
+        """
+        num_folds = self._num_folds
+        with ExitStack() as stack:
+            for name, p in self.params.items():
+                y = p() if params is None else params[name]
+                stack.enter_context(p.memoized(y[fold_idx]))
+            self._num_folds = len(fold_idx)
+            try:
+                yield
+            finally:
+                self._num_folds = num_folds
+
     @cached_property
     def num_parameters(self) -> int:
         """Retrieve the number of scalar parameters. Note that if a parameter is complex-valued,
@@ -7,7 +7,23 @@ from torch import Tensor
 
 from cirkit.backend.torch.layers.base import TorchLayer
 from cirkit.backend.torch.parameters.parameter import TorchParameter
-from cirkit.backend.torch.semiring import Semiring, SumProductSemiring
+from cirkit.backend.torch.semiring import (
+    ComplexLSESumSemiring,
+    LSESumSemiring,
+    MaxSumSemiring,
+    Semiring,
+    SumProductSemiring,
+)
+from cirkit.backend.torch.utils import (
+    gumbel_max_sample,
+    log_matmul_exp,
+    safelog,
+    weighted_max,
+)
+
+# The fused log-matmul-exp is an autograd function having a custom backward, hence it must be
+# recorded as it is when the circuit layers are traced to generate code
+torch.fx.wrap("log_matmul_exp")
 
 
 class TorchInnerLayer(TorchLayer, ABC):
@@ -95,6 +111,32 @@ class TorchInnerLayer(TorchLayer, ABC):
         """
         raise TypeError(f"Max is not supported for layers of type {type(self)}")
 
+    def _weighted_max(self, x: Tensor, weight: Tensor) -> tuple[Tensor, Tensor]:
+        """Compute the maximum of the inputs weighted by the weights of sum units, without
+        materializing all the weighted inputs at once
+        (see [weighted_max][cirkit.backend.torch.utils.weighted_max]).
+
+        Args:
+            x: The inputs of the sum units, having shape $(F, B, I)$.
+            weight: The weights of the sum units, having shape $(F, B, K_o, I)$.
+
+        Returns:
+            tuple[Tensor, Tensor]: A tuple where the first tensor is the index of the input
+                maximizing each sum unit and the second tensor is that maximum value, both having
+                shape $(F, B, K_o)$.
+        """
+        if self.semiring in (LSESumSemiring, MaxSumSemiring):
+            # The weighted inputs are computed in log-space, which avoids underflows.
+            # Note that the weights are assumed to be non-negative in these semirings
+            idxs, log_val = weighted_max(x, safelog(weight), log_space=True)
+            return idxs, self.semiring.map_from(log_val, LSESumSemiring)
+        # intermediary weighted results are computed in the sum product semiring
+        # since very small products leading to underflow would not be selected
+        # by max anyway
+        x = SumProductSemiring.map_from(x, self.semiring)
+        idxs, val = weighted_max(x, weight)
+        return idxs, self.semiring.map_from(val, SumProductSemiring)
+
 
 class TorchHadamardLayer(TorchInnerLayer):
     """The Hadamard product layer, which computes an element-wise (or Hadamard) product of
@@ -299,10 +341,6 @@ class TorchSumLayer(TorchInnerLayer):
             )
         self.weight = weight
 
-        # prepare max and argmaxing functions across folds and batches
-        self._max_fn = torch.vmap(torch.vmap(lambda x: torch.amax(x, dim=-1)))
-        self._argmax_fn = torch.vmap(torch.vmap(lambda x: torch.argmax(x, dim=-1)))
-
     def _valid_weight_shape(self, w: TorchParameter) -> bool:
         if w.num_folds != self.num_folds:
             return False
@@ -330,6 +368,15 @@ class TorchSumLayer(TorchInnerLayer):
         x = x.permute(0, 2, 1, 3).flatten(start_dim=2)
 
         weight = self.weight()
+        if self.semiring is MaxSumSemiring:
+            # Use a fused max-reduction rather than the max-sum einsum, as the latter would
+            # materialize all the weighted inputs
+            _, y = self._weighted_max(x, weight)
+            return y  # shape (F, B, K_o).
+        if self.semiring in (LSESumSemiring, ComplexLSESumSemiring):
+            # Use a fused log-matmul-exp rather than the log-sum-exp einsum, as the latter would
+            # materialize and save exponentiated copies of the inputs
+            return log_matmul_exp(x, self.semiring.cast(weight))  # shape (F, B, K_o).
         return self.semiring.einsum(
             "fbi,fboi->fbo", inputs=(x,), operands=(weight,), dim=-1, keepdim=True
         )  # shape (F, B, K_o).
@@ -341,52 +388,24 @@ class TorchSumLayer(TorchInnerLayer):
         to recover the index of the sampled input element as $i // I$ and
         the unit of that element as $i mod I$ where $I$ is the number of inputs of this
         layer (i.e. the number of units of each element that is input to this layer).
+        The inputs are sampled proportionally to their weighted values with the Gumbel-max
+        trick in log-space (see [gumbel_max_sample][cirkit.backend.torch.utils.gumbel_max_sample]),
+        hence the weights are assumed to be non-negative but they need not be normalized.
 
         Args:
             x (Tensor): The input to the layer.
 
         Returns:
             tuple[Tensor, Tensor]: A tuple where the first tensor is the raveled index
-                of the sampled input to the layer and the second value is the input weighted
-                by that element value.
+                of the sampled input to the layer and the second value is the output of the layer.
         """
-        # weight: (F, B, K_o, H * Ki)
-        weight = self.weight()
-        negative = torch.any(weight < 0.0)
-        if negative:
-            raise TypeError("Sampling in sum layers only works with positive weights.")
-
-        normalized = torch.allclose(torch.sum(weight, dim=-1), torch.ones(1, device=weight.device))
-        if not normalized:
-            # normalize weight as a probability distribution
-            eps = torch.finfo(weight.dtype).eps
-            weight = (weight + eps) / (weight + eps).sum(dim=-1, keepdim=True)
-        
-        # intermediary weighted results are computed in the sum product semiring
-        # since very small products leading to underflow would not be selected
-        # by max anyway
-        sp_x = SumProductSemiring.map_from(x, self.semiring)
-        # sp_x: (F, H, B, Ki) -> (F, B, H * Ki)
-        sp_x = sp_x.permute(0, 2, 1, 3).flatten(start_dim=2)
-
-        # FIXME: Since sampling is not currently supported for batched
-        # parameter, the same weight matrix will be used throughout all
-        # the samples
-        # we can exploit this to make the code less memory intensive
-        weight = weight.squeeze(1) # (F, K_o, H * Ki)
-
-        # apply the weight of the sum unit to each input
-        # without reducing as a sum
-        weighted_x = torch.einsum("fbi,foi->foi", sp_x, weight)
-
-        # make sure the probs provided are not all zeros
-        dist = torch.distributions.Categorical(probs=weighted_x + torch.finfo(weighted_x.dtype).eps)
-        idxs = dist.sample((sp_x.size(1),)).permute(1, 0, 2) # (B, F, K_i) -> (F, B, K_i)
-                
-        # compute the regular layer output by reducing along the last dimension
-        val = self(x)
-
-        return idxs, val
+        # log_x: (F, H, B, Ki) -> (F, B, H * Ki)
+        log_x = LSESumSemiring.map_from(x, self.semiring)
+        log_x = log_x.permute(0, 2, 1, 3).flatten(start_dim=2)
+        # log_weight: (F, B, K_o, H * Ki)
+        log_weight = safelog(self.weight())
+        idxs, _ = gumbel_max_sample(log_x, log_weight)
+        return idxs, self(x)
 
     def max(self, x: Tensor) -> tuple[Tensor, Tensor]:
         r"""The maximum of a sum layer is the computed by weighting the input
@@ -408,17 +427,6 @@ class TorchSumLayer(TorchInnerLayer):
         """
         # x: (F, H, B, Ki) -> (F, B, H * Ki)
         x = x.permute(0, 2, 1, 3).flatten(start_dim=2)
-
         # weight: (F, B, K_o, H * Ki)
         weight = self.weight()
-
-        # intermediary weighted results are computed in the sum product semiring
-        # since very small products leading to underflow would not be selected
-        # by max anyway
-        x = SumProductSemiring.map_from(x, self.semiring)
-        # weighted_x: (F, B, H * Ki, Ko)
-        weighted_x = self.semiring.map_from(
-            torch.einsum("fbi,fboi->fboi", x, weight), SumProductSemiring
-        )
-
-        return self._argmax_fn(weighted_x), self._max_fn(weighted_x)
+        return self._weighted_max(x, weight)
@@ -6,7 +6,17 @@ from torch import Tensor
 
 from cirkit.backend.torch.layers.inner import TorchInnerLayer
 from cirkit.backend.torch.parameters.parameter import TorchParameter
-from cirkit.backend.torch.semiring import Semiring, SumProductSemiring
+from cirkit.backend.torch.semiring import (
+    ComplexLSESumSemiring,
+    LSESumSemiring,
+    MaxSumSemiring,
+    Semiring,
+)
+from cirkit.backend.torch.utils import gumbel_max_sample, log_matmul_exp, safelog
+
+# The fused log-matmul-exp is an autograd function having a custom backward, hence it must be
+# recorded as it is when the circuit layers are traced to generate code
+torch.fx.wrap("log_matmul_exp")
 
 
 class TorchTuckerLayer(TorchInnerLayer):
@@ -83,6 +93,12 @@ class TorchTuckerLayer(TorchInnerLayer):
 
     def forward(self, x: Tensor) -> Tensor:
         # x: (F, H, B, Ki)
+        if self.semiring in (LSESumSemiring, ComplexLSESumSemiring):
+            # Use a fused log-matmul-exp over the Kronecker product of the inputs, which is
+            # computed in log-space chunk by chunk, rather than the log-sum-exp einsum
+            # weight: (F, B, Ko, Ki ** arity)
+            weight = self.semiring.cast(self.weight())
+            return log_matmul_exp(x.unbind(dim=1), weight)  # shape (F, B, Ko).
         # weight: (F, Ko, Ki ** arity) -> (F, Ko, Ki, ..., Ki)
         weight = self.weight().view(
             -1, self.num_output_units, *(self.num_input_units for _ in range(self.arity))
@@ -140,10 +156,6 @@ class TorchCPTLayer(TorchInnerLayer):
             )
         self.weight = weight
 
-        # prepare max and argmaxing functions across folds and batches
-        self._max_fn = torch.vmap(torch.vmap(lambda x: torch.amax(x, dim=-1)))
-        self._argmax_fn = torch.vmap(torch.vmap(lambda x: torch.argmax(x, dim=-1)))
-
     def _valid_weight_shape(self, w: TorchParameter) -> bool:
         if w.num_folds != self.num_folds:
             return False
@@ -170,6 +182,15 @@ class TorchCPTLayer(TorchInnerLayer):
         x = self.semiring.prod(x, dim=1, keepdim=False)
         # weight: (F, B, Ko, Ki)
         weight = self.weight()
+        if self.semiring is MaxSumSemiring:
+            # Use a fused max-reduction rather than the max-sum einsum, as the latter would
+            # materialize all the weighted inputs
+            _, y = self._weighted_max(x, weight)
+            return y
+        if self.semiring in (LSESumSemiring, ComplexLSESumSemiring):
+            # Use a fused log-matmul-exp rather than the log-sum-exp einsum, as the latter would
+            # materialize and save exponentiated copies of the inputs
+            return log_matmul_exp(x, self.semiring.cast(weight))
         return self.semiring.einsum(
             "fbi,fboi->fbo", inputs=(x,), operands=(weight,), dim=-1, keepdim=True
         )
@@ -177,70 +198,33 @@ class TorchCPTLayer(TorchInnerLayer):
     def max(self, x: Tensor) -> tuple[Tensor, Tensor]:
         # x: (F, B, Ki)
         x = self.semiring.prod(x, dim=1, keepdim=False)
-
         # weight: (F, B, K_o, Ki)
         weight = self.weight()
-
-        # intermediary weighted results are computed in the sum product semiring
-        # since very small products leading to underflow would not be selected
-        # by max anyway
-        x = SumProductSemiring.map_from(x, self.semiring)
-        # weighted_x: (F, B, H * Ki, Ko)
-        weighted_x = self.semiring.map_from(
-            torch.einsum("fbi,fboi->fboi", x, weight), SumProductSemiring
-        )
-
-        return self._argmax_fn(weighted_x), self._max_fn(weighted_x)
+        return self._weighted_max(x, weight)
 
     def sample(self, x: Tensor) -> tuple[Tensor, Tensor]:
         r"""Sample from a CP-T sum layer based on the weight paramerters.
 
-        The sampled index is given in raveled form. Given the index $i$ it is possible
-        to recover the index of the sampled input element as $i // I$ and
-        the unit of that element as $i mod I$ where $I$ is the number of inputs of this
-        layer (i.e. the number of units of each element that is input to this layer).
+        The sampled index is the index of the input unit, which is shared by all the inputs
+        being multiplied. The input units are sampled proportionally to their weighted values
+        with the Gumbel-max trick in log-space
+        (see [gumbel_max_sample][cirkit.backend.torch.utils.gumbel_max_sample]),
+        hence the weights are assumed to be non-negative but they need not be normalized.
 
         Args:
             x (Tensor): The input to the layer.
 
         Returns:
-            tuple[Tensor, Tensor]: A tuple where the first tensor is the raveled index
-                of the sampled input to the layer and the second value is the input weighted
+            tuple[Tensor, Tensor]: A tuple where the first tensor is the index
+                of the sampled input unit and the second value is the input weighted
                 by that element value.
         """
-        # weight: (F, B, K_o, H * Ki)
-        weight = self.weight()
-        negative = torch.any(weight < 0.0)
-        if negative:
-            raise TypeError("Sampling in sum layers only works with positive weights.")
-
-        normalized = torch.allclose(torch.sum(weight, dim=-1), torch.ones(1, device=weight.device))
-        if not normalized:
-            # normalize weight as a probability distribution
-            eps = torch.finfo(weight.dtype).eps
-            weight = (weight + eps) / (weight + eps).sum(dim=-1, keepdim=True)
-
-        # x: (F, B, Ki)
-        x = self.semiring.prod(x, dim=1, keepdim=False)
-
-        # weight: (F, B, K_o, Ki)
-        weight = self.weight()
-
-        # intermediary weighted results are computed in the sum product semiring
-        x = SumProductSemiring.map_from(x, self.semiring)
-        # weighted_x: (F, B, H * Ki, Ko)
-        weighted_x = self.semiring.map_from(
-            torch.einsum("fbi,fboi->fboi", x, weight), SumProductSemiring
-        )
-
-        # sample indexes based on weight
-        dist = torch.distributions.Categorical(probs=weight)
-        idxs = dist.sample((x.size(1),)).squeeze(-2).permute(1, 0, 2)
-        # gather the weighted value
-        # TODO: find a better way rather than squeezing and unsqueezing
-        val = torch.gather(weighted_x, index=idxs.unsqueeze(-1), dim=-1).squeeze(-1)
-
-        return idxs, val
+        # log_x: (F, H, B, Ki) -> (F, B, Ki)
+        log_x = torch.sum(LSESumSemiring.map_from(x, self.semiring), dim=1)
+        # log_weight: (F, B, K_o, Ki)
+        log_weight = safelog(self.weight())
+        idxs, log_val = gumbel_max_sample(log_x, log_weight)
+        return idxs, self.semiring.map_from(log_val, LSESumSemiring)
 
 
 class TorchTensorDotLayer(TorchInnerLayer):
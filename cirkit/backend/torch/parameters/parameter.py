@@ -1,5 +1,6 @@
 from collections.abc import Iterator, Mapping, Sequence
-from itertools import chain
+from contextlib import contextmanager
+from itertools import chain, islice
 from typing import Union
 
 import torch
@@ -35,14 +36,18 @@ class ParameterAddressBook(AddressBook[TorchParameterNode]):
     """
 
     def lookup(
-        self, module_outputs: list[Tensor], *, in_graph: Tensor | None = None
+        self,
+        module_outputs: list[Tensor | None],
+        *,
+        in_graph: Tensor | None = None,
+        start: int = 0,
     ) -> Iterator[tuple[TorchParameterNode | None, tuple]]:
         def _select_index(mids: list[int], idx: Tensor | tuple[slice | None, ...]) -> Tensor:
             # A useful function combining the modules outputs, and then possibly applying an index
             if len(mids) == 1:
-                t = module_outputs[mids[0]]
+                (t,) = self.retrieve_outputs(module_outputs, mids)
             else:
-                module_inputs = [module_outputs[mid] for mid in mids]
+                module_inputs = self.retrieve_outputs(module_outputs, mids)
 
                 # check that we have coherent batch sizes and the missing ones
                 # are broadcastable
@@ -71,7 +76,7 @@ class ParameterAddressBook(AddressBook[TorchParameterNode]):
             return t[idx]
 
         # Loop through the entries and yield inputs
-        for entry in self:
+        for entry in islice(self, start, None):
             node = entry.module
             in_node_ids = entry.in_module_ids
             in_fold_idx = entry.in_fold_idx
@@ -154,6 +159,7 @@ class TorchParameter(TorchDiAcyclicGraph[TorchParameterNode]):
                 It can be None if the Torch graph is not folded.
         """
         super().__init__(modules, in_modules, outputs, fold_idx_info=fold_idx_info)
+        self._cached_output: Tensor | None = None
 
     @property
     def device(self) -> torch.device:
@@ -203,17 +209,59 @@ class TorchParameter(TorchDiAcyclicGraph[TorchParameterNode]):
         for p in self.nodes:
             p.reset_parameters()
 
+    @property
+    def is_memoized(self) -> bool:
+        """Check whether the output of the parameter computational graph is memoized.
+
+        Returns:
+            True if the output is memoized, and False otherwise.
+        """
+        return self._cached_output is not None
+
+    def memoize(self) -> None:
+        """Memoize the output of the parameter computational graph. Upon invocation, the
+        parameter will return the memoized output until the cache is reset
+        (see [TorchParameter.reset_cache]
+        [cirkit.backend.torch.parameters.parameter.TorchParameter.reset_cache]).
+        """
+        self._cached_output = self.evaluate()
+
+    def reset_cache(self) -> None:
+        """Resets the memoized output, if any."""
+        self._cached_output = None
+
+    @contextmanager
+    def memoized(self, output: Tensor) -> Iterator[None]:
+        """A context manager within which the parameter returns the given output, instead of
+        evaluating the parameter computational graph. The memoized output, if any, is
+        restored when exiting the context.
+
+        Args:
+            output: The output tensor to return.
+
+        Yields:
+            Nothing.
+        """
+        cached_output = self._cached_output
+        self._cached_output = output
+        try:
+            yield
+        finally:
+            self._cached_output = cached_output
+
     def __call__(self) -> Tensor:
         return super().__call__()
 
     def forward(self) -> Tensor:
-        r"""Evaluate the parameter computational graph.
+        r"""Evaluate the parameter computational graph, or retrieve its memoized output.
 
         Returns:
             Tensor: The output parameter tensor, having shape (F, B, K_1,\ldots K_n),
                 where F is the number of folds, B the batch size and (K_1,\ldots,K_n)
                 is the shape of each parameter tensor slice.
         """
+        if self._cached_output is not None:
+            return self._cached_output
         return self.evaluate()
 
     def _build_unfold_index_info(self) -> FoldIndexInfo[TorchParameterNode]:
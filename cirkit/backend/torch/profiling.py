@@ -0,0 +1,453 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Literal
+
+import torch
+from torch import Tensor, nn
+from torch.utils.hooks import RemovableHandle
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.cost import estimate_flops
+from cirkit.backend.torch.layers import TorchInnerLayer, TorchLayer
+
+
+@dataclass(frozen=True)
+class LayerEvent:
+    """An evaluation of a circuit layer recorded by a profile, either in the forward or in the
+    backward pass."""
+
+    entry_id: int
+    """The index of the entry of the address book the layer belongs to."""
+    layer: str
+    """The name of the layer type."""
+    phase: Literal["forward", "backward"]
+    """The pass the layer has been evaluated in."""
+    thread_id: int
+    """The identifier of the thread that evaluated the layer."""
+    start_ns: int
+    """The time the evaluation started at, in nanoseconds since the profile started."""
+    duration_ns: int
+    """The wall time of the evaluation, in nanoseconds."""
+    allocated_bytes: int
+    """The number of bytes allocated by the evaluation. On CUDA devices, this is the
+    difference of the allocated memory before and after the evaluation. Otherwise, it is the
+    number of bytes of the tensors being computed, i.e., the output in the forward pass, and
+    the gradients w.r.t. the inputs and the parameters in the backward pass."""
+    output_shape: tuple[int, ...]
+    """The shape of the output of the layer."""
+    num_folds: int
+    """The number of folds of the layer."""
+    flops: int
+    """The estimated number of floating point operations."""
+
+
+@dataclass(frozen=True)
+class LayerStats:
+    """The statistics of a circuit layer, aggregated over the events recorded by a profile."""
+
+    entry_id: int
+    """The index of the entry of the address book the layer belongs to."""
+    layer: str
+    """The name of the layer type."""
+    num_folds: int
+    """The number of folds of the layer."""
+    output_shape: tuple[int, ...]
+    """The shape of the output of the layer, in the last forward pass."""
+    num_calls: int
+    """The number of forward evaluations of the layer."""
+    forward_ns: int
+    """The total wall time of the forward evaluations, in nanoseconds."""
+    backward_ns: int
+    """The total wall time of the backward evaluations, in nanoseconds."""
+    allocated_bytes: int
+    """The total number of bytes allocated by the evaluations."""
+    flops: int
+    """The total estimated number of floating point operations."""
+
+    @property
+    def total_ns(self) -> int:
+        """Retrieve the total wall time of the forward and backward evaluations.
+
+        Returns:
+            The total wall time, in nanoseconds.
+        """
+        return self.forward_ns + self.backward_ns
+
+
+_SORT_KEYS: dict[str, Callable[[LayerStats], Any]] = {
+    "entry": lambda s: -s.entry_id,
+    "layer": lambda s: s.layer,
+    "num_folds": lambda s: s.num_folds,
+    "num_calls": lambda s: s.num_calls,
+    "forward_time": lambda s: s.forward_ns,
+    "backward_time": lambda s: s.backward_ns,
+    "total_time": lambda s: s.total_ns,
+    "allocated_bytes": lambda s: s.allocated_bytes,
+    "flops": lambda s: s.flops,
+}
+
+
+class CircuitProfile:
+    """The profile of the evaluations of the layers of a circuit. The events are recorded
+    only within the context of [profile][cirkit.backend.torch.profiling.profile]."""
+
+    def __init__(self, cc: TorchCircuit) -> None:
+        """Initialize a profile.
+
+        Args:
+            cc: The profiled circuit.
+        """
+        self._circuit = cc
+        self._entry_ids: dict[TorchLayer, int] = {
+            entry.module: i for i, entry in enumerate(cc.address_book) if entry.module is not None
+        }
+        self._events: list[LayerEvent] = []
+        self._origin_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._handles: list[RemovableHandle] = []
+        # The state of the layers being evaluated in the forward and backward passes
+        self._forward_state: dict[TorchLayer, tuple[int, int]] = {}
+        self._backward_state: dict[TorchLayer, list[int]] = {}
+        self._last_output_shape: dict[TorchLayer, tuple[int, ...]] = {}
+
+    @property
+    def circuit(self) -> TorchCircuit:
+        """Retrieve the profiled circuit.
+
+        Returns:
+            The profiled circuit.
+        """
+        return self._circuit
+
+    @property
+    def events(self) -> Sequence[LayerEvent]:
+        """Retrieve the recorded events, in the order they terminated.
+
+        Returns:
+            The sequence of recorded events.
+        """
+        return self._events
+
+    def reset(self) -> None:
+        """Remove all the recorded events."""
+        with self._lock:
+            self._events.clear()
+
+    def stats(self) -> list[LayerStats]:
+        """Aggregate the recorded events by circuit layer.
+
+        Returns:
+            The statistics of the layers that have been evaluated, in address book order.
+        """
+        events_by_entry: dict[int, list[LayerEvent]] = {}
+        for e in self._events:
+            events_by_entry.setdefault(e.entry_id, []).append(e)
+        stats: list[LayerStats] = []
+        for entry_id in sorted(events_by_entry):
+            events = events_by_entry[entry_id]
+            forward_events = [e for e in events if e.phase == "forward"]
+            stats.append(
+                LayerStats(
+                    entry_id=entry_id,
+                    layer=events[0].layer,
+                    num_folds=events[0].num_folds,
+                    output_shape=events[-1].output_shape,
+                    num_calls=len(forward_events),
+                    forward_ns=sum(e.duration_ns for e in forward_events),
+                    backward_ns=sum(e.duration_ns for e in events if e.phase == "backward"),
+                    allocated_bytes=sum(e.allocated_bytes for e in events),
+                    flops=sum(e.flops for e in events),
+                )
+            )
+        return stats
+
+    def table(self, sort_by: str = "total_time", *, limit: int | None = None) -> str:
+        """Format the statistics of the layers as a table.
+
+        Args:
+            sort_by: The column to sort the rows by, in decreasing order. It can be either
+                'entry', 'layer', 'num_folds', 'num_calls', 'forward_time', 'backward_time',
+                'total_time', 'allocated_bytes' or 'flops'. If it is 'entry', then the rows are
+                sorted in address book order.
+            limit: The maximum number of rows. If it is None, then all the layers are shown.
+
+        Returns:
+            The formatted table.
+
+        Raises:
+            ValueError: If the column to sort the rows by is not known.
+        """
+        if sort_by not in _SORT_KEYS:
+            raise ValueError(
+                f"Unknown column '{sort_by}' to sort by, "
+                f"expected one of {', '.join(map(repr, _SORT_KEYS))}"
+            )
+        stats = sorted(self.stats(), key=_SORT_KEYS[sort_by], reverse=True)
+        if limit is not None:
+            stats = stats[:limit]
+        header = (
+            "entry",
+            "layer",
+            "folds",
+            "output shape",
+            "calls",
+            "forward (ms)",
+            "backward (ms)",
+            "total (ms)",
+            "allocated (MiB)",
+            "GFLOPs",
+        )
+        rows = [
+            (
+                str(s.entry_id),
+                s.layer,
+                str(s.num_folds),
+                str(s.output_shape),
+                str(s.num_calls),
+                f"{s.forward_ns * 1e-6:.3f}",
+                f"{s.backward_ns * 1e-6:.3f}",
+                f"{s.total_ns * 1e-6:.3f}",
+                f"{s.allocated_bytes / 2**20:.3f}",
+                f"{s.flops * 1e-9:.4f}",
+            )
+            for s in stats
+        ]
+        widths = [max(len(r[j]) for r in (header, *rows)) for j in range(len(header))]
+        lines = ["  ".join(c.rjust(w) for c, w in zip(r, widths)) for r in (header, *rows)]
+        lines.insert(1, "  ".join("-" * w for w in widths))
+        return "\n".join(lines)
+
+    def print_table(self, sort_by: str = "total_time", *, limit: int | None = None) -> None:
+        """Print the statistics of the layers as a table.
+        See [table][cirkit.backend.torch.profiling.CircuitProfile.table] for details.
+
+        Args:
+            sort_by: The column to sort the rows by, in decreasing order.
+            limit: The maximum number of rows. If it is None, then all the layers are shown.
+        """
+        print(self.table(sort_by, limit=limit))
+
+    def chrome_trace(self) -> dict[str, Any]:
+        """Retrieve the recorded events in the Chrome trace event format, which can be
+        visualized with chrome://tracing or Perfetto.
+
+        Returns:
+            The trace, as a JSON-serializable dictionary.
+        """
+        pid = os.getpid()
+        trace_events = [
+            {
+                "name": f"{e.layer} [{e.entry_id}]",
+                "cat": e.phase,
+                "ph": "X",
+                "ts": e.start_ns * 1e-3,
+                "dur": e.duration_ns * 1e-3,
+                "pid": pid,
+                "tid": e.thread_id,
+                "args": {
+                    "entry_id": e.entry_id,
+                    "allocated_bytes": e.allocated_bytes,
+                    "output_shape": list(e.output_shape),
+                    "num_folds": e.num_folds,
+                    "flops": e.flops,
+                },
+            }
+            for e in self._events
+        ]
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path: str | os.PathLike) -> None:
+        """Export the recorded events to a file in the Chrome trace event format.
+
+        Args:
+            path: The path of the JSON file.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def _attach(self) -> None:
+        for layer in self._entry_ids:
+            self._handles.append(layer.register_forward_pre_hook(self._forward_pre_hook))
+            self._handles.append(layer.register_forward_hook(self._forward_hook))
+            self._handles.append(layer.register_full_backward_pre_hook(self._backward_pre_hook))
+            # The gradients w.r.t. the inputs of input layers are never computed
+            if isinstance(layer, TorchInnerLayer):
+                self._handles.append(layer.register_full_backward_hook(self._backward_hook))
+            params = [p for p in layer.parameters() if p.requires_grad]
+            if params:
+                self._handles.append(
+                    torch.autograd.graph.register_multi_grad_hook(
+                        params, lambda grads, layer=layer: self._params_grad_hook(layer, grads)
+                    )
+                )
+
+    def _detach(self) -> None:
+        for h in self._handles:
+            h.remove()
+        self._handles.clear()
+        self._forward_state.clear()
+        self._backward_state.clear()
+
+    def _now(self) -> int:
+        if self._circuit.device.type == "cuda":
+            torch.cuda.synchronize(self._circuit.device)
+        return time.perf_counter_ns() - self._origin_ns
+
+    def _allocated_memory(self) -> int:
+        if self._circuit.device.type == "cuda":
+            return torch.cuda.memory_allocated(self._circuit.device)
+        return 0
+
+    def _forward_pre_hook(self, layer: TorchLayer, _args: tuple[Any, ...]) -> None:
+        self._forward_state[layer] = (self._now(), self._allocated_memory())
+
+    def _forward_hook(self, layer: TorchLayer, _args: tuple[Any, ...], output: Tensor) -> None:
+        end_ns = self._now()
+        start_ns, allocated_memory = self._forward_state.pop(layer)
+        if self._circuit.device.type == "cuda":
+            allocated_bytes = self._allocated_memory() - allocated_memory
+        else:
+            allocated_bytes = _num_bytes(output)
+        output_shape = tuple(output.shape)
+        self._last_output_shape[layer] = output_shape
+        # The output of a layer has shape (F, B, K)
+        self._record(
+            layer,
+            "forward",
+            start_ns,
+            end_ns,
+            allocated_bytes,
+            output_shape,
+            estimate_flops(layer, output_shape[1]),
+        )
+
+    def _backward_pre_hook(self, layer: nn.Module, _grad_output: tuple[Tensor | None, ...]) -> None:
+        assert isinstance(layer, TorchLayer)
+        # The backward pass of a layer terminates as soon as the gradients w.r.t. both
+        # its inputs and its parameters have been computed
+        num_pending = int(isinstance(layer, TorchInnerLayer)) + int(
+            any(p.requires_grad for p in layer.parameters())
+        )
+        if not num_pending:
+            return
+        self._backward_state[layer] = [
+            self._now(),
+            self._allocated_memory(),
+            num_pending,
+            0,
+        ]
+
+    def _backward_hook(
+        self,
+        layer: nn.Module,
+        grad_input: tuple[Tensor | None, ...],
+        _grad_output: tuple[Tensor | None, ...],
+    ) -> None:
+        assert isinstance(layer, TorchLayer)
+        self._backward_done(layer, grad_input)
+
+    def _params_grad_hook(self, layer: TorchLayer, grads: Sequence[Tensor | None]) -> None:
+        self._backward_done(layer, grads)
+
+    def _backward_done(self, layer: TorchLayer, grads: Sequence[Tensor | None]) -> None:
+        with self._lock:
+            state = self._backward_state.get(layer)
+            if state is None:
+                return
+            state[2] -= 1
+            state[3] += sum(_num_bytes(g) for g in grads if g is not None)
+            if state[2]:
+                return
+            del self._backward_state[layer]
+        end_ns = self._now()
+        start_ns, allocated_memory, _, grad_bytes = state
+        if self._circuit.device.type == "cuda":
+            allocated_bytes = self._allocated_memory() - allocated_memory
+        else:
+            allocated_bytes = grad_bytes
+        output_shape = self._last_output_shape[layer]
+        # The backward pass is estimated to require twice the operations of the forward pass
+        self._record(
+            layer,
+            "backward",
+            start_ns,
+            end_ns,
+            allocated_bytes,
+            output_shape,
+            2 * estimate_flops(layer, output_shape[1]),
+        )
+
+    def _record(
+        self,
+        layer: TorchLayer,
+        phase: Literal["forward", "backward"],
+        start_ns: int,
+        end_ns: int,
+        allocated_bytes: int,
+        output_shape: tuple[int, ...],
+        flops: int,
+    ) -> None:
+        event = LayerEvent(
+            entry_id=self._entry_ids[layer],
+            layer=type(layer).__name__,
+            phase=phase,
+            thread_id=threading.get_ident(),
+            start_ns=start_ns,
+            duration_ns=end_ns - start_ns,
+            allocated_bytes=allocated_bytes,
+            output_shape=output_shape,
+            num_folds=layer.num_folds,
+            flops=flops,
+        )
+        with self._lock:
+            self._events.append(event)
+
+
+@contextmanager
+def profile(cc: TorchCircuit) -> Iterator[CircuitProfile]:
+    """A context manager profiling the evaluations of the layers of a circuit. For each entry
+    of the address book of the circuit, it records the wall time, the allocated bytes,
+    the output shape, the number of folds and the estimated number of floating point
+    operations, in both the forward and the backward passes. Within the context, the circuit
+    is evaluated by looking up its address book, even if code has been generated for it.
+
+    The wall time of the layers includes the evaluation of their parameters. On CUDA devices,
+    the device is synchronized before and after evaluating each layer, such that the wall
+    time is attributed to the right layer. Note that in the backward pass the wall time is
+    measured from when the gradients w.r.t. the output of a layer are available, until the
+    gradients w.r.t. its inputs and parameters have been computed. Since these gradients
+    might be computed while other layers are being differentiated, the backward wall times
+    are an estimate.
+
+    Example:
+        ```python
+        with profile(cc) as prof:
+            cc(x).sum().backward()
+        prof.print_table(sort_by="total_time", limit=10)
+        prof.export_chrome_trace("trace.json")
+        ```
+
+    Args:
+        cc: The circuit to profile.
+
+    Yields:
+        The profile, which keeps the recorded events after the context exits.
+    """
+    prof = CircuitProfile(cc)
+    generated_forward, generated_code = cc.generated_forward, cc.generated_code
+    cc.set_generated_forward(None)
+    prof._attach()  # pylint: disable=protected-access
+    try:
+        yield prof
+    finally:
+        prof._detach()  # pylint: disable=protected-access
+        cc.set_generated_forward(generated_forward, generated_code)
+
+
+def _num_bytes(x: Tensor) -> int:
+    return x.numel() * x.element_size()
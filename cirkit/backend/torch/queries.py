@@ -1,19 +1,32 @@
 import functools
+import itertools
 from abc import ABC
-from collections.abc import Sequence
+from collections.abc import Callable, Iterator, Sequence
 from typing import Any, Mapping
 
 import torch
 from torch import Tensor
 
-from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.circuits import (
+    SparseEvidence,
+    TorchCircuit,
+    coalesce_evidence,
+    evaluate_sparse_evidence,
+    slice_batch,
+)
 from cirkit.backend.torch.layers import (
+    TorchBinomialLayer,
+    TorchCategoricalLayer,
+    TorchCPTLayer,
     TorchHadamardLayer,
     TorchInnerLayer,
     TorchInputLayer,
+    TorchKroneckerLayer,
     TorchLayer,
     TorchSumLayer,
 )
+from cirkit.backend.torch.semiring import LSESumSemiring, SumProductSemiring
+from cirkit.backend.torch.utils import gumbel_max_sample, safelog
 from cirkit.utils.scope import Scope
 
 
@@ -51,21 +64,35 @@ class IntegrateQuery(Query):
             )
         super().__init__()
         self._circuit = circuit
+        # The static indices of the variables of each univariate input layer, which are used to
+        # gather the variables to integrate in each fold. They are kept on the host, such that
+        # the folds to integrate can be found without synchronizing with the device
+        self._scope_idxs: dict[TorchInputLayer, Tensor] = {
+            layer: layer.scope_idx[:, 0].cpu()
+            for layer in circuit.layers
+            if isinstance(layer, TorchInputLayer) and layer.num_variables == 1
+        }
 
     def __call__(
         self,
         x: Tensor,
         *,
-        integrate_vars: Tensor | Scope | Sequence[Scope],
+        integrate_vars: Tensor | Scope | Sequence[Scope] | None = None,
         gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None,
+        chunk_size: int | None = None,
     ) -> Tensor:
         """Solve an integration query, given an input batch and the variables to integrate.
 
         Args:
             x: An input batch of shape $(B, D)$, where $B$ is the batch size,
-                and $D$ is the number of variables.
+                and $D$ is the number of variables. It can also be a sparse tensor (either in
+                COO or CSR layout), whose specified entries are the observed values of the
+                variables. In such a case, the variables that are not observed are integrated
+                as well, without ever building the dense input tensor.
             integrate_vars: The variables to integrate. It must be a subset of the variables on
-                which the circuit given in the constructor is defined on.
+                which the circuit given in the constructor is defined on. It can be None only
+                if the input batch is sparse, i.e., if only the variables that are not observed
+                are integrated.
                 The format can be one of the following three:
                     1. Tensor of shape (B, D) where B is the batch size and D is the number of
                         variables in the scope of the circuit. Its dtype should be torch.bool
@@ -75,11 +102,81 @@ class IntegrateQuery(Query):
                         of the batch
                     3. Sequence of Scopes, where the length of the list must be either 1 or B. If
                         the list has length 1, behaves as above.
+            gate_function_kwargs: The keyword arguments of the gate functions, if any.
+            chunk_size: The maximum number of batch elements to evaluate at once. If it is
+                not None, then the input batch is split into chunks that are evaluated one
+                after the other (see [TorchCircuit.evaluate_chunks]
+                [cirkit.backend.torch.circuits.TorchCircuit.evaluate_chunks]).
+                Defaults to None, i.e., the whole batch is evaluated at once.
+
         Returns:
             The result of the integration query, given as a tensor of shape $(B, O, K)$,
                 where $B$ is the batch size, $O$ is the number of output vectors of the circuit, and
                 $K$ is the number of units in each output vector.
         """
+        if x.layout != torch.strided:
+            x = coalesce_evidence(x)
+            if integrate_vars is None:
+                integrate_vars = Scope([])
+        elif integrate_vars is None:
+            raise ValueError("The variables to integrate must be given, if the input is dense")
+        integrate_vars_mask = self._integrate_vars_mask(integrate_vars)
+
+        # Check batch sizes of input x and mask are compatible
+        if integrate_vars_mask.shape[0] not in (1, x.shape[0]):
+            raise ValueError(
+                "The number of scopes to integrate over must "
+                "either match the batch size of x, or be 1 if you "
+                "want to broadcast. Found #inputs = "
+                f"{x.shape[0]} != {integrate_vars_mask.shape[0]} = len(integrate_vars)"
+            )
+
+        # If the same variables are integrated for all the batch elements, and the mask is on
+        # the host, then find the folds to integrate of each input layer once
+        fold_masks = (
+            self._fold_masks(integrate_vars_mask)
+            if integrate_vars_mask.shape[0] == 1 and integrate_vars_mask.device.type == "cpu"
+            else None
+        )
+        integrate_vars_mask = integrate_vars_mask.to(x.device)
+
+        # The integrals of the input layers are computed once and shared by all the chunks,
+        # unless the circuit is conditionally parameterized
+        integrals: dict[TorchLayer, Tensor] = {}
+
+        if chunk_size is None:
+            return self._integrate(
+                x,
+                integrate_vars_mask,
+                gate_function_kwargs,
+                fold_masks=fold_masks,
+                integrals=integrals,
+            )
+
+        def _integrate_chunk(
+            chunk: slice, chunk_gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None
+        ) -> Tensor:
+            chunk_mask = (
+                integrate_vars_mask
+                if integrate_vars_mask.shape[0] == 1
+                else integrate_vars_mask[chunk]
+            )
+            return self._integrate(
+                slice_batch(x, chunk),
+                chunk_mask,
+                chunk_gate_function_kwargs,
+                fold_masks=fold_masks,
+                integrals=integrals if gate_function_kwargs is None else {},
+            )
+
+        return self._circuit.evaluate_chunks(
+            _integrate_chunk,
+            x.shape[0],
+            chunk_size=chunk_size,
+            gate_function_kwargs=gate_function_kwargs,
+        )
+
+    def _integrate_vars_mask(self, integrate_vars: Tensor | Scope | Sequence[Scope]) -> Tensor:
         if isinstance(integrate_vars, Tensor):
             # Check type of tensor is boolean
             if integrate_vars.dtype != torch.bool:
@@ -91,72 +188,150 @@ class IntegrateQuery(Query):
                 integrate_vars = torch.unsqueeze(integrate_vars, 0)
             # If the scope is correct, proceed, otherwise error
             num_vars = max(self._circuit.scope) + 1
-            if integrate_vars.shape[1] == num_vars:
-                integrate_vars_mask = integrate_vars
-            else:
+            if integrate_vars.shape[1] != num_vars:
                 raise ValueError(
                     f"Circuit scope has {num_vars} variables but integrate_vars "
                     f"was defined over {integrate_vars.shape[1]} != {num_vars} variables"
                 )
-        else:
-            # Convert list of scopes to a boolean mask of dimension (B, N) where
-            # N is the number of variables in the circuit's scope.
-            integrate_vars_mask = IntegrateQuery.scopes_to_mask(self._circuit, integrate_vars)
-            integrate_vars_mask = integrate_vars_mask.to(x.device)
+            return integrate_vars
 
-        # Check batch sizes of input x and mask are compatible
-        if integrate_vars_mask.shape[0] not in (1, x.shape[0]):
-            raise ValueError(
-                "The number of scopes to integrate over must "
-                "either match the batch size of x, or be 1 if you "
-                "want to broadcast. Found #inputs = "
-                f"{x.shape[0]} != {integrate_vars_mask.shape[0]} = len(integrate_vars)"
-            )
+        # Convert list of scopes to a boolean mask of dimension (B, N) where
+        # N is the number of variables in the circuit's scope.
+        return IntegrateQuery.scopes_to_mask(self._circuit, integrate_vars)
 
+    def _integrate(
+        self,
+        x: Tensor,
+        integrate_vars_mask: Tensor,
+        gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None,
+        *,
+        fold_masks: Mapping[TorchInputLayer, Tensor | bool] | None,
+        integrals: dict[TorchLayer, Tensor],
+    ) -> Tensor:
         # Memoize the gate functions before evaluating the circuit
-        self._circuit._memoize_gate_functions(gate_function_kwargs)
+        self._circuit._memoize_gate_functions(
+            {} if gate_function_kwargs is None else gate_function_kwargs
+        )
 
         output = self._circuit.evaluate(
             x,
             module_fn=functools.partial(
-                IntegrateQuery._layer_fn, integrate_vars_mask=integrate_vars_mask
+                IntegrateQuery._layer_fn,
+                integrate_vars_mask=integrate_vars_mask,
+                fold_masks=fold_masks,
+                integrals=integrals,
+                integrate_fn=self._integrate_layer,
             ),
         )  # (O, B, K)
         return output.transpose(0, 1)  # (B, O, K)
 
+    def _integrate_layer(self, layer: TorchInputLayer) -> Tensor:
+        # Reuse the integral computed by previous queries, if the parameters have not changed
+        return self._circuit.cached_constant(("integrate", layer), layer.integrate)
+
+    def _fold_masks(self, integrate_vars_mask: Tensor) -> dict[TorchInputLayer, Tensor | bool]:
+        # For each input layer, either a boolean mask over its folds of shape (F, 1, 1),
+        # or True (resp. False) if all (resp. none) of its folds are integrated
+        fold_masks: dict[TorchInputLayer, Tensor | bool] = {}
+        for layer, scope_idx in self._scope_idxs.items():
+            fold_mask = integrate_vars_mask[0, scope_idx]
+            if torch.all(fold_mask):
+                fold_masks[layer] = True
+            elif not torch.any(fold_mask):
+                fold_masks[layer] = False
+            else:
+                fold_masks[layer] = fold_mask.view(-1, 1, 1).to(layer.scope_idx.device)
+        return fold_masks
+
     @staticmethod
-    def _layer_fn(layer: TorchLayer, x: Tensor, *, integrate_vars_mask: Tensor) -> Tensor:
+    def _layer_fn(
+        layer: TorchLayer,
+        *inputs: Tensor | int | SparseEvidence,
+        integrate_vars_mask: Tensor,
+        fold_masks: Mapping[TorchInputLayer, Tensor | bool] | None = None,
+        integrals: dict[TorchLayer, Tensor] | None = None,
+        integrate_fn: Callable[[TorchInputLayer], Tensor] = TorchInputLayer.integrate,
+    ) -> Tensor:
         # Evaluate a layer: if it is not an input layer, then evaluate it in the usual
         # feed-forward way. Otherwise, use the variables to integrate to solve the marginal
         # queries on the input layers.
-        output = layer(x)  # (F, B, Ko)
-        if not isinstance(layer, TorchInputLayer):
-            return output
+        if not isinstance(layer, TorchInputLayer) or not layer.num_variables:
+            return layer(*inputs)  # (F, B, Ko)
         if layer.num_variables > 1:
             raise NotImplementedError("Integration of multivariate input layers is not supported")
-        # Some information:
-        # - integrate_vars_mask is a boolean tensor of dim (B, N)
-        #   where N is the number of variables in the scope of the whole circuit.
-        # - layer.scope_idx contains a subset of the variable_idxs of the scope
-        #   but may be a reshaped tensor; the shape and order of the variables may be different.
-        # As such, we need to use the idxs in layer.scope_idx to look-up the values from
-        # the integrate_vars_mask. This will return the correct shape and values.
-        # Note that, if integrate_vars_mask was a vector, we could do
-        # integrate_vars_mask[layer.scope_idx] the vmap below applies the above across
-        # the batch (B) dimension.
-
-        # integration_mask has dimension (B, F, Ko)
-        integration_mask = torch.vmap(lambda x: x[layer.scope_idx])(integrate_vars_mask)
-        # permute to match integration_output: integration_mask has dimension (F, B, Ko)
-        integration_mask = integration_mask.permute([1, 0, 2])
-        if not torch.any(integration_mask).item():
-            return output
-        integration_output = layer.integrate()
+        (x,) = inputs
+        if isinstance(x, SparseEvidence):
+            # The variables that are not observed in the sparse input batch are integrated
+            return IntegrateQuery._sparse_evidence_layer_fn(
+                layer,
+                x,
+                integrate_vars_mask=integrate_vars_mask,
+                fold_masks=fold_masks,
+                integrals=integrals,
+                integrate_fn=integrate_fn,
+            )
+        # Input layers depending on variables receive the dense evidence otherwise
+        assert isinstance(x, Tensor)
+        integration_mask: Tensor | bool
+        if fold_masks is None:
+            # Some information:
+            # - integrate_vars_mask is a boolean tensor of dim (B, N)
+            #   where N is the number of variables in the scope of the whole circuit.
+            # - layer.scope_idx contains a subset of the variable_idxs of the scope
+            #   but may be a reshaped tensor; the shape and order of the variables may be
+            #   different. As such, we need to use the idxs in layer.scope_idx to look-up the
+            #   values from the integrate_vars_mask. This will return the correct shape and values.
+            # integration_mask has dimension (B, F) -> (F, B, 1)
+            integration_mask = integrate_vars_mask[:, layer.scope_idx[:, 0]].T.unsqueeze(dim=2)
+        else:
+            integration_mask = fold_masks[layer]
+        if integration_mask is False:
+            return layer(x)
+        if integrals is None:
+            integrals = {}
+        integration_output = integrals.get(layer)
+        if integration_output is None:
+            integration_output = integrate_fn(layer)
+            integrals[layer] = integration_output
+        if integration_mask is True:
+            # All the folds are integrated, hence the layer is not evaluated at all
+            return integration_output.expand(-1, x.shape[1], -1)
         # Use the integration mask to select which output should be the result of
         # an integration operation, and which should not be
         # This is done in parallel for all folds, and regardless of whether the
         # circuit is folded or unfolded
-        return torch.where(integration_mask, integration_output, output)
+        return torch.where(integration_mask, integration_output, layer(x))
+
+    @staticmethod
+    def _sparse_evidence_layer_fn(
+        layer: TorchInputLayer,
+        evidence: SparseEvidence,
+        *,
+        integrate_vars_mask: Tensor,
+        fold_masks: Mapping[TorchInputLayer, Tensor | bool] | None,
+        integrals: dict[TorchLayer, Tensor] | None,
+        integrate_fn: Callable[[TorchInputLayer], Tensor],
+    ) -> Tensor:
+        if integrals is None:
+            integrals = {}
+        integration_output = integrals.get(layer)
+        if integration_output is None:
+            integration_output = integrate_fn(layer)
+            integrals[layer] = integration_output
+        # Retrieve which of the observed values are integrated nonetheless
+        integrate: Tensor | None
+        if fold_masks is None:
+            # integrate: (N,)
+            batch_idx = evidence.batch_idx if integrate_vars_mask.shape[0] > 1 else 0
+            var_idx = layer.scope_idx[evidence.fold_idx, 0]
+            integrate = integrate_vars_mask[batch_idx, var_idx]
+        else:
+            fold_mask = fold_masks[layer]
+            if fold_mask is True:
+                # All the folds are integrated, hence the layer is not evaluated at all
+                return integration_output.expand(-1, evidence.batch_size, -1)
+            integrate = None if fold_mask is False else fold_mask[evidence.fold_idx, 0, 0]
+        return evaluate_sparse_evidence(layer, evidence, integration_output, integrate=integrate)
 
     @staticmethod
     def scopes_to_mask(
@@ -200,6 +375,139 @@ class IntegrateQuery(Query):
         return mask
 
 
+class ConditionalQuery(Query):
+    r"""The conditional query object computes the log-probability of some target variables
+    $\mathbf{Y}$ conditioned on the remaining ones $\mathbf{X}$, i.e.,
+    $\log p(\mathbf{y}\mid\mathbf{x}) = \log p(\mathbf{x},\mathbf{y}) - \log p(\mathbf{x})$.
+
+    The joint and the marginal are computed in a single forward pass, by stacking them along
+    the batch dimension, i.e., the target variables are integrated only on the second half of
+    the stacked batch. The input layers not depending on the target variables are evaluated
+    as usual on the whole stacked batch.
+    """
+
+    def __init__(self, circuit: TorchCircuit) -> None:
+        """Initialize a conditional query object.
+
+        Args:
+            circuit: The circuit encoding the joint distribution.
+
+        Raises:
+            ValueError: If the circuit is not smooth or not decomposable.
+        """
+        super().__init__()
+        self._circuit = circuit
+        self._integrate_query = IntegrateQuery(circuit)
+
+    def __call__(
+        self,
+        x: Tensor,
+        *,
+        target_vars: Tensor | Scope | Sequence[Scope],
+        gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None = None,
+        chunk_size: int | None = None,
+    ) -> Tensor:
+        """Solve a conditional query, given an input batch and the target variables.
+
+        Args:
+            x: An input batch of shape $(B, D)$, where $B$ is the batch size,
+                and $D$ is the number of variables. It contains the assignments to both
+                the target variables and the variables being conditioned on.
+            target_vars: The target variables, given in any of the formats accepted by
+                [IntegrateQuery][cirkit.backend.torch.queries.IntegrateQuery] to specify the
+                variables to integrate. All the other variables are conditioned on.
+            gate_function_kwargs: The keyword arguments of the gate functions, if any.
+            chunk_size: The maximum number of batch elements to evaluate at once. If it is
+                not None, then the input batch is split into chunks that are evaluated one
+                after the other (see [TorchCircuit.evaluate_chunks]
+                [cirkit.backend.torch.circuits.TorchCircuit.evaluate_chunks]).
+                Defaults to None, i.e., the whole batch is evaluated at once.
+
+        Returns:
+            The log-probabilities of the target variables conditioned on the other ones, given
+                as a tensor of shape $(B, O, K)$, where $B$ is the batch size, $O$ is the number
+                of output vectors of the circuit, and $K$ is the number of units in each
+                output vector.
+
+        Raises:
+            ValueError: If the target variables are not compatible with the input batch.
+        """
+        target_vars_mask = self._integrate_query._integrate_vars_mask(target_vars)
+        if target_vars_mask.shape[0] not in (1, x.shape[0]):
+            raise ValueError(
+                "The number of target scopes must either match the batch size of x, "
+                f"or be 1 if you want to broadcast. Found #inputs = "
+                f"{x.shape[0]} != {target_vars_mask.shape[0]} = len(target_vars)"
+            )
+
+        # If the target variables are the same for all the batch elements, and the mask is on
+        # the host, then find the folds depending on the target variables once
+        fold_masks = (
+            self._integrate_query._fold_masks(target_vars_mask)
+            if target_vars_mask.shape[0] == 1 and target_vars_mask.device.type == "cpu"
+            else None
+        )
+        target_vars_mask = target_vars_mask.to(x.device)
+
+        if chunk_size is None:
+            return self._conditional(x, target_vars_mask, gate_function_kwargs, fold_masks)
+
+        def _conditional_chunk(
+            chunk: slice, chunk_gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None
+        ) -> Tensor:
+            chunk_mask = (
+                target_vars_mask if target_vars_mask.shape[0] == 1 else target_vars_mask[chunk]
+            )
+            return self._conditional(x[chunk], chunk_mask, chunk_gate_function_kwargs, fold_masks)
+
+        return self._circuit.evaluate_chunks(
+            _conditional_chunk,
+            x.shape[0],
+            chunk_size=chunk_size,
+            gate_function_kwargs=gate_function_kwargs,
+        )
+
+    def _conditional(
+        self,
+        x: Tensor,
+        target_vars_mask: Tensor,
+        gate_function_kwargs: Mapping[str, Mapping[str, Any]] | None,
+        fold_masks: Mapping[TorchInputLayer, Tensor | bool] | None,
+    ) -> Tensor:
+        # Stack the batch twice, and integrate the target variables on the second half only
+        batch_size = x.shape[0]
+        integrate_vars_mask = torch.cat(
+            [
+                torch.zeros_like(target_vars_mask).expand(batch_size, -1),
+                target_vars_mask.expand(batch_size, -1),
+            ]
+        )  # (2B, D)
+        if fold_masks is not None:
+            # The folds depending on the target variables are integrated in the second half
+            # of the stacked batch only, while the other ones are never integrated
+            marginal_rows = (torch.arange(2 * batch_size, device=x.device) >= batch_size).view(
+                1, -1, 1
+            )  # (1, 2B, 1)
+            stacked_fold_masks: dict[TorchInputLayer, Tensor | bool] = {}
+            for layer, fold_mask in fold_masks.items():
+                if isinstance(fold_mask, Tensor):
+                    stacked_fold_masks[layer] = marginal_rows & fold_mask  # (F, 2B, 1)
+                else:
+                    stacked_fold_masks[layer] = marginal_rows if fold_mask else False
+            fold_masks = stacked_fold_masks
+        if gate_function_kwargs is not None:
+            gate_function_kwargs = _stack_gate_function_kwargs(gate_function_kwargs, batch_size)
+        y = self._integrate_query._integrate(
+            torch.cat([x, x]),
+            integrate_vars_mask,
+            gate_function_kwargs,
+            fold_masks=fold_masks,
+            integrals={},
+        )  # (2B, O, K)
+        log_y = LSESumSemiring.map_from(y, self._circuit.outputs[0].semiring)
+        return log_y[:batch_size] - log_y[batch_size:]
+
+
 class MAPQuery(Query):
     """Compute the MAP state of the circuit, optionally using evidence."""
 
@@ -356,6 +664,549 @@ class MAPQuery(Query):
         return idx, output
 
 
+class TopKMAPQuery(Query):
+    """Compute the k best states of the circuit, i.e., the top-k MAP states, optionally using
+    evidence."""
+
+    def __init__(self, circuit: TorchCircuit) -> None:
+        """Initialize a top-k MAP query object.
+
+        Args:
+            circuit: The circuit used to compute the top-k MAP states.
+
+        Raises:
+            ValueError: If the circuit is not smooth or not decomposable, or if it has more than
+                one output.
+        """
+        if not circuit.properties.smooth or not circuit.properties.decomposable:
+            raise ValueError(
+                f"Top-k MAP is supported by smooth and decomposable circuits, "
+                f"found {circuit.properties}"
+            )
+        if circuit.address_book.num_outputs != 1:
+            raise ValueError(
+                f"Top-k MAP is supported by circuits having exactly one output, "
+                f"found {circuit.address_book.num_outputs} outputs"
+            )
+        super().__init__()
+        self._circuit = circuit
+
+    def __call__(
+        self,
+        k: int,
+        *,
+        x: Tensor | None = None,
+        evidence_vars: Tensor | None = None,
+    ) -> tuple[Tensor, Tensor]:
+        """Solve a top-k MAP query, optionally using an input evidence.
+
+        The k best pairs of (value, backpointer) of each unit are propagated in a single
+        bottom-up evaluation of the circuit, and then the k best states are decoded at once by
+        backtracking. The value of a state is the max-product value of the first output unit,
+        i.e., the maximum over the sub-circuits (or induced trees) of the circuit assigning
+        that state. Therefore, the same state might be found more than once if the circuit is
+        not deterministic. If there are less than k states, then the remaining ones have
+        value $-\\infty$.
+
+        Args:
+            k: The number of states to compute for each batch element.
+            x: The input evidence of shape $(B, D)$, where $B$ is the batch size,
+                and $D$ is the number of variables.
+            evidence_vars: The variables to include in the evidence, i.e., a boolean tensor of
+                shape $(B, D)$ or $(1, D)$ having True in the positions of random variables
+                that are in the evidence and False elsewhere.
+
+        Returns:
+            A tuple where the first element is the tensor of shape $(B, k)$ of the logarithm of
+            the values of the k best states, in decreasing order, and the second element is
+            the tensor of shape $(B, k, D)$ of the states.
+
+        Raises:
+            ValueError: If k is not a positive integer, or if only one of the input evidence
+                and the evidence variables is given.
+        """
+        if k <= 0:
+            raise ValueError(f"The number of states k must be a positive integer, but found {k}")
+        if (x is None) ^ (evidence_vars is None):
+            raise ValueError("Both evidence and the evidence variables must be provided.")
+        device = self._circuit.device
+        if x is None:
+            num_variables = max(self._circuit.scope) + 1
+            x = torch.zeros((1, num_variables), dtype=torch.long, device=device)
+            evidence_vars = torch.zeros_like(x, dtype=torch.bool)
+        assert evidence_vars is not None
+        x = x.to(device)
+        batch_size, num_variables = x.shape
+        evidence_vars = evidence_vars.to(device).expand(batch_size, -1)
+
+        # Each batch element is repeated once for each rank, i.e., the outputs of the layers
+        # have shape (F, B * k, K), and they store the k best values of each unit
+        x = x.repeat_interleave(k, dim=0)
+        evidence_vars = evidence_vars.repeat_interleave(k, dim=0)
+        module_ptrs: dict[TorchLayer, Any] = {}
+
+        def _topk_fn(layer: TorchLayer, *inputs: Tensor) -> Tensor:
+            y, ptrs = TopKMAPQuery._layer_topk(layer, *inputs, k=k, evidence_vars=evidence_vars)
+            module_ptrs[layer] = ptrs
+            return y
+
+        # log_values: (1, B * k, K) -> (B, k)
+        log_values = self._circuit.evaluate(x, module_fn=_topk_fn)[0, :, 0].view(batch_size, k)
+
+        def _select_fn(layer: TorchLayer, units: Tensor) -> Tensor | list[Tensor]:
+            return TopKMAPQuery._select_topk(layer, units, module_ptrs[layer], k=k)
+
+        # The units of the layers being backtracked are the ranked units u * k + r, where u is
+        # the unit of the layer and r is the rank of the value of that unit. For each batch
+        # element, the k ranks of the first output unit are backtracked
+        out_units = torch.arange(k, device=device).repeat(batch_size)
+        state = self._circuit.address_book.backtrack_select(
+            x.clone(), _select_fn, out_units=out_units, units_per_input=True
+        )
+        return log_values, state.view(batch_size, k, num_variables)
+
+    @staticmethod
+    def _layer_topk(
+        layer: TorchLayer, *inputs: Tensor, k: int, evidence_vars: Tensor
+    ) -> tuple[Tensor, Any]:
+        """Compute the k best values of each unit of a layer in log-space, together with the
+        backpointers needed to decode the states.
+
+        Args:
+            layer: The layer.
+            *inputs: The inputs of the layer, i.e., for inner layers the k best values of the
+                units of the inputs, having shape $(F, H, B k, K_i)$.
+            k: The number of values to compute for each unit.
+            evidence_vars: The variables in the evidence, of shape $(B k, D)$.
+
+        Returns:
+            A tuple where the first element is the tensor of shape $(F, B k, K_o)$ of the k best
+            values of each unit, and the second element are the backpointers.
+
+        Raises:
+            TypeError: If top-k MAP is not supported by the layer.
+        """
+        if isinstance(layer, TorchInputLayer):
+            if not layer.num_variables:
+                # the layer has been marginalized, hence only its first rank is valid
+                (batch_size,) = inputs
+                y = LSESumSemiring.map_from(layer(batch_size // k), layer.semiring)
+                y = _pad_ranks(y.unsqueeze(dim=3), k)
+                return y.transpose(2, 3).flatten(start_dim=1, end_dim=2), None
+            if not isinstance(layer, TorchCategoricalLayer):
+                raise TypeError(f"Top-k MAP is not supported for layers of type {type(layer)}")
+            (x,) = inputs
+            num_folds = layer.num_folds
+            # x: (F, B * k, 1) -> (F, B, 1), as the evidence is repeated for each rank
+            x = x[:, ::k]
+            is_evidence = evidence_vars[::k, layer.scope_idx].permute(1, 0, 2)
+            # log_y: (F, B, K), the values of the evidence
+            log_y = LSESumSemiring.map_from(layer(x), layer.semiring)
+            # log_c: (F, K, C), the values of all the categories
+            categories = torch.arange(layer.num_categories, device=x.device)
+            log_c = layer(categories.view(1, -1, 1).expand(num_folds, -1, 1))
+            log_c = LSESumSemiring.map_from(log_c, layer.semiring).transpose(1, 2)
+            log_c, states_c = torch.topk(log_c, min(k, layer.num_categories), dim=2)
+            log_c, states_c = _pad_ranks(log_c, k), _pad_ranks(states_c, k, value=0)
+            # values, states: (F, B, K, k)
+            values = torch.where(
+                is_evidence.unsqueeze(dim=3),
+                _pad_ranks(log_y.unsqueeze(dim=3), k),
+                log_c.unsqueeze(dim=1),
+            )
+            states = torch.where(
+                is_evidence.unsqueeze(dim=3), x.unsqueeze(dim=3), states_c.unsqueeze(dim=1)
+            )
+            return values.transpose(2, 3).flatten(start_dim=1, end_dim=2), states
+
+        (x,) = inputs
+        num_folds, arity, _, num_input_units = x.shape
+        # x: (F, H, B * k, Ki) -> (F, H, B, Ki, k)
+        x = x.view(num_folds, arity, -1, k, num_input_units).transpose(3, 4)
+        ptrs: Any
+        match layer:
+            case TorchSumLayer():
+                # log_x: (F, B, H * Ki, k)
+                log_x = x.permute(0, 2, 1, 3, 4).flatten(start_dim=2, end_dim=3)
+                values, ptrs = _weighted_topk(log_x, safelog(layer.weight()), k)
+            case TorchCPTLayer():
+                log_x, ranks = _product_topk(x)
+                values, idxs = _weighted_topk(log_x, safelog(layer.weight()), k)
+                ptrs = idxs, ranks
+            case TorchHadamardLayer():
+                values, ptrs = _product_topk(x)
+            case TorchKroneckerLayer():
+                # broadcast the values of the inputs to the units of the Kronecker product
+                digits = _kronecker_digits(layer, device=x.device)
+                x = torch.stack([x[:, h, :, digits[h]] for h in range(arity)], dim=1)
+                values, ptrs = _product_topk(x)
+            case _:
+                raise TypeError(f"Top-k MAP is not supported for layers of type {type(layer)}")
+        # values: (F, B, Ko, k) -> (F, B * k, Ko)
+        return values.transpose(2, 3).flatten(start_dim=1, end_dim=2), ptrs
+
+    @staticmethod
+    def _select_topk(
+        layer: TorchLayer, units: Tensor, ptrs: Any, *, k: int
+    ) -> Tensor | list[Tensor]:
+        """Follow the backpointers of the ranked units being selected.
+
+        Args:
+            layer: The layer.
+            units: The ranked units being selected, i.e., $u k + r$ where $u$ is the unit and
+                $r$ is the rank, having shape $(F, B k)$.
+            ptrs: The backpointers computed by the layer.
+            k: The number of values computed for each unit.
+
+        Returns:
+            The states of the variables, if the layer is an input layer. Otherwise, the ranked
+            units being selected within each input of the layer.
+        """
+        if isinstance(layer, TorchInputLayer):
+            return _gather_ranked(ptrs, units, k)
+        match layer:
+            case TorchSumLayer():
+                # the raveled index of the input unit and its rank
+                idxs = _gather_ranked(ptrs, units, k)
+                in_idxs, in_ranks = torch.div(idxs, k, rounding_mode="floor"), idxs % k
+                arity_idxs = torch.div(in_idxs, layer.num_input_units, rounding_mode="floor")
+                in_units = (in_idxs % layer.num_input_units) * k + in_ranks
+                return [torch.where(arity_idxs == h, in_units, -1) for h in range(layer.arity)]
+            case TorchCPTLayer():
+                idxs, ranks = ptrs
+                idxs = _gather_ranked(idxs, units, k)
+                in_idxs, in_ranks = torch.div(idxs, k, rounding_mode="floor"), idxs % k
+                # in_ranks: (F, B * k, H), the ranks within the inputs of the product
+                in_ranks = _gather_ranked(ranks, in_idxs * k + in_ranks, k)
+                return [in_idxs * k + in_ranks[..., h] for h in range(layer.arity)]
+            case TorchHadamardLayer():
+                in_ranks = _gather_ranked(ptrs, units, k)
+                in_idxs = torch.div(units, k, rounding_mode="floor")
+                return [in_idxs * k + in_ranks[..., h] for h in range(layer.arity)]
+            case TorchKroneckerLayer():
+                in_ranks = _gather_ranked(ptrs, units, k)
+                digits = _kronecker_digits(layer, device=units.device)
+                in_idxs = torch.div(units, k, rounding_mode="floor")
+                return [digits[h][in_idxs] * k + in_ranks[..., h] for h in range(layer.arity)]
+        raise TypeError(f"Top-k MAP is not supported for layers of type {type(layer)}")
+
+
+class AllMarginalsQuery(Query):
+    r"""Compute the posterior marginal distributions of all the variables at once, optionally
+    using evidence.
+
+    The marginals are computed by differentiating the logarithm of the circuit output w.r.t.
+    indicators $\lambda_{d,c}$ of each variable $X_d$ taking each value $c$, which replace the
+    evidence on the input layers. That is, each univariate input unit over $X_d$ computes
+    $\sum_c \lambda_{d,c} f(c)$, where the indicators are one-hot for the variables in the
+    evidence and all set to one otherwise. Since the circuit is decomposable, its output is
+    linear in the indicators of each variable, hence
+    $\partial \log Z / \partial \lambda_{d,c} \propto p(X_d = c, \mathbf{e}_{\setminus d})$,
+    where $\mathbf{e}_{\setminus d}$ is the evidence on the variables other than $X_d$.
+    Therefore, all the marginals require one forward and one backward pass only.
+    """
+
+    def __init__(self, circuit: TorchCircuit) -> None:
+        """Initialize an all-marginals query object.
+
+        Args:
+            circuit: The circuit used to compute the marginals.
+
+        Raises:
+            ValueError: If the circuit is not smooth or not decomposable, or if it has more than
+                one output.
+            NotImplementedError: If the circuit has input layers other than univariate
+                categorical and binomial layers, or input layers with no variables.
+        """
+        if not circuit.properties.smooth or not circuit.properties.decomposable:
+            raise ValueError(
+                f"All-marginals queries are supported by smooth and decomposable circuits, "
+                f"found {circuit.properties}"
+            )
+        if circuit.address_book.num_outputs != 1:
+            raise ValueError(
+                f"All-marginals queries are supported by circuits having exactly one output, "
+                f"found {circuit.address_book.num_outputs} outputs"
+            )
+        super().__init__()
+        self._circuit = circuit
+        # The number of states of the variable of each univariate input layer
+        self._num_states: dict[TorchInputLayer, int] = {}
+        for layer in circuit.layers:
+            if not isinstance(layer, TorchInputLayer) or not layer.num_variables:
+                continue
+            if isinstance(layer, TorchCategoricalLayer) and layer.num_variables == 1:
+                self._num_states[layer] = layer.num_categories
+            elif isinstance(layer, TorchBinomialLayer) and layer.num_variables == 1:
+                self._num_states[layer] = layer.total_count + 1
+            else:
+                raise NotImplementedError(
+                    f"All-marginals queries are not supported for input layers of type "
+                    f"{type(layer)} over {layer.num_variables} variables"
+                )
+
+    def __call__(
+        self,
+        *,
+        x: Tensor | None = None,
+        evidence_vars: Tensor | None = None,
+    ) -> Tensor:
+        """Solve an all-marginals query, optionally using an input evidence.
+
+        Args:
+            x: The input evidence of shape $(B, D)$, where $B$ is the batch size,
+                and $D$ is the number of variables.
+            evidence_vars: The variables to include in the evidence, i.e., a boolean tensor of
+                shape $(B, D)$ or $(1, D)$ having True in the positions of random variables
+                that are in the evidence and False elsewhere.
+
+        Returns:
+            The tensor of shape $(B, D, C)$ of the marginal distributions, where $C$ is the
+            maximum number of states of the variables. For each variable $X_d$, it is the
+            distribution $p(X_d \mid \mathbf{e}_{\setminus d})$ conditioned on the evidence
+            on the other variables. The probabilities of the states that are not valid for a
+            variable, as well as the ones of the variables that are not in the scope of the
+            circuit, are zero.
+
+        Raises:
+            ValueError: If only one of the input evidence and the evidence variables is given.
+        """
+        if (x is None) ^ (evidence_vars is None):
+            raise ValueError("Both evidence and the evidence variables must be provided.")
+        device = self._circuit.device
+        num_states = max(self._num_states.values())
+        if x is None:
+            num_variables = max(self._circuit.scope) + 1
+            x = torch.zeros((1, num_variables), dtype=torch.long, device=device)
+            evidence_vars = torch.zeros_like(x, dtype=torch.bool)
+        assert evidence_vars is not None
+        x = x.to(device)
+        evidence_vars = evidence_vars.to(device).expand(x.shape[0], -1)
+
+        # The indicators are one-hot for the variables in the evidence, and all ones otherwise
+        states = torch.arange(num_states, device=device)
+        indicators = ((x.unsqueeze(dim=2) == states) | ~evidence_vars.unsqueeze(dim=2)).to(
+            torch.get_default_dtype()
+        )  # (B, D, C)
+        with torch.enable_grad():
+            indicators.requires_grad_(True)
+            output = self._circuit.evaluate(
+                x,
+                module_fn=functools.partial(
+                    self._layer_fn, indicators=indicators, num_states=self._num_states
+                ),
+            )  # (1, B, K)
+            log_output = LSESumSemiring.map_from(output[0, :, 0], self._circuit.layers[0].semiring)
+            (grad,) = torch.autograd.grad(log_output.real.sum(), indicators)
+        # The gradients are proportional to the joint probabilities p(X_d = c, e_{-d})
+        grad = grad.clamp(min=0.0)
+        normalizer = grad.sum(dim=2, keepdim=True)
+        return grad / torch.where(normalizer > 0.0, normalizer, 1.0)
+
+    @staticmethod
+    def _layer_fn(
+        layer: TorchLayer,
+        x: Tensor,
+        *,
+        indicators: Tensor,
+        num_states: Mapping[TorchInputLayer, int],
+    ) -> Tensor:
+        if not isinstance(layer, TorchInputLayer) or not layer.num_variables:
+            return layer(x)
+        # Evaluate the input layer on all the states of its variable, and compute the
+        # sum of its outputs weighted by the indicators, in log-space
+        num_folds = layer.num_folds
+        layer_num_states = num_states[layer]
+        states = torch.arange(layer_num_states, device=x.device)
+        states = states.view(1, -1, 1).expand(num_folds, -1, 1)  # (F, C, 1)
+        log_y = LSESumSemiring.map_from(layer(states), layer.semiring)  # (F, C, K)
+        log_y_max = log_y.amax(dim=1, keepdim=True).detach()
+        log_y_max = torch.where(torch.isfinite(log_y_max), log_y_max, 0.0)
+        layer_indicators = indicators[:, layer.scope_idx[:, 0], :layer_num_states].to(
+            log_y.dtype
+        )  # (B, F, C)
+        y = torch.einsum(
+            "bfc,fck->fbk", layer_indicators, torch.exp(log_y - log_y_max)
+        )  # (F, B, K)
+        return layer.semiring.map_from(safelog(y) + log_y_max, LSESumSemiring)
+
+
+class IncrementalQuery(Query):
+    """Evaluate the circuit incrementally on a sequence of inputs, where consecutive inputs
+    differ in a few variables only (e.g., in Gibbs sampling or in streaming settings).
+
+    The outputs of all the layers are kept after each evaluation. Then, given the variables
+    whose values have changed, only the folds of the layers depending on them are re-evaluated,
+    i.e., the folds on the paths from the input layers over the changed variables to the outputs
+    of the circuit. The circuit is evaluated without gradients, and it is fully re-evaluated
+    whenever its parameters or the batch size are changed.
+    """
+
+    def __init__(self, circuit: TorchCircuit) -> None:
+        """Initialize an incremental evaluation query object.
+
+        Args:
+            circuit: The circuit to evaluate.
+
+        Raises:
+            ValueError: If the circuit has empty scope, or if it depends on gate functions.
+        """
+        if not circuit.scope:
+            raise ValueError("The circuit to evaluate incrementally must have non-empty scope")
+        if circuit.gate_function_evals:
+            raise ValueError("The circuit to evaluate incrementally must not have gate functions")
+        super().__init__()
+        self._circuit = circuit
+        book = circuit.address_book
+        self._layer_ids: dict[TorchLayer, int] = {
+            entry.module: i for i, entry in enumerate(book) if entry.module is not None
+        }
+        # For each entry of the address book, the static indices of its inputs within the
+        # stacked outputs of its input layers, and the offsets of such outputs
+        self._in_idx: list[Tensor | None] = []
+        self._in_offsets: list[list[int]] = []
+        # For each layer, a boolean matrix of shape (D, F) encoding whether each of its folds
+        # depends on each variable. They are kept on the host, such that the folds to
+        # re-evaluate can be found without synchronizing with the device
+        num_variables = max(circuit.scope) + 1
+        self._dependencies: list[Tensor] = []
+        for entry in book:
+            layer = entry.module
+            if not entry.in_module_ids:
+                # Only the entries of the input layers have no inputs
+                assert layer is not None
+                self._in_idx.append(None)
+                self._in_offsets.append([])
+                dependencies = torch.zeros(num_variables, layer.num_folds, dtype=torch.bool)
+                if isinstance(layer, TorchInputLayer) and layer.num_variables:
+                    scope_idx = layer.scope_idx.cpu()  # (F, D')
+                    fold_idx = torch.arange(layer.num_folds).unsqueeze(dim=1).expand_as(scope_idx)
+                    dependencies[scope_idx, fold_idx] = True
+                self._dependencies.append(dependencies)
+                continue
+            (in_layer_ids,) = entry.in_module_ids
+            (in_fold_idx,) = entry.in_fold_idx
+            in_dependencies = torch.cat([self._dependencies[i] for i in in_layer_ids], dim=1)
+            if not isinstance(in_fold_idx, Tensor):
+                # Recover the index tensor from the slices that would unsqueeze the inputs
+                in_fold_idx = torch.arange(in_dependencies.shape[1])[in_fold_idx]
+            in_fold_idx = in_fold_idx.cpu()  # (F, H)
+            self._in_idx.append(in_fold_idx.to(circuit.device))
+            self._in_offsets.append(
+                list(
+                    itertools.accumulate(
+                        (self._dependencies[i].shape[1] for i in in_layer_ids), initial=0
+                    )
+                )
+            )
+            if layer is not None:
+                # (D, F, H) -> (D, F)
+                self._dependencies.append(torch.any(in_dependencies[:, in_fold_idx], dim=2))
+        # The input batch, the outputs of all the layers and the parameters of the layers
+        # at the previous evaluation, and the versions of the parameters of the circuit
+        self._x: Tensor | None
+        self._outputs: list[Tensor]
+        self._params: dict[TorchLayer, dict[str, Tensor]]
+        self._versions: tuple[tuple[int, torch.device, torch.dtype, int], ...] | None
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the outputs of the previous evaluation, such that the circuit will be fully
+        evaluated at the next call."""
+        self._x = None
+        self._outputs = []
+        self._params = {}
+        self._versions = None
+
+    @torch.no_grad()
+    def __call__(self, x: Tensor, *, changed_vars: Tensor | Sequence[int] | None = None) -> Tensor:
+        """Evaluate the circuit on an input batch, by re-evaluating only the folds of the
+        layers that depend on the variables whose values have changed since the previous
+        evaluation.
+
+        Args:
+            x: The input batch of shape $(B, D)$, where $B$ is the batch size,
+                and $D$ is the number of variables.
+            changed_vars: The indices of the variables whose values have changed in any of the
+                batch elements, since the previous evaluation. If it is None, then they are
+                found by comparing the input batch with the previous one.
+
+        Returns:
+            The output of the circuit, given as a tensor of shape $(B, O, K)$, where $O$ is the
+            number of output vectors of the circuit, and $K$ is the number of units in each
+            output vector.
+        """
+        versions = self._circuit.parameter_versions()
+        if self._x is None or self._x.shape != x.shape or self._versions != versions:
+            return self._evaluate(x, versions)
+        if changed_vars is None:
+            changed_vars = torch.nonzero(torch.any(x != self._x, dim=0), as_tuple=True)[0]
+        changed_vars = torch.as_tensor(changed_vars, dtype=torch.long).cpu()
+        self._x = x.clone()
+
+        book = self._circuit.address_book
+        for i, entry in enumerate(book):
+            layer = entry.module
+            if layer is None:
+                (in_layer_ids,) = entry.in_module_ids
+                y = self._gather_inputs(i, in_layer_ids, slice(None))  # (O, B, K)
+                return y.transpose(0, 1)  # (B, O, K)
+            # Find the folds to re-evaluate
+            fold_idx = torch.nonzero(torch.any(self._dependencies[i][changed_vars], dim=0))
+            if not len(fold_idx):
+                continue
+            fold_idx = fold_idx[:, 0].to(x.device)
+            if entry.in_module_ids:
+                (in_layer_ids,) = entry.in_module_ids
+                inputs = (self._gather_inputs(i, in_layer_ids, fold_idx),)  # (F', H, B, K)
+            else:
+                assert isinstance(layer, TorchInputLayer)
+                inputs = (x[:, layer.scope_idx[fold_idx]].permute(1, 0, 2),)  # (F', B, D')
+            params = self._params.get(layer)
+            if params is None:
+                params = self._params[layer] = {n: p() for n, p in layer.params.items()}
+            with layer.select_folds(fold_idx, params=params):
+                self._outputs[i][fold_idx] = layer(*inputs)  # (F', B, K)
+        raise RuntimeError("The address book is malformed")
+
+    def _evaluate(self, x: Tensor, versions: tuple) -> Tensor:
+        # Evaluate the whole circuit, and keep the outputs of all the layers
+        outputs: dict[TorchLayer, Tensor] = {}
+
+        def _layer_fn(layer: TorchLayer, *inputs: Tensor) -> Tensor:
+            y = layer(*inputs)
+            outputs[layer] = y
+            return y
+
+        y = self._circuit.evaluate(x, module_fn=_layer_fn)  # (O, B, K)
+        self._outputs = [outputs[layer].contiguous() for layer in self._layer_ids]
+        self._params = {}
+        self._x = x.clone()
+        self._versions = versions
+        return y.transpose(0, 1)  # (B, O, K)
+
+    def _gather_inputs(self, i: int, in_layer_ids: list[int], fold_idx: Tensor | slice) -> Tensor:
+        # Gather the inputs to the given folds of a layer (or the outputs of the circuit),
+        # from the outputs of its input layers
+        in_idx = self._in_idx[i]
+        assert in_idx is not None
+        in_idx = in_idx[fold_idx]  # (F', H) or (O,)
+        if len(in_layer_ids) == 1:
+            return self._outputs[in_layer_ids[0]][in_idx]
+        in_outputs = [self._outputs[j] for j in in_layer_ids]
+        batch_size = max(y.shape[1] for y in in_outputs)
+        x = torch.empty(
+            (*in_idx.shape, batch_size, in_outputs[0].shape[2]),
+            dtype=in_outputs[0].dtype,
+            device=in_outputs[0].device,
+        )
+        offsets = self._in_offsets[i]
+        for j, y in enumerate(in_outputs):
+            mask = (in_idx >= offsets[j]) & (in_idx < offsets[j + 1])
+            x[mask] = y[in_idx[mask] - offsets[j]]
+        return x
+
+
 class SamplingQuery(Query):
     """Sample from the circuit, optionally using evidence."""
 
@@ -381,7 +1232,12 @@ class SamplingQuery(Query):
     ) -> tuple[Tensor, Tensor]:
         """Sample from the circuit, optionally using an input evidence.
 
+        Given an input evidence of shape $(B, D)$, the samples are drawn for each row of the
+        evidence in a single pass. The circuit is evaluated once on the evidence, and then the
+        samples are drawn top-down according to the values computed by each layer.
+
         Args:
+            num_samples: The number of samples $N$ to draw (for each row of the evidence).
             x: The input evidence of shape $(B, D)$, where $B$ is the batch size,
                 and $D$ is the number of variables.
             evidence_vars: The variables to include in the evidence. It must be a subset of the
@@ -389,75 +1245,627 @@ class SamplingQuery(Query):
                 It must be a Tensor of shape (B, D) where B is the batch size and D is the number of
                 variables in the scope of the circuit. Its dtype should be torch.bool and have True
                 in the positions of random variables that are in the evidence and False elsewhere.
+                It can also have shape (1, D), i.e., the same variables are in the evidence
+                for each row.
         Returns:
-            The result of the sampling query, given as a tuple where the first element is the probability of
-            the sample value and the second value is the sample with shape $(B, D)$.
+            The result of the sampling query, given as a tuple where the first element is the
+            probability of the sample value and the second value is the sample. The samples have
+            shape $(N, D)$ if no evidence is given, and shape $(B, N, D)$ otherwise, even if the
+            evidence has a single row. Similarly, the first element has shape $(O, N, K)$ or
+            $(O, B, N, K)$, where $O$ is the number of outputs and $K$ is the number of output
+            units. Note that this is a breaking change for evidence with a single row: previous
+            versions returned samples of shape $(N, D)$ in such a case, which can be recovered
+            by indexing the first row of the samples.
+
+        Raises:
+            ValueError: If only one between the evidence and the evidence variables is given.
+            ValueError: If the evidence and the evidence variables have inconsistent shapes.
+        """
+        return self._build_sampler(x, evidence_vars)(num_samples, None)
+
+    def iter_samples(
+        self,
+        total: int,
+        chunk_size: int,
+        *,
+        x: Tensor | None = None,
+        evidence_vars: Tensor | None = None,
+        seed: int | None = None,
+    ) -> Iterator[Tensor]:
+        """Lazily sample from the circuit in chunks, optionally using an input evidence,
+        such that only one chunk of samples is held in memory at a time.
+
+        The quantities that do not depend on the samples, e.g., the normalized weights of
+        the sum layers and the evaluation of the circuit on the evidence, are computed once
+        and reused across chunks. Each chunk is drawn from its own random generator, whose seed
+        is obtained by hashing the given seed together with the index of the chunk. Therefore,
+        the chunks do not depend on the global random state, they are reproducible, and the
+        chunks drawn with different seeds do not share their random streams.
+
+        Args:
+            total: The total number of samples to draw (for each row of the evidence).
+            chunk_size: The maximum number of samples in each chunk.
+            x: The input evidence.
+                See [__call__][cirkit.backend.torch.queries.SamplingQuery.__call__].
+            evidence_vars: The variables to include in the evidence.
+                See [__call__][cirkit.backend.torch.queries.SamplingQuery.__call__].
+            seed: The seed of the random streams. If it is None, then it is drawn from the
+                global random state when the first chunk is requested.
+
+        Returns:
+            An iterator over the chunks of samples, each having shape $(N, D)$ or $(B, N, D)$
+                as the samples returned by
+                [__call__][cirkit.backend.torch.queries.SamplingQuery.__call__],
+                where $N$ is at most the chunk size.
+
+        Raises:
+            ValueError: If the total number of samples is negative, or if the chunk size is not
+                positive.
+        """
+        if total < 0:
+            raise ValueError(f"The total number of samples must be non-negative, found {total}")
+        if chunk_size <= 0:
+            raise ValueError(f"The chunk size must be positive, found {chunk_size}")
+        sampler = self._build_sampler(x, evidence_vars)
+        if seed is None:
+            seed = int(torch.randint(2**62, size=()).item())
+        generator = torch.Generator(device=self._circuit.device)
+        for chunk_idx, start in enumerate(range(0, total, chunk_size)):
+            generator.manual_seed(_mix_seed(seed, chunk_idx))
+            _, samples = sampler(min(chunk_size, total - start), generator)
+            yield samples
+
+    def _build_sampler(
+        self, x: Tensor | None, evidence_vars: Tensor | None
+    ) -> Callable[[int, torch.Generator | None], tuple[Tensor, Tensor]]:
+        """Build a function drawing a given number of samples, by precomputing the quantities
+        that do not depend on the samples.
+
+        Args:
+            x: The input evidence, or None.
+            evidence_vars: The variables to include in the evidence, or None.
+
+        Returns:
+            A function that, given the number of samples and the random generator to draw them
+                from (or None, to use the global random state), returns the result of the sampling
+                query. See [__call__][cirkit.backend.torch.queries.SamplingQuery.__call__].
+
+        Raises:
+            ValueError: If only one between the evidence and the evidence variables is given.
+            ValueError: If the evidence and the evidence variables have inconsistent shapes.
         """
         if (x is None) ^ (evidence_vars is None):
-            assert ValueError("Both evidence and the evidence variables must be provided.")
+            raise ValueError("Both evidence and the evidence variables must be provided.")
 
         if self._circuit.symbolic_operation:
             circuit_scope = self._circuit.symbolic_operation.operands[0].scope
         else:
             circuit_scope = self._circuit.scope
 
+        device = self._circuit.device
+        cdfs = self._categorical_cdfs()
         if x is None:
             # if the circuit is the result of some operation then work on the original scope size
             num_variables = max(circuit_scope) + 1
-            state = torch.full(
-                (num_samples, num_variables), 0, dtype=torch.float, device=self._circuit.device
+
+            def _empty_state(num_samples: int) -> Tensor:
+                return torch.full((num_samples, num_variables), 0, dtype=torch.float, device=device)
+
+            # sample top-down without evaluating the circuit, if it is normalized
+            weights = self._normalized_weights()
+            if weights is not None:
+                cdfs.update(weights)
+                return lambda num_samples, generator: self._sample_top_down(
+                    _empty_state(num_samples), cdfs, generator=generator
+                )
+
+            # otherwise, integrate all the variables
+            evidence = self._evaluate_evidence(None, None)
+            return lambda num_samples, generator: self._sample_conditional(
+                _empty_state(num_samples),
+                None,
+                None,
+                evidence,
+                cdfs,
+                num_samples=num_samples,
+                generator=generator,
+            )
+
+        assert evidence_vars is not None
+        x = x.to(device)
+        evidence_vars = evidence_vars.to(device)
+        batch_size = x.size(0)
+        if evidence_vars.size(0) == 1:
+            evidence_vars = evidence_vars.expand(batch_size, -1)
+        if evidence_vars.shape != x.shape:
+            raise ValueError(
+                f"The evidence variables must have shape {tuple(x.shape)} or (1, {x.size(1)}), "
+                f"but found shape {tuple(evidence_vars.shape)}"
+            )
+        evidence = self._evaluate_evidence(x, evidence_vars)
+
+        def _sample_evidence(
+            num_samples: int, generator: torch.Generator | None
+        ) -> tuple[Tensor, Tensor]:
+            # each row of the evidence is repeated for its samples, i.e., the sample n of the
+            # row b is the row b * N + n of the state
+            state = x.repeat_interleave(num_samples, dim=0)
+            samples_p, state = self._sample_conditional(
+                state,
+                x,
+                evidence_vars,
+                evidence,
+                cdfs,
+                num_samples=num_samples,
+                generator=generator,
+            )
+            return (
+                samples_p.unflatten(1, (batch_size, num_samples)),
+                state.unflatten(0, (batch_size, num_samples)),
             )
-            evidence_vars = state.clone().to(torch.bool)
-        else:
-            x = x.to(self._circuit.device)
-            state = x.clone()
 
-            if state.size(0) != 1:
-                raise ValueError("Only one tensor can be provided as evidence.")
+        return _sample_evidence
 
-            state = state.tile((num_samples, 1))
-            evidence_vars = evidence_vars.tile((num_samples, 1))
+    def _categorical_cdfs(self) -> dict[TorchLayer, Tensor]:
+        """Compute the cumulative distributions of the categorical input layers.
 
-        samples_p, state = self._circuit.backtrack(
-            x=state,
-            module_fn=functools.partial(
-                SamplingQuery._layer_fn, num_samples=num_samples, evidence_vars=evidence_vars
-            ),
-        )
+        Returns:
+            A dictionary mapping each categorical input layer to the cumulative probabilities
+                of shape $(F, K, C)$, where $C$ is the number of categories.
+        """
+        cdfs: dict[TorchLayer, Tensor] = {}
+        for layer in self._circuit.layers:
+            if not isinstance(layer, TorchCategoricalLayer) or not layer.num_variables:
+                continue
+            # probs: (F, 1, K, C) -> (F, K, C)
+            if layer.logits is None:
+                assert layer.probs is not None
+                probs = layer.probs()
+            else:
+                probs = torch.softmax(layer.logits(), dim=-1)
+            cdfs[layer] = torch.cumsum(probs.squeeze(dim=1), dim=-1)
+        return cdfs
 
-        return samples_p, state
+    def _normalized_weights(self) -> dict[TorchLayer, Tensor] | None:
+        """Retrieve the cumulative weights of the sum layers if the circuit is locally
+        normalized, i.e., if the weights of each sum unit and each input distribution are
+        normalized.
 
-    @staticmethod
-    def _layer_fn(
-        layer: TorchLayer, x: Tensor, *, num_samples: int, evidence_vars: Tensor
+        Returns:
+            A dictionary mapping each sum layer to its cumulative weight of shape
+                $(F, K_o, H K_i)$, or None if the circuit is not locally normalized and hence it
+                cannot be sampled top-down without evaluating it.
+        """
+        weights: dict[TorchLayer, Tensor] = {}
+        # The checks on the values of the parameters are gathered, such that the device is
+        # synchronized only once
+        is_normalized: list[Tensor] = []
+        for layer in self._circuit.layers:
+            match layer:
+                case TorchInputLayer():
+                    if not layer.num_variables:
+                        continue
+                    partition = SumProductSemiring.map_from(layer.integrate(), layer.semiring)
+                    is_normalized.append(
+                        torch.all(torch.isclose(partition, torch.ones_like(partition)))
+                    )
+                case TorchHadamardLayer() | TorchKroneckerLayer():
+                    continue
+                case TorchSumLayer() | TorchCPTLayer():
+                    # weight: (F, B, K_o, H * Ki)
+                    weight = layer.weight()
+                    # batched parameters are not supported by sampling
+                    if weight.size(1) != 1:
+                        return None
+                    weight_sum = torch.sum(weight, dim=-1)
+                    is_normalized.append(torch.all(weight >= 0.0))
+                    is_normalized.append(
+                        torch.all(torch.isclose(weight_sum, torch.ones_like(weight_sum)))
+                    )
+                    weights[layer] = torch.cumsum(weight.squeeze(dim=1), dim=-1)
+                case _:
+                    return None
+        if is_normalized and not torch.all(torch.stack(is_normalized)):
+            return None
+        return weights
+
+    def _sample_top_down(
+        self,
+        state: Tensor,
+        cdfs: dict[TorchLayer, Tensor],
+        *,
+        generator: torch.Generator | None = None,
     ) -> tuple[Tensor, Tensor]:
-        """Evaluate the layer in the usual feedforward way by randomly sampling.
+        """Sample from a locally normalized circuit by ancestral sampling, i.e., by drawing
+        the inputs of the sum units from their weights and the variables from the input
+        distributions while visiting the circuit top-down, without evaluating it.
+        Only the units being visited by each sample are sampled from.
 
         Args:
-            layer (TorchLayer): The layer for the forward pass.
-            x (Tensor): The input to the layer.
-            evidence_vars (Tensor): A tensor that indicates which variables are set
-                as evidence.
+            state: The tensor of shape $(N, D)$ storing the samples, where $N$ is the number
+                of samples and $D$ is the number of variables.
+            cdfs: The cumulative weights of the sum layers and the cumulative distributions
+                of the categorical input layers.
+                See [_normalized_weights][cirkit.backend.torch.queries.SamplingQuery._normalized_weights].
+            generator: The random generator to draw the samples from. If it is None, then the
+                global random state is used.
 
         Returns:
-            tuple[Tensor, Tensor]: A tuple which contains the input sampled the layer
-                and its layer output.
+            The result of the sampling query, as in the bottom-up evaluation.
         """
-        if isinstance(layer, TorchInputLayer):
-            if layer.num_variables:
-                # sample from input layer
-                sample_idx, sampled_output = layer.sample(num_samples)
+        num_samples = state.size(0)
+
+        def _select_fn(layer: TorchLayer, units: Tensor) -> Tensor:
+            if isinstance(layer, TorchInputLayer):
+                return self._sample_input_layer(layer, units, cdfs, generator=generator)
+            return _sample_units_inverse_cdf(cdfs[layer], units, generator=generator)
+
+        state = self._circuit.address_book.backtrack_select(state, _select_fn)
+
+        # the output of the circuit when integrating all the variables, i.e., the partition
+        # function, which is cheaply computed for a batch of size one
+        def _integrate_fn(layer: TorchLayer, *inputs: Tensor) -> Tensor:
+            if isinstance(layer, TorchInputLayer) and layer.num_variables:
+                # the partition function might be broadcast over the units
+                return layer.integrate().expand(layer.num_folds, 1, layer.num_output_units)
+            return layer(*inputs)
+
+        samples_p = self._circuit.evaluate(module_fn=_integrate_fn)
+        return samples_p.expand(-1, num_samples, -1), state
+
+    def _evaluate_evidence(
+        self, x: Tensor | None, evidence_vars: Tensor | None
+    ) -> tuple[Tensor, dict[TorchLayer, tuple[Tensor, Tensor]]]:
+        """Evaluate the circuit on the evidence, where the variables not being in the evidence
+        are integrated, and retrieve the weighted inputs of each sum layer.
+
+        Args:
+            x: The evidence of shape $(B, D)$. If it is None, then no evidence is given,
+                i.e., all the variables are integrated and $B = 1$.
+            evidence_vars: The boolean mask of the evidence variables, of shape $(B, D)$.
+                It is None if and only if the evidence is None.
+
+        Returns:
+            The output of the circuit of shape $(O, B, K)$, and a dictionary mapping each sum
+                layer to both the logarithm of its weight of shape $(F, K_o, H K_i)$ and
+                the logarithm of its input of shape $(F, B, H K_i)$.
+
+        Raises:
+            TypeError: If the weights of some sum layer are negative.
+        """
+        sum_inputs: dict[TorchLayer, tuple[Tensor, Tensor]] = {}
+        # The checks on the signs of the weights are gathered, such that the device is
+        # synchronized only once after the evaluation
+        is_negative: list[Tensor] = []
+
+        def _evidence_fn(layer: TorchLayer, *inputs: Tensor) -> Tensor:
+            if isinstance(layer, TorchInputLayer):
+                if not layer.num_variables:
+                    # layer has been marginalized
+                    return layer(*inputs)
+                # the partition function might be broadcast over the units
+                integral = layer.integrate().expand(layer.num_folds, 1, layer.num_output_units)
+                if x is None:
+                    return integral
+                assert evidence_vars is not None
+                # when evidence is used, select that layer otherwise marginalize the variable
+                (layer_x,) = inputs
                 is_evidence = evidence_vars[:, layer.scope_idx].permute(1, 0, 2)
-                # select evidence state where specified
-                idx = torch.where(is_evidence, x, sample_idx)
-                # when evidence is used, select that layer otherwise marginalize
-                # the variable
-                output = torch.where(is_evidence, layer(x), layer.integrate())
-            else:
-                # layer has been marginalized
-                output = layer(x)
-                idx = torch.full_like(output, torch.nan)
+                return torch.where(is_evidence, layer(layer_x), integral)
+            (layer_x,) = inputs
+            if isinstance(layer, (TorchSumLayer, TorchCPTLayer)):
+                # weight: (F, 1, K_o, H * Ki) -> (F, K_o, H * Ki)
+                weight = layer.weight()
+                is_negative.append(torch.any(weight < 0.0))
+                # log_x: (F, H, B, Ki) -> (F, B, H * Ki)
+                log_x = LSESumSemiring.map_from(layer_x, layer.semiring)
+                if isinstance(layer, TorchCPTLayer):
+                    log_x = torch.sum(log_x, dim=1, keepdim=True)
+                log_x = log_x.permute(0, 2, 1, 3).flatten(start_dim=2)
+                sum_inputs[layer] = (safelog(weight.squeeze(dim=1)), log_x)
+            return layer(layer_x)
+
+        samples_p = self._circuit.evaluate(x, module_fn=_evidence_fn)
+        if is_negative and torch.any(torch.stack(is_negative)):
+            raise TypeError("Sampling in sum layers only works with positive weights.")
+        return samples_p, sum_inputs
+
+    def _sample_conditional(
+        self,
+        state: Tensor,
+        x: Tensor | None,
+        evidence_vars: Tensor | None,
+        evidence: tuple[Tensor, dict[TorchLayer, tuple[Tensor, Tensor]]],
+        cdfs: dict[TorchLayer, Tensor],
+        *,
+        num_samples: int,
+        generator: torch.Generator | None = None,
+    ) -> tuple[Tensor, Tensor]:
+        """Sample from the circuit conditioned on the evidence, by drawing the inputs of the
+        sum units being visited top-down proportionally to their weighted input values.
+
+        Args:
+            state: The tensor of shape $(B N, D)$ storing the samples, where $N$ is the number
+                of samples for each row of the evidence.
+            x: The evidence of shape $(B, D)$. If it is None, then no evidence is given,
+                i.e., all the variables are integrated and $B = 1$.
+            evidence_vars: The boolean mask of the evidence variables, of shape $(B, D)$.
+                It is None if and only if the evidence is None.
+            evidence: The evaluation of the circuit on the evidence.
+                See [_evaluate_evidence][cirkit.backend.torch.queries.SamplingQuery._evaluate_evidence].
+            cdfs: The cumulative distributions of the categorical input layers.
+            num_samples: The number of samples $N$ for each row of the evidence.
+            generator: The random generator to draw the samples from. If it is None, then the
+                global random state is used.
+
+        Returns:
+            The output of the circuit on the evidence of shape $(O, B N, K)$, and the samples.
+        """
+        samples_p, sum_inputs = evidence
+
+        # The row of the evidence of each sample
+        rows = torch.arange(state.size(0), device=state.device) // num_samples
+
+        def _select_fn(layer: TorchLayer, units: Tensor) -> Tensor:
+            if isinstance(layer, TorchInputLayer):
+                sample_idx = self._sample_input_layer(layer, units, cdfs, generator=generator)
+                if x is None:
+                    return sample_idx
+                assert evidence_vars is not None
+                # select the evidence state where specified
+                # is_evidence, layer_x: (F, B N)
+                is_evidence = evidence_vars[rows][:, layer.scope_idx[:, 0]].T
+                layer_x = x[rows][:, layer.scope_idx[:, 0]].T
+                return torch.where(is_evidence, layer_x.to(sample_idx.dtype), sample_idx)
+
+            # log_weight: (F, K_o, H * Ki), log_x: (F, B, H * Ki)
+            log_weight, log_x = sum_inputs[layer]
+            # the weights of the units being selected by the samples of each row of the evidence
+            # are the weights of N sum units sharing the same inputs, i.e., (F, B, N, H * Ki)
+            log_weight = _gather_units(log_weight, units).unflatten(1, (log_x.size(1), num_samples))
+            # sample_idx: (F, B, N) -> (F, B N)
+            sample_idx, _ = gumbel_max_sample(log_x, log_weight, generator=generator)
+            return sample_idx.flatten(start_dim=1)
+
+        state = self._circuit.address_book.backtrack_select(state, _select_fn)
+        return samples_p[:, rows], state
+
+    @staticmethod
+    def _sample_input_layer(
+        layer: TorchInputLayer,
+        units: Tensor,
+        cdfs: dict[TorchLayer, Tensor],
+        *,
+        generator: torch.Generator | None = None,
+    ) -> Tensor:
+        """Sample from the units of an input layer.
+
+        Args:
+            layer: The input layer.
+            units: The units to sample from, of shape $(F, N)$.
+            cdfs: The cumulative distributions of the categorical input layers.
+            generator: The random generator to draw the samples from. If it is None, then the
+                global random state is used.
+
+        Returns:
+            The samples of shape $(F, N)$.
+        """
+        if layer in cdfs:
+            return _sample_units_inverse_cdf(cdfs[layer], units, generator=generator)
+        if generator is None:
+            # sample_idx: (F, N, K)
+            sample_idx, _ = layer.sample(units.size(1))
         else:
-            idx, output = layer.sample(x)
+            # The input layers sample from torch distributions, which only draw from the global
+            # random state. Hence, we draw from a global random state seeded by the generator
+            device = units.device
+            seed = int(torch.randint(2**62, size=(), device=device, generator=generator).item())
+            with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+                torch.manual_seed(seed)
+                sample_idx, _ = layer.sample(units.size(1))
+        # sample_idx: (F, N, K) -> (F, N)
+        return sample_idx.gather(dim=2, index=units.unsqueeze(dim=2)).squeeze(dim=2)
+
+
+def _mix_seed(seed: int, index: int) -> int:
+    """Derive the seed of the random stream having a given index from a seed, by hashing them
+    with the SplitMix64 finalizer. Differently from offsetting the seed by the index, the
+    streams derived from different seeds do not overlap.
+
+    Args:
+        seed: The seed.
+        index: The index of the random stream.
+
+    Returns:
+        The seed of the random stream, i.e., an unsigned 64-bit integer.
+    """
 
-        return idx, output
+    def _splitmix64(z: int) -> int:
+        z = (z + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return z ^ (z >> 31)
+
+    return _splitmix64(_splitmix64(seed) + index)
+
+
+def _gather_units(x: Tensor, units: Tensor) -> Tensor:
+    """Gather the rows of the units being selected.
+
+    Args:
+        x: A tensor of shape $(F, K, C)$, where $F$ is the number of folds, $K$ is the number of
+            units, and $C$ is the size of each row.
+        units: The units being selected, of shape $(F, N)$.
+
+    Returns:
+        The tensor of shape $(F, N, C)$ of the selected rows.
+    """
+    return x.gather(dim=1, index=units.unsqueeze(dim=2).expand(-1, -1, x.size(2)))
+
+
+def _sample_units_inverse_cdf(
+    cdf: Tensor, units: Tensor, *, generator: torch.Generator | None = None
+) -> Tensor:
+    """Sample from the categorical distributions of the units being selected, by inverting
+    their cumulative distribution. The cumulative distribution of each unit is not gathered
+    for each sample. Instead, the cumulative distributions of all units are offset by their
+    index and concatenated, such that a single sorted search is performed for all the samples.
+
+    Args:
+        cdf: The cumulative probabilities of shape $(F, K, C)$, where $F$ is the number of folds,
+            $K$ is the number of units, and $C$ is the number of categories.
+        units: The units being sampled from, of shape $(F, N)$.
+        generator: The random generator to draw the samples from. If it is None, then the
+            global random state is used.
+
+    Returns:
+        The sampled categories of shape $(F, N)$.
+    """
+    num_folds, num_units, num_categories = cdf.shape
+    # the search is performed in double precision, as the offsets can be large
+    cdf = cdf.double()
+    offsets = torch.arange(num_folds * num_units, dtype=cdf.dtype, device=cdf.device)
+    # flat_cdf: (F * K * C), where the cumulative probabilities of each unit are in [i, i + 1]
+    flat_cdf = (cdf / cdf[..., -1:] + offsets.view(num_folds, num_units, 1)).flatten()
+    # rows: (F, N), the index of the unit being selected by each sample
+    rows = torch.arange(num_folds, device=cdf.device).unsqueeze(dim=1) * num_units + units
+    u = torch.rand(units.shape, dtype=cdf.dtype, device=cdf.device, generator=generator)
+    idx = torch.searchsorted(flat_cdf, rows + u, right=True) - rows * num_categories
+    return idx.clamp(min=0, max=num_categories - 1)
+
+
+def _pad_ranks(x: Tensor, k: int, *, value: float = -float("inf")) -> Tensor:
+    """Pad the last dimension of a tensor of ranked values up to the given number of ranks.
+
+    Args:
+        x: The ranked values, whose last dimension has size at most k.
+        k: The number of ranks.
+        value: The value used for padding.
+
+    Returns:
+        The padded tensor, whose last dimension has size k.
+    """
+    if x.size(-1) == k:
+        return x
+    return torch.nn.functional.pad(x, (0, k - x.size(-1)), value=value)
+
+
+def _gather_ranked(x: Tensor, units: Tensor, k: int) -> Tensor:
+    """Gather the entries of the ranked units being selected.
+
+    Args:
+        x: A tensor of shape $(F, B, K, k, \\ldots)$, where $F$ is the number of folds, $B$ is the
+            batch size, $K$ is the number of units and $k$ is the number of ranks.
+        units: The ranked units being selected, i.e., $u k + r$ where $u$ is the unit and
+            $r$ is the rank, having shape $(F, B k)$.
+        k: The number of ranks.
+
+    Returns:
+        The tensor of shape $(F, B k, \\ldots)$ of the selected entries.
+    """
+    fold_idx = torch.arange(x.size(0), device=units.device).unsqueeze(dim=1)
+    batch_idx = torch.div(
+        torch.arange(units.size(1), device=units.device), k, rounding_mode="floor"
+    )
+    return x[fold_idx, batch_idx, torch.div(units, k, rounding_mode="floor"), units % k]
+
+
+def _kronecker_digits(layer: TorchKroneckerLayer, *, device: torch.device) -> Tensor:
+    """Compute the units of the inputs of a Kronecker layer for each of its units.
+
+    Args:
+        layer: The Kronecker layer.
+        device: The device.
+
+    Returns:
+        The tensor of shape $(H, K_o)$ of the units of each input.
+    """
+    units = torch.arange(layer.num_output_units, device=device)
+    return torch.stack(
+        [
+            torch.div(units, layer.num_input_units ** (layer.arity - h - 1), rounding_mode="floor")
+            % layer.num_input_units
+            for h in range(layer.arity)
+        ]
+    )
+
+
+def _product_topk(x: Tensor) -> tuple[Tensor, Tensor]:
+    """Compute the k best values of the products of the units of the inputs, by merging the
+    ranked values of one input at a time.
+
+    Args:
+        x: The k best values of the units of the inputs in log-space, having shape
+            $(F, H, B, K, k)$.
+
+    Returns:
+        A tuple of the k best values of the products in log-space, having shape $(F, B, K, k)$,
+        and the ranks within each input, having shape $(F, B, K, k, H)$.
+    """
+    k = x.size(-1)
+    values = x[:, 0]
+    ranks = torch.arange(k, device=x.device).expand(*values.shape).unsqueeze(dim=-1)
+    for h in range(1, x.size(1)):
+        # values: (F, B, K, k * k) -> (F, B, K, k)
+        values = (values.unsqueeze(dim=-1) + x[:, h].unsqueeze(dim=-2)).flatten(start_dim=-2)
+        values, idxs = torch.topk(values, k, dim=-1)
+        prev_idxs = torch.div(idxs, k, rounding_mode="floor")
+        ranks = torch.cat(
+            [
+                ranks.gather(dim=-2, index=prev_idxs.unsqueeze(dim=-1).expand(-1, -1, -1, -1, h)),
+                (idxs % k).unsqueeze(dim=-1),
+            ],
+            dim=-1,
+        )
+    return values, ranks
+
+
+def _weighted_topk(
+    log_x: Tensor, log_weight: Tensor, k: int, *, max_numel: int = 2**24
+) -> tuple[Tensor, Tensor]:
+    """Compute the k best weighted values of sum units in log-space, in chunks of output units.
+
+    Args:
+        log_x: The k best values of the inputs in log-space, having shape $(F, B, I, k)$.
+        log_weight: The logarithm of the weights, having shape $(F, B, K_o, I)$, where the batch
+            size can also be one.
+        k: The number of values to compute for each sum unit.
+        max_numel: The maximum number of weighted values to materialize at a time.
+
+    Returns:
+        A tuple of the k best values in log-space and of their raveled indices $i k + r$, where
+        $i$ is the input and $r$ is its rank, both having shape $(F, B, K_o, k)$.
+    """
+    num_folds, batch_size, num_inputs, num_ranks = log_x.shape
+    num_outputs = log_weight.shape[2]
+    chunk_size = max(1, max_numel // max(num_folds * batch_size * num_inputs * num_ranks, 1))
+    values: list[Tensor] = []
+    idxs: list[Tensor] = []
+    for start in range(0, num_outputs, chunk_size):
+        # scores: (F, B, C, I * k)
+        scores = log_weight[:, :, start : start + chunk_size].unsqueeze(dim=-1) + log_x.unsqueeze(
+            dim=2
+        )
+        value, idx = torch.topk(
+            scores.flatten(start_dim=-2), min(k, num_inputs * num_ranks), dim=-1
+        )
+        values.append(_pad_ranks(value, k))
+        idxs.append(_pad_ranks(idx, k, value=0))
+    return torch.cat(values, dim=2), torch.cat(idxs, dim=2)
+
+
+def _stack_gate_function_kwargs(
+    gate_function_kwargs: Mapping[str, Mapping[str, Any]], batch_size: int
+) -> Mapping[str, Mapping[str, Any]]:
+    # Repeat the tensor arguments of the gate functions that are batched
+    return {
+        gate_function_id: {
+            k: (
+                torch.cat([v, v])
+                if isinstance(v, Tensor) and v.dim() and v.shape[0] == batch_size
+                else v
+            )
+            for k, v in kwargs.items()
+        }
+        for gate_function_id, kwargs in gate_function_kwargs.items()
+    }
@@ -9,6 +9,11 @@ from torch import Tensor
 
 from cirkit.backend.torch.utils import csafelog, safelog
 
+# The safe logarithms are autograd functions having a custom backward, hence they must be
+# recorded as they are when the circuit layers are traced to generate code
+torch.fx.wrap("safelog")
+torch.fx.wrap("csafelog")
+
 Semiring = type["SemiringImpl"]
 
 
@@ -476,6 +481,100 @@ class ComplexLSESumSemiring(SemiringImpl):
         return csafelog(func_exp_xs) + reduced_max_xs
 
 
+@SemiringImpl.register("max-sum")
+class MaxSumSemiring(SemiringImpl):
+    """The log space computation of the max-product semiring, i.e., the max-sum semiring."""
+
+    @classmethod
+    def cast(cls, x: Tensor) -> Tensor:
+        if x.is_floating_point():
+            return x
+        if not x.is_complex():
+            default_float_dtype = torch.get_default_dtype()
+            return x.to(default_float_dtype)
+        raise ValueError(f"Cannot cast a tensor of type '{x.dtype}' to the '{cls.__name__}'")
+
+    @classmethod
+    def einsum(
+        cls,
+        equation: str | Sequence[Sequence[int]],
+        *,
+        inputs: tuple[Tensor, ...] | None = None,
+        operands: tuple[Tensor, ...] | None = None,
+        dim: int,
+        keepdim: bool,
+    ) -> Tensor:
+        # NOTE: The maximum over the contracted indices cannot be expressed as an einsum in the
+        #       linear space, hence the logarithms of the inputs and of the (linear) operands are
+        #       broadcasted to all the indices, summed and then maximized. The layers having a
+        #       large number of contracted indices (e.g., sum layers) implement a fused and chunked
+        #       max-reduction instead, see [weighted_max][cirkit.backend.torch.utils.weighted_max].
+        if inputs is None:
+            inputs = ()
+        if operands is None:
+            operands = ()
+        match equation:
+            case str():
+                in_subscripts, out_subscripts = equation.replace(" ", "").split("->")
+                symbols = {c: i for i, c in enumerate(sorted(set(equation) - set(",->")))}
+                subscripts = [
+                    [symbols[c] for c in ss] for ss in (*in_subscripts.split(","), out_subscripts)
+                ]
+            case Sequence():
+                subscripts = [[int(i) for i in ss] for ss in equation]
+            case _:
+                raise ValueError(
+                    "The einsum expression must be either a string or a sequence of int sequences"
+                )
+        xs = (*inputs, *(safelog(cls.cast(opd)) for opd in operands))
+        *in_subscripts_seq, out_subscripts_seq = subscripts
+        # Align all the terms to the output indices, followed by the contracted indices
+        indices = list(out_subscripts_seq)
+        indices.extend(
+            sorted(set(itertools.chain.from_iterable(in_subscripts_seq)).difference(indices))
+        )
+        y: Tensor | None = None
+        for xi, ss in zip(xs, in_subscripts_seq):
+            shape = [xi.shape[ss.index(i)] if i in ss else 1 for i in indices]
+            positions = [indices.index(i) for i in ss]
+            perm = sorted(range(len(ss)), key=positions.__getitem__)
+            aligned_xi = xi.permute(perm).reshape(shape)
+            y = aligned_xi if y is None else y + aligned_xi
+        assert y is not None
+        contracted_dims = tuple(range(len(out_subscripts_seq), len(indices)))
+        if not contracted_dims:
+            return y
+        return torch.amax(y, dim=contracted_dims)
+
+    @classmethod
+    def sum(cls, x: Tensor, dim: int, *, keepdim: bool = False) -> Tensor:
+        return torch.amax(x, dim=dim, keepdim=keepdim)
+
+    @classmethod
+    def add(cls, *xs: Tensor) -> Tensor:
+        return functools.reduce(torch.maximum, xs)
+
+    @classmethod
+    def prod(cls, x: Tensor, dim: int, *, keepdim: bool = False) -> Tensor:
+        return x.sum(dim=dim, keepdim=keepdim)
+
+    @classmethod
+    def mul(cls, *xs: Tensor) -> Tensor:
+        return functools.reduce(torch.add, xs)
+
+    @classmethod
+    def apply_reduce(
+        cls,
+        func: EinsumFunc,
+        *xs: Tensor,
+        dim: int,
+        keepdim: bool,
+    ) -> Tensor:
+        raise NotImplementedError(
+            f"Sum-like functions in the linear space cannot be applied in '{cls.__name__}'"
+        )
+
+
 @SumProductSemiring.register_map_from(LSESumSemiring)
 def _(x: Tensor) -> Tensor:
     return torch.exp(x)
@@ -512,3 +611,37 @@ def _(x: Tensor) -> Tensor:
 @ComplexLSESumSemiring.register_map_from(LSESumSemiring)
 def _(x: Tensor) -> Tensor:
     return ComplexLSESumSemiring.cast(x)
+
+
+@SumProductSemiring.register_map_from(MaxSumSemiring)
+def _(x: Tensor) -> Tensor:
+    return torch.exp(x)
+
+
+@LSESumSemiring.register_map_from(MaxSumSemiring)
+def _(x: Tensor) -> Tensor:
+    return x
+
+
+@ComplexLSESumSemiring.register_map_from(MaxSumSemiring)
+def _(x: Tensor) -> Tensor:
+    return ComplexLSESumSemiring.cast(x)
+
+
+@MaxSumSemiring.register_map_from(SumProductSemiring)
+def _(x: Tensor) -> Tensor:
+    return safelog(x)
+
+
+@MaxSumSemiring.register_map_from(LSESumSemiring)
+def _(x: Tensor) -> Tensor:
+    return x
+
+
+@MaxSumSemiring.register_map_from(ComplexLSESumSemiring)
+def _(x: Tensor) -> Tensor:
+    if torch.all(torch.isreal(x)):
+        return x.real
+    raise ValueError(
+        f"Cannot map a tensor with non-zero imaginary part to {MaxSumSemiring.__name__}"
+    )
@@ -1,6 +1,7 @@
+import functools
 import itertools
 from collections.abc import Sequence
-from typing import Any, Callable, Mapping, Protocol, cast
+from typing import Any, Mapping, Protocol, cast
 
 import torch
 from torch import Tensor, autograd, nn
@@ -25,7 +26,17 @@ class SafeLog(autograd.Function):
         return torch.nan_to_num(grad_output / x)
 
 
-safelog = SafeLog.apply
+def safelog(x: Tensor) -> Tensor:
+    """Compute the logarithm of a tensor, such that the gradients of the logarithm of zeros
+    are also zeros rather than being undefined.
+
+    Args:
+        x: The input tensor.
+
+    Returns:
+        Tensor: The logarithm of the input tensor.
+    """
+    return SafeLog.apply(x)
 
 
 # pylint: disable-next=abstract-method
@@ -47,7 +58,17 @@ class ComplexSafeLog(autograd.Function):
         return torch.nan_to_num(grad_output / x.conj())
 
 
-csafelog: Callable[[Tensor], Tensor] = ComplexSafeLog.apply
+def csafelog(x: Tensor) -> Tensor:
+    """Compute the complex logarithm of a tensor, such that the gradients of the logarithm of
+    zeros are also zeros rather than being undefined.
+
+    Args:
+        x: The input tensor.
+
+    Returns:
+        Tensor: The complex logarithm of the input tensor.
+    """
+    return ComplexSafeLog.apply(x)
 
 
 def flatten_dims(x: Tensor, /, *, dims: Sequence[int]) -> Tensor:
@@ -108,6 +129,271 @@ def unflatten_dims(x: Tensor, /, *, dims: Sequence[int], shape: Sequence[int]) -
     )
 
 
+def gumbel_max_sample(
+    log_x: Tensor,
+    log_weight: Tensor,
+    /,
+    *,
+    max_numel: int = 2**24,
+    generator: torch.Generator | None = None,
+) -> tuple[Tensor, Tensor]:
+    r"""Sample the inputs of sum units with the Gumbel-max trick, i.e., for each sum unit $o$
+    the sampled input is $\arg\max_i \log w_{oi} + \log x_i + g_{oi}$, where $g_{oi}$ are
+    i.i.d. samples from a standard Gumbel distribution. That is, the input $i$ is sampled with
+    probability proportional to $w_{oi} x_i$, and the weights need not be normalized.
+
+    The samples are computed in chunks of output units, such that at most a given number of
+    perturbed scores are materialized at a time. No check is performed on the values of the
+    weights, which are assumed to be non-negative.
+
+    Args:
+        log_x: The logarithm of the inputs, having shape $(F, B, I)$, where $F$ is the number of
+            folds, $B$ is the batch size and $I$ is the number of inputs.
+        log_weight: The logarithm of the weights, having shape $(F, B, K_o, I)$, where the batch
+            size can also be one, and $K_o$ is the number of sum units.
+        max_numel: The maximum number of perturbed scores to materialize at a time.
+        generator: The random generator to draw the Gumbel samples from. If it is None, then
+            the global random state is used.
+
+    Returns:
+        A tuple of two tensors of shape $(F, B, K_o)$, the sampled inputs and the logarithm of
+            the weighted inputs being sampled, i.e., $\log w_{oi} + \log x_i$.
+    """
+    return _chunked_weighted_argmax(
+        log_x, log_weight, log_space=True, perturb=True, max_numel=max_numel, generator=generator
+    )
+
+
+def weighted_max(
+    x: Tensor, weight: Tensor, /, *, log_space: bool = False, max_numel: int = 2**24
+) -> tuple[Tensor, Tensor]:
+    r"""Compute the maximum weighted input of sum units, i.e., for each sum unit $o$ the
+    maximizer $\arg\max_i w_{oi} x_i$ and the maximum value $\max_i w_{oi} x_i$, without
+    materializing all the weighted inputs at once. In log-space, the products are replaced by
+    sums, i.e., the maximum is $\max_i \log w_{oi} + \log x_i$.
+
+    The maximum is computed in chunks of output units, such that at most a given number of
+    weighted inputs are materialized at a time. The maximum values are gathered from the
+    inputs and the weights, hence their gradients are sparse and flow to the maximizers only.
+
+    Args:
+        x: The inputs, having shape $(F, B, I)$, where $F$ is the number of folds, $B$ is the
+            batch size and $I$ is the number of inputs.
+        weight: The weights, having shape $(F, B, K_o, I)$, where the batch size can also be one,
+            and $K_o$ is the number of sum units.
+        log_space: Whether the inputs and the weights are given in log-space.
+        max_numel: The maximum number of weighted inputs to materialize at a time.
+
+    Returns:
+        A tuple of two tensors of shape $(F, B, K_o)$, the maximizers and the maximum values.
+    """
+    return _chunked_weighted_argmax(
+        x, weight, log_space=log_space, perturb=False, max_numel=max_numel
+    )
+
+
+def _chunked_weighted_argmax(
+    x: Tensor,
+    weight: Tensor,
+    /,
+    *,
+    log_space: bool,
+    perturb: bool,
+    max_numel: int,
+    generator: torch.Generator | None = None,
+) -> tuple[Tensor, Tensor]:
+    num_folds, batch_size, num_inputs = x.shape
+    num_outputs = weight.shape[2]
+    chunk_size = max(1, max_numel // max(num_folds * batch_size * num_inputs, 1))
+    combine = torch.add if log_space else torch.mul
+    idxs: list[Tensor] = []
+    values: list[Tensor] = []
+    for start in range(0, num_outputs, chunk_size):
+        # weight_c: (F, B, C, I)
+        weight_c = weight[:, :, start : start + chunk_size].expand(
+            num_folds, batch_size, -1, num_inputs
+        )
+        with torch.no_grad():
+            if perturb:
+                # scores: (F, B, C, I), i.e., -log(e) with e ~ Exp(1) is a standard Gumbel sample
+                scores = torch.empty_like(weight_c).exponential_(generator=generator).log_().neg_()
+                scores.add_(weight_c).add_(x.unsqueeze(dim=2))
+            else:
+                scores = combine(weight_c, x.unsqueeze(dim=2))
+            idx = torch.argmax(scores, dim=-1)
+            del scores
+        value = combine(
+            weight_c.gather(dim=-1, index=idx.unsqueeze(dim=-1)).squeeze(dim=-1),
+            x.gather(dim=-1, index=idx),
+        )
+        idxs.append(idx)
+        values.append(value)
+    return torch.cat(idxs, dim=2), torch.cat(values, dim=2)
+
+
+def log_matmul_exp(
+    x: Tensor | Sequence[Tensor], weight: Tensor, /, *, max_numel: int = 2**24
+) -> Tensor:
+    r"""Compute the logarithm of the weighted sums of exponentiated inputs, i.e., for each sum
+    unit $o$ the value $\log \sum_i w_{oi} \exp(x_i)$, in a numerically stable way. If a sequence
+    of inputs $x^{(1)},\ldots,x^{(H)}$ is given, then the sums are computed over their Kronecker
+    product, i.e., $\log \sum_{i_1,\ldots,i_H} w_{o i_1\cdots i_H} \exp(x^{(1)}_{i_1} + \cdots
+    + x^{(H)}_{i_H})$, where the weights are indexed in row-major order.
+
+    The inputs are shifted by their maximum and exponentiated in chunks of batch elements, such
+    that at most a given number of exponentiated inputs are materialized at a time. The gradients
+    are computed by a custom backward pass, which only saves the inputs, the weights and the
+    outputs, and recomputes the exponentiated inputs chunk by chunk. The inputs and the weights
+    can also be complex, in which case the maximum is taken over the real parts of the inputs.
+
+    Args:
+        x: The inputs, having shape $(F, B, I)$, where $F$ is the number of folds, $B$ is the
+            batch size and $I$ is the number of inputs, or a sequence of inputs of shape
+            $(F, B, I_h)$ such that $I = \prod_h I_h$.
+        weight: The weights, having shape $(F, B, K_o, I)$, where the batch size can also be one,
+            and $K_o$ is the number of sum units.
+        max_numel: The maximum number of exponentiated inputs to materialize at a time.
+
+    Returns:
+        Tensor: The result, having shape $(F, B, K_o)$.
+    """
+    xs = (x,) if isinstance(x, Tensor) else tuple(x)
+    return LogMatMulExp.apply(weight, max_numel, *xs)
+
+
+def _shifted_log_kron(xs: Sequence[Tensor]) -> tuple[Tensor, Tensor]:
+    # Shift every input by its own maximum, such that the exponentiated Kronecker product
+    # never overflows, and the maximum of inputs that are all zeros (i.e., -inf in log-space)
+    # never yields NaNs when it is subtracted
+    max_xs = [
+        torch.clamp(
+            torch.amax(xi.real, dim=-1, keepdim=True),
+            min=torch.finfo(xi.real.dtype).min,
+            max=torch.finfo(xi.real.dtype).max,
+        )
+        for xi in xs
+    ]
+    y = xs[0] - max_xs[0]
+    for xi, max_xi in zip(xs[1:], max_xs[1:]):
+        y = (y.unsqueeze(dim=-1) + (xi - max_xi).unsqueeze(dim=-2)).flatten(start_dim=-2)
+    return y, functools.reduce(torch.add, max_xs)
+
+
+def _log_matmul_exp_backward_chunk(
+    weight: Tensor,
+    output: Tensor,
+    grad_output: Tensor,
+    xs: Sequence[Tensor],
+    *,
+    needs_weight_grad: bool,
+    needs_xs_grad: Sequence[bool],
+) -> tuple[Tensor | None, list[Tensor | None]]:
+    # Compute the gradients of the weights and of the inputs on a chunk of batch elements,
+    # where the weights have either the batch size of the chunk or a batch size of one
+    log_x, max_x = _shifted_log_kron(xs)
+    exp_x = torch.exp_(log_x)
+    # The gradients of the maximum cancel out, as the output is invariant to the shift.
+    # Similarly to the safe logarithm, the gradients of the logarithm of zeros are set
+    # to the largest representable value rather than being undefined
+    y = torch.exp(output - max_x)
+    grad_y = torch.nan_to_num(grad_output / y.conj())
+    del y
+    grad_weight: Tensor | None = None
+    if needs_weight_grad:
+        grad_weight = (
+            torch.einsum("fbo,fbi->fboi", grad_y, exp_x.conj())
+            if weight.shape[1] != 1
+            else torch.einsum("fbo,fbi->foi", grad_y, exp_x.conj()).unsqueeze(dim=1)
+        )
+    grad_xs: list[Tensor | None] = [None] * len(xs)
+    if not any(needs_xs_grad):
+        return grad_weight, grad_xs
+    # grad_x: (F, C, I) -> (F, C, I_1, ..., I_H)
+    grad_x = torch.einsum("fbo,fboi->fbi", grad_y, weight.conj())
+    # Inputs whose exponentials underflow to zero get zero gradients rather than NaNs
+    grad_x = torch.nan_to_num(grad_x.mul_(exp_x.conj()))
+    grad_x = grad_x.unflatten(-1, tuple(xi.shape[-1] for xi in xs))
+    for h, needs_grad in enumerate(needs_xs_grad):
+        if not needs_grad:
+            continue
+        dims = tuple(d + 2 for d in range(len(xs)) if d != h)
+        grad_xs[h] = grad_x.sum(dim=dims) if dims else grad_x
+    return grad_weight, grad_xs
+
+
+# pylint: disable-next=abstract-method
+class LogMatMulExp(autograd.Function):
+    """The autograd function computing the logarithm of the weighted sums of exponentiated
+    inputs by chunks of batch elements. See
+    [log_matmul_exp][cirkit.backend.torch.utils.log_matmul_exp] for details."""
+
+    @staticmethod
+    def forward(  # pylint: disable=arguments-differ
+        weight: Tensor, max_numel: int, *xs: Tensor
+    ) -> Tensor:
+        num_folds, batch_size, num_inputs = xs[0].shape[0], xs[0].shape[1], weight.shape[-1]
+        chunk_size = max(1, max_numel // max(num_folds * num_inputs, 1))
+        ys: list[Tensor] = []
+        for start in range(0, batch_size, chunk_size):
+            xs_c = [xi[:, start : start + chunk_size] for xi in xs]
+            weight_c = weight if weight.shape[1] == 1 else weight[:, start : start + chunk_size]
+            # exp_x: (F, C, I)
+            log_x, max_x = _shifted_log_kron(xs_c)
+            exp_x = torch.exp_(log_x)
+            # y: (F, C, K_o)
+            y = torch.einsum("fbi,fboi->fbo", exp_x, weight_c)
+            del exp_x
+            ys.append(torch.log_(y).add_(max_x))
+        return ys[0] if len(ys) == 1 else torch.cat(ys, dim=1)
+
+    @staticmethod
+    def setup_context(  # pylint: disable=arguments-differ
+        ctx: Any, inputs: tuple[Any, ...], output: Tensor
+    ) -> None:
+        weight, max_numel, *xs = inputs
+        ctx.max_numel = max_numel
+        ctx.save_for_backward(weight, output, *xs)
+
+    @staticmethod
+    def backward(  # pylint: disable=arguments-differ
+        ctx: Any, grad_output: Tensor
+    ) -> tuple[Tensor | None, ...]:
+        weight, output, *xs = ctx.saved_tensors
+        needs_weight_grad, _, *needs_xs_grad = ctx.needs_input_grad
+        num_folds, batch_size, num_inputs = xs[0].shape[0], xs[0].shape[1], weight.shape[-1]
+        chunk_size = max(1, ctx.max_numel // max(num_folds * num_inputs, 1))
+        weight_batched = weight.shape[1] != 1
+        grad_weight_cs: list[Tensor] = []
+        grad_xs_cs: list[list[Tensor]] = [[] for _ in xs]
+        for start in range(0, batch_size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            grad_weight_c, grad_xs_c = _log_matmul_exp_backward_chunk(
+                weight[:, chunk] if weight_batched else weight,
+                output[:, chunk],
+                grad_output[:, chunk],
+                [xi[:, chunk] for xi in xs],
+                needs_weight_grad=needs_weight_grad,
+                needs_xs_grad=needs_xs_grad,
+            )
+            if grad_weight_c is not None:
+                grad_weight_cs.append(grad_weight_c)
+            for grad_xi_cs, grad_xi_c in zip(grad_xs_cs, grad_xs_c):
+                if grad_xi_c is not None:
+                    grad_xi_cs.append(grad_xi_c)
+        grad_weight: Tensor | None = None
+        if needs_weight_grad:
+            grad_weight = (
+                torch.cat(grad_weight_cs, dim=1)
+                if weight_batched
+                else functools.reduce(torch.add, grad_weight_cs)
+            )
+        grad_xs = tuple(
+            torch.cat(grad_xi_cs, dim=1) if needs_grad else None
+            for grad_xi_cs, needs_grad in zip(grad_xs_cs, needs_xs_grad)
+        )
+        return grad_weight, None, *grad_xs
+
+
 class GateFunction(Protocol):
     def __call__(
         self, shape: tuple[int, ...], *args: list[Any], **kwargs: Mapping[str, Any]
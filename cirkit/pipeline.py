@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
 from contextlib import AbstractContextManager
 from contextvars import ContextVar, Token
 from types import TracebackType
@@ -26,21 +28,37 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
     A pipeline context can also be used to register compilation rules for user-defined
     layers, parameterizations and initialization methods. Furthermore, new layer operators
     can be added to the context.
+
+    The compiled circuits resulting from circuit operations (e.g., multiplying two compiled
+    circuits and integrating the result) are cached, such that repeating the same operations on
+    the same compiled circuits returns the previously compiled circuits, i.e., without
+    re-applying the symbolic operators and re-compiling. Since they are the same objects, the
+    cached circuits keep sharing the parameters of the circuits they have been obtained from.
     """
 
-    def __init__(self, backend: str = "torch", **backend_kwargs: Any) -> None:
+    def __init__(
+        self, backend: str = "torch", *, operation_cache_size: int = 128, **backend_kwargs: Any
+    ) -> None:
         """Initialzes a pipeline context, given the compilation backend and
             the compilation flags.
 
         Args:
             backend: The compilation backend.  The only backend supported is 'torch'.
+            operation_cache_size: The maximum number of compiled circuits resulting from circuit
+                operations to cache, where the least recently used ones are evicted first.
+                If it is 0, then the results of circuit operations are not cached.
             backend_kwargs: The compilation flags to pass to the compiler.
 
         Raises:
             ValuerError: if the compilation backend is unknown.
+            ValueError: if the operation cache size is negative.
         """
         if backend not in SUPPORTED_BACKENDS:
             raise NotImplementedError(f"Backend '{backend}' is not implemented")
+        if operation_cache_size < 0:
+            raise ValueError(
+                f"The operation cache size must be non-negative, but found {operation_cache_size}"
+            )
         # Backend specs
         self._backend = backend
         self._backend_kwargs = backend_kwargs
@@ -54,6 +72,11 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
         # The token used to restore the pipeline context
         self._token: Token[PipelineContext[CompiledCircuitT]] | None = None
 
+        # The LRU cache of the compiled circuits resulting from circuit operations, which are
+        # indexed by the operation name, the compiled operand circuits and the operation arguments
+        self._operation_cache_size = operation_cache_size
+        self._operation_cache: OrderedDict[Hashable, CompiledCircuitT] = OrderedDict()
+
     @classmethod
     def from_default_backend(cls) -> "PipelineContext[CompiledCircuitT]":
         """Construts a pipeline context from the default backend.
@@ -107,6 +130,7 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
             func: The layer operator implementation.
         """
         self._op_registry.add_rule(op, func)
+        self.clear_operation_cache()
 
     def add_layer_compilation_rule(self, func: LayerCompilationFunc) -> None:
         """Add a new layer compilation rule to the current compilation backend.
@@ -115,6 +139,7 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
             func: The layer compilation rule.
         """
         self._compiler.add_layer_rule(func)
+        self.clear_operation_cache()
 
     def add_parameter_compilation_rule(self, func: ParameterCompilationFunc) -> None:
         """Add a new parameter compilation rule to the current compilation backend.
@@ -123,6 +148,7 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
             func: The parameter compilation rule.
         """
         self._compiler.add_parameter_rule(func)
+        self.clear_operation_cache()
 
     def add_initializer_compilation_rule(self, func: InitializerCompilationFunc) -> None:
         """Add a new initialization method compilation rule to the current compilation backend.
@@ -131,6 +157,7 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
             func: The initializer compilation rule.
         """
         self._compiler.add_initializer_rule(func)
+        self.clear_operation_cache()
 
     def compile(self, sc: Circuit) -> CompiledCircuitT:
         """Compile a symbolic circuit.
@@ -197,6 +224,7 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
                 an object of type [torch.nn.Module][torch.nn.Module].
         """
         self._compiler.add_gate_function(name, function)
+        self.clear_operation_cache()
 
     def get_gate_function(self, name: str) -> GateFunction:
         """Retrieves the gate function by its name.
@@ -209,6 +237,29 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
         """
         return self._compiler.get_gate_function(name)
 
+    def clear_operation_cache(self) -> None:
+        """Clear the cache of the compiled circuits resulting from circuit operations.
+        This is done automatically whenever new operators, compilation rules or gate functions
+        are added to the context, as they might change the results of the operations.
+        """
+        self._operation_cache.clear()
+
+    def _cached_operation(
+        self, key: Hashable, operation: Callable[[], CompiledCircuitT]
+    ) -> CompiledCircuitT:
+        # Retrieve the compiled circuit resulting from an operation, if it is cached,
+        # otherwise apply the operation and cache its result
+        cc = self._operation_cache.get(key)
+        if cc is not None:
+            self._operation_cache.move_to_end(key)
+            return cc
+        cc = operation()
+        if self._operation_cache_size:
+            self._operation_cache[key] = cc
+            if len(self._operation_cache) > self._operation_cache_size:
+                self._operation_cache.popitem(last=False)
+        return cc
+
     def concatenate(self, *cc: CompiledCircuitT) -> CompiledCircuitT:
         """Circuit concatenation interface for compiled circuits.
             See [concantenate][cirkit.symbolic.functional.concatenate] for more details.
@@ -225,9 +276,15 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
         for i, cci in enumerate(cc):
             if not self._compiler.has_symbolic(cci):
                 raise ValueError(f"The {i}-th given compiled circuit is not known in this pipeline")
-        sc = [self._compiler.get_symbolic_circuit(cci) for cci in cc]
-        cat_sc = SF.concatenate(sc, registry=self._op_registry)
-        return self.compile(cat_sc)
+        return self._cached_operation(
+            ("concatenate", cc),
+            lambda: self.compile(
+                SF.concatenate(
+                    [self._compiler.get_symbolic_circuit(cci) for cci in cc],
+                    registry=self._op_registry,
+                )
+            ),
+        )
 
     def integrate(self, cc: CompiledCircuitT, scope: Scope | None = None) -> CompiledCircuitT:
         """Circuit integration interface for compiled circuits.
@@ -247,8 +304,10 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
         if not self._compiler.has_symbolic(cc):
             raise ValueError("The given compiled circuit is not known in this pipeline")
         sc = self._compiler.get_symbolic_circuit(cc)
-        int_sc = SF.integrate(sc, scope=scope, registry=self._op_registry)
-        return self.compile(int_sc)
+        return self._cached_operation(
+            ("integrate", cc, scope),
+            lambda: self.compile(SF.integrate(sc, scope=scope, registry=self._op_registry)),
+        )
 
     def multiply(self, cc1: CompiledCircuitT, cc2: CompiledCircuitT) -> CompiledCircuitT:
         """Circuit multiplication interface for compiled circuits.
@@ -270,8 +329,10 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
             raise ValueError("The second compiled circuit is not known in this pipeline")
         sc1 = self._compiler.get_symbolic_circuit(cc1)
         sc2 = self._compiler.get_symbolic_circuit(cc2)
-        prod_sc = SF.multiply(sc1, sc2, registry=self._op_registry)
-        return self.compile(prod_sc)
+        return self._cached_operation(
+            ("multiply", cc1, cc2),
+            lambda: self.compile(SF.multiply(sc1, sc2, registry=self._op_registry)),
+        )
 
     def differentiate(self, cc: CompiledCircuitT, *, order: int = 1) -> CompiledCircuitT:
         """Circuit differentiation interface for compiled circuits.
@@ -293,8 +354,10 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
         if order <= 0:
             raise ValueError("The order of differentiation must be positive.")
         sc = self._compiler.get_symbolic_circuit(cc)
-        diff_sc = SF.differentiate(sc, order=order, registry=self._op_registry)
-        return self.compile(diff_sc)
+        return self._cached_operation(
+            ("differentiate", cc, order),
+            lambda: self.compile(SF.differentiate(sc, order=order, registry=self._op_registry)),
+        )
 
     def conjugate(self, cc: CompiledCircuitT) -> CompiledCircuitT:
         """Circuit conjugation interface for compiled circuits.
@@ -312,8 +375,9 @@ class PipelineContext(AbstractContextManager, Generic[CompiledCircuitT]):
         if not self._compiler.has_symbolic(cc):
             raise ValueError("The given compiled circuit is not known in this pipeline")
         sc = self._compiler.get_symbolic_circuit(cc)
-        conj_sc = SF.conjugate(sc, registry=self._op_registry)
-        return self.compile(conj_sc)
+        return self._cached_operation(
+            ("conjugate", cc), lambda: self.compile(SF.conjugate(sc, registry=self._op_registry))
+        )
 
 
 # pylint: disable-next=redefined-builtin
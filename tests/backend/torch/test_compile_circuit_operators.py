@@ -11,6 +11,7 @@ from cirkit.backend.torch.circuits import TorchCircuit
 from cirkit.backend.torch.compiler import TorchCompiler
 from cirkit.backend.torch.layers.input import TorchEvidenceLayer
 from cirkit.backend.torch.semiring import SumProductSemiring
+from cirkit.pipeline import PipelineContext
 from cirkit.symbolic import functional as SF
 from cirkit.symbolic.layers import PolynomialLayer
 from cirkit.utils.scope import Scope
@@ -108,6 +109,50 @@ def test_compile_product_integrate_pc_categorical_hadamard(
     assert allclose(compiler.semiring.prod(each_tc_scores, dim=0), scores)
 
 
+@pytest.mark.parametrize("fold,optimize", itertools.product([False, True], [False, True]))
+def test_pipeline_cached_product_integrate_pc_categorical(fold: bool, optimize: bool):
+    ctx = PipelineContext(backend="torch", semiring="lse-sum", fold=fold, optimize=optimize)
+    sc1 = build_multivariate_monotonic_structured_cpt_pc(
+        num_units=2, input_layer="bernoulli", product_layer="hadamard"
+    )
+    sc2 = build_multivariate_monotonic_structured_cpt_pc(
+        num_units=3, input_layer="bernoulli", product_layer="hadamard"
+    )
+    tc1, tc2 = ctx.compile(sc1), ctx.compile(sc2)
+
+    # Repeating the same operations on the same circuits gives the cached compiled circuits
+    int_tc = ctx.integrate(ctx.multiply(tc1, tc2))
+    assert ctx.multiply(tc1, tc2) is ctx.multiply(tc1, tc2)
+    assert ctx.integrate(ctx.multiply(tc1, tc2)) is int_tc
+    assert ctx.multiply(tc2, tc1) is not ctx.multiply(tc1, tc2)
+    assert ctx.integrate(ctx.multiply(tc1, tc2), scope=Scope([0])) is not int_tc
+
+    # The cached circuits share the parameters of the operand circuits
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc1.num_variables)))
+    with torch.no_grad():
+        for p in tc1.parameters():
+            p.mul_(0.5)
+    int_scores = torch.logsumexp(tc1(worlds) + tc2(worlds), dim=0)
+    assert allclose(ctx.integrate(ctx.multiply(tc1, tc2))(), int_scores)
+
+    # The least recently used circuits are evicted, and the cache is cleared whenever
+    # the operations or the compilation rules might change
+    ctx = PipelineContext(backend="torch", semiring="lse-sum", operation_cache_size=1)
+    tc1, tc2 = ctx.compile(sc1), ctx.compile(sc2)
+    prod_tc = ctx.multiply(tc1, tc2)
+    assert ctx.multiply(tc1, tc2) is prod_tc
+    ctx.multiply(tc2, tc1)
+    assert ctx.multiply(tc1, tc2) is not prod_tc
+    prod_tc = ctx.multiply(tc1, tc2)
+    ctx.add_gate_function("f", lambda x: x)
+    assert ctx.multiply(tc1, tc2) is not prod_tc
+
+    # The results of the operations are not cached, if the cache size is zero
+    ctx = PipelineContext(backend="torch", semiring="lse-sum", operation_cache_size=0)
+    tc1, tc2 = ctx.compile(sc1), ctx.compile(sc2)
+    assert ctx.multiply(tc1, tc2) is not ctx.multiply(tc1, tc2)
+
+
 @pytest.mark.parametrize(
     "semiring,fold,optimize,normalized,num_products",
     itertools.product(["sum-product", "lse-sum"], [False, True], [False, True], [False, True], [2]),
@@ -0,0 +1,54 @@
+import itertools
+import weakref
+
+import pytest
+import torch
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.cost import estimate_cost, estimate_flops
+from cirkit.backend.torch.layers import TorchInputLayer
+from tests.backend.torch.test_evaluation import build_image_circuit
+
+
+@pytest.mark.parametrize(
+    "semiring,optimize", itertools.product(["lse-sum", "complex-lse-sum"], [False, True])
+)
+def test_estimate_cost(semiring: str, optimize: bool):
+    compiler = TorchCompiler(semiring=semiring, fold=True, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(build_image_circuit())
+    x = torch.randint(256, size=(16, tc.num_variables))
+    cost = estimate_cost(tc, batch_size=16)
+    layers = [entry.module for entry in tc.address_book if entry.module is not None]
+    assert len(cost.layers) == len(layers)
+    assert cost.flops == sum(estimate_flops(l, 16) for l in layers)
+    assert cost.param_bytes == sum(p.numel() * p.element_size() for p in tc.parameters())
+    assert cost.param_bytes == sum(c.param_bytes for c in cost.layers)
+
+    # Measure the bytes of the activations being alive while evaluating each layer
+    outputs: list[weakref.ref] = []
+    live_bytes: list[int] = []
+
+    def _num_bytes(t: torch.Tensor) -> int:
+        return t.numel() * t.element_size()
+
+    def _layer_fn(layer, *inputs):
+        y = layer(*inputs)
+        step_bytes = sum(_num_bytes(o()) for o in outputs if o() is not None) + _num_bytes(y)
+        if not isinstance(layer, TorchInputLayer):
+            step_bytes += sum(_num_bytes(x) for x in inputs if x._base is None)
+        live_bytes.append(step_bytes)
+        outputs.append(weakref.ref(y))
+        return y
+
+    y = tc.evaluate(x, module_fn=_layer_fn)
+    assert cost.output_bytes == _num_bytes(y)
+    live_bytes.append(sum(_num_bytes(o()) for o in outputs if o() is not None) + _num_bytes(y))
+    assert [c.live_bytes for c in cost.layers] == live_bytes[:-1]
+    assert cost.peak_activation_bytes == max(live_bytes)
+    assert live_bytes[cost.peak_entry_id] == max(live_bytes)
+
+    # The activation bytes scale linearly with the batch size
+    assert estimate_cost(tc, batch_size=32).peak_activation_bytes == 2 * cost.peak_activation_bytes
+    with pytest.raises(ValueError):
+        estimate_cost(tc, batch_size=0)
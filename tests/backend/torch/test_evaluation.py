@@ -0,0 +1,283 @@
+import functools
+import itertools
+import threading
+import weakref
+
+import pytest
+import torch
+
+import cirkit.symbolic.functional as SF
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.codegen import generate_graph_module
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.parameters.nodes import TorchTensorParameter
+from cirkit.backend.torch.parameters.parameter import TorchParameter
+from cirkit.pipeline import PipelineContext
+from cirkit.templates import data_modalities, utils
+from tests.backend.torch.test_queries.test_map import build_deterministic_categorical_mixture
+from tests.floats import allclose
+
+
+def build_image_circuit(num_units: int = 8) -> TorchCircuit:
+    return data_modalities.image_data(
+        (1, 8, 8),
+        region_graph="quad-graph",
+        input_layer="categorical",
+        num_input_units=num_units,
+        sum_product_layer="cp",
+        num_sum_units=num_units,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+
+
+@pytest.mark.parametrize("fold,optimize", itertools.product([False, True], [False, True]))
+def test_evaluate_releases_intermediate_outputs(fold: bool, optimize: bool):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(build_image_circuit())
+    x = torch.randint(256, size=(16, tc.num_variables))
+
+    # Keep track of the outputs that are still alive while evaluating each layer
+    outputs: list[weakref.ref] = []
+    num_alive: list[int] = []
+
+    def _layer_fn(layer, *inputs):
+        num_alive.append(sum(o() is not None for o in outputs))
+        y = layer(*inputs)
+        outputs.append(weakref.ref(y))
+        return y
+
+    y = tc.evaluate(x, module_fn=_layer_fn)
+    assert allclose(y.transpose(0, 1), tc(x))
+
+    # The outputs of each layer must be released after their last use
+    book = tc.address_book
+    assert len(book.last_use) == len(book) - 1
+    assert all(i < l for i, l in enumerate(book.last_use))
+    assert max(num_alive) < len(outputs)
+    for mid, last_use in enumerate(book.last_use):
+        if last_use < len(book) - 1:
+            assert outputs[mid]() is None
+
+
+def test_evaluate_releases_intermediate_outputs_with_autograd():
+    compiler = TorchCompiler(semiring="lse-sum", fold=True, optimize=True)
+    tc: TorchCircuit = compiler.compile(build_image_circuit())
+    x = torch.randint(256, size=(16, tc.num_variables))
+    with torch.enable_grad():
+        y = tc(x)
+        y.sum().backward()
+    assert all(p.grad is not None for p in tc.parameters())
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize",
+    itertools.product(["sum-product", "lse-sum", "complex-lse-sum"], [False, True], [False, True]),
+)
+def test_evaluate_arena_plan(semiring: str, fold: bool, optimize: bool):
+    sc = build_image_circuit()
+    tc: TorchCircuit = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize).compile(sc)
+    arena_tc: TorchCircuit = TorchCompiler(
+        semiring=semiring, fold=fold, optimize=optimize, arena=True
+    ).compile(sc)
+    arena_tc.load_state_dict(tc.state_dict())
+    plan = arena_tc.address_book.arena_plan
+    assert plan is not None
+    assert tc.address_book.arena_plan is None
+    assert len(plan.out_slots) == len(arena_tc.address_book) - 1
+    assert sum(plan.arena_num_folds) == sum(
+        arena_tc.address_book._fold_idx_info.ordering[mid].num_folds
+        for mid, slot in enumerate(plan.out_slots)
+        if slot is not None
+    )
+    x = torch.randint(256, size=(16, tc.num_variables))
+    assert allclose(arena_tc(x), tc(x))
+    with torch.enable_grad():
+        y = arena_tc(x)
+    assert allclose(y, tc(x))
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize",
+    itertools.product(["sum-product", "lse-sum", "complex-lse-sum"], [False, True], [False, True]),
+)
+def test_evaluate_generated_code(semiring: str, fold: bool, optimize: bool):
+    sc = build_image_circuit()
+    tc: TorchCircuit = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize).compile(sc)
+    gen_tc: TorchCircuit = TorchCompiler(
+        semiring=semiring, fold=fold, optimize=optimize, codegen=True
+    ).compile(sc)
+    gen_tc.load_state_dict(tc.state_dict())
+    assert tc.generated_code is None
+    assert gen_tc.generated_code is not None
+    assert "address_book" in gen_tc.generated_code
+    x = torch.randint(256, size=(16, tc.num_variables))
+    assert allclose(gen_tc(x), tc(x))
+    assert allclose(generate_graph_module(tc)(x), tc(x))
+
+    # The generated code must be differentiable as the circuit is
+    with torch.enable_grad():
+        tc(x).real.sum().backward()
+        gen_tc(x).real.sum().backward()
+    for p, gen_p in zip(tc.parameters(), gen_tc.parameters()):
+        assert allclose(p.grad, gen_p.grad)
+
+
+@pytest.mark.parametrize("semiring", ["sum-product", "lse-sum"])
+def test_evaluate_generated_code_empty_scope(semiring: str):
+    sc = SF.integrate(build_image_circuit())
+    tc: TorchCircuit = TorchCompiler(semiring=semiring, fold=True, optimize=True).compile(sc)
+    gen_tc: TorchCircuit = TorchCompiler(
+        semiring=semiring, fold=True, optimize=True, codegen=True
+    ).compile(sc)
+    gen_tc.load_state_dict(tc.state_dict())
+    assert gen_tc.generated_code is not None
+    assert gen_tc().shape == tc().shape
+    assert allclose(gen_tc(), tc())
+
+
+@pytest.mark.parametrize("fold,optimize", itertools.product([False, True], [False, True]))
+def test_evaluate_chunks(fold: bool, optimize: bool):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(build_image_circuit())
+    x = torch.randint(256, size=(13, tc.num_variables))
+
+    # Count the number of times the parameter tensors are evaluated
+    num_calls: list[int] = []
+    for m in tc.modules():
+        if isinstance(m, TorchTensorParameter):
+            m.register_forward_hook(lambda *_: num_calls.append(1))
+    y = tc(x)
+    num_param_calls = len(num_calls)
+    num_calls.clear()
+    chunked_y = tc(x, chunk_size=4)
+    assert chunked_y.shape == y.shape
+    assert allclose(chunked_y, y)
+    assert len(num_calls) == num_param_calls
+    assert not any(m.is_memoized for m in tc.modules() if isinstance(m, TorchParameter))
+    with pytest.raises(ValueError):
+        tc(x, chunk_size=0)
+
+
+@pytest.mark.parametrize("fold,optimize", itertools.product([False, True], [False, True]))
+def test_evaluate_chunks_conditional_circuit(fold: bool, optimize: bool):
+    sc = build_deterministic_categorical_mixture(2)
+    c_sc, gf_specs = SF.condition_circuit(sc, gate_functions={"sum": list(sc.sum_layers)})
+    ctx = PipelineContext(backend="torch", semiring="lse-sum", fold=fold, optimize=optimize)
+    for name, shape in gf_specs.items():
+        ctx.add_gate_function(
+            name, functools.partial(lambda x, shape: x.view(-1, *shape), shape=shape)
+        )
+    tc: TorchCircuit = ctx.compile(c_sc)
+
+    # The gate function inputs are chunked together with the circuit input
+    x = torch.randint(2, size=(7, 2))
+    gate_function_kwargs = {name: {"x": torch.rand(7, *shape)} for name, shape in gf_specs.items()}
+    y = tc(x, gate_function_kwargs=gate_function_kwargs)
+    chunked_y = tc(x, gate_function_kwargs=gate_function_kwargs, chunk_size=3)
+    assert chunked_y.shape == y.shape
+    assert allclose(chunked_y, y)
+
+
+@pytest.mark.parametrize(
+    "fold,optimize,every,memory_budget",
+    [
+        (fold, optimize, every, memory_budget)
+        for fold, optimize in itertools.product([False, True], [False, True])
+        for every, memory_budget in [(1, None), (3, None), (None, 4096)]
+    ],
+)
+def test_evaluate_checkpoints(fold: bool, optimize: bool, every: int, memory_budget: int):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(build_image_circuit())
+    x = torch.randint(256, size=(16, tc.num_variables))
+    cuts = tc.frontier_cuts()
+    assert cuts and cuts == sorted(cuts)
+    assert all(0 < i < len(tc.address_book) - 1 for i in cuts)
+
+    # Count the number of bytes saved by autograd for the backward pass
+    def _saved_bytes() -> tuple[torch.Tensor, int]:
+        saved_bytes: list[int] = []
+
+        def _pack_hook(t: torch.Tensor) -> torch.Tensor:
+            saved_bytes.append(t.numel() * t.element_size())
+            return t
+
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(_pack_hook, lambda t: t):
+            y = tc(x)
+        return y, sum(saved_bytes)
+
+    y, saved_bytes = _saved_bytes()
+    with torch.enable_grad():
+        y.sum().backward()
+    grads = [p.grad for p in tc.parameters()]
+    tc.zero_grad(set_to_none=True)
+
+    checkpoints = tc.checkpoint_frontiers(every=every, memory_budget=memory_budget)
+    assert set(checkpoints).issubset(cuts)
+    tc.set_checkpoints(checkpoints)
+    assert tc.checkpoints == checkpoints
+    ck_y, ck_saved_bytes = _saved_bytes()
+    with torch.enable_grad():
+        ck_y.sum().backward()
+    assert allclose(ck_y, y)
+    assert ck_saved_bytes < saved_bytes
+    for g, p in zip(grads, tc.parameters()):
+        assert allclose(p.grad, g)
+
+    # Activation checkpointing is not used if gradients are disabled
+    assert allclose(tc(x), y)
+
+
+def test_checkpoint_frontiers_invalid_arguments():
+    tc: TorchCircuit = TorchCompiler(fold=True).compile(build_image_circuit())
+    with pytest.raises(ValueError):
+        tc.checkpoint_frontiers()
+    with pytest.raises(ValueError):
+        tc.checkpoint_frontiers(every=2, memory_budget=1024)
+    with pytest.raises(ValueError):
+        tc.checkpoint_frontiers(every=0)
+    with pytest.raises(ValueError):
+        tc.checkpoint_frontiers(memory_budget=0)
+
+
+@pytest.mark.parametrize(
+    "fold,optimize,arena", itertools.product([False, True], [False, True], [False, True])
+)
+def test_evaluate_thread_pool(fold: bool, optimize: bool, arena: bool):
+    sc = build_image_circuit()
+    tc: TorchCircuit = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize).compile(sc)
+    pool_tc: TorchCircuit = TorchCompiler(
+        semiring="lse-sum", fold=fold, optimize=optimize, arena=arena
+    ).compile(sc)
+    pool_tc.load_state_dict(tc.state_dict())
+    x = torch.randint(256, size=(16, tc.num_variables))
+    y = tc(x)
+
+    num_threads = torch.get_num_threads()
+    with pool_tc.thread_pool(max_workers=4, intra_op_threads=1) as executor:
+        assert torch.get_num_threads() == 1
+        assert allclose(pool_tc(x), y)
+        # The gradient mode is propagated to the threads evaluating the layers
+        with torch.enable_grad():
+            pool_y = pool_tc(x)
+            pool_y.sum().backward()
+        assert pool_y.requires_grad
+        assert allclose(pool_y, y)
+        assert all(p.grad is not None for p in pool_tc.parameters())
+
+        # The layers are submitted to the thread pool
+        submitted: list[int] = []
+
+        def _layer_fn(layer, *inputs):
+            submitted.append(threading.get_ident())
+            return layer(*inputs)
+
+        pool_y = pool_tc.evaluate(x, module_fn=_layer_fn, executor=executor)
+        assert allclose(pool_y.transpose(0, 1), y)
+        assert len(submitted) == len(pool_tc.address_book) - 1
+        assert threading.get_ident() not in submitted
+    assert torch.get_num_threads() == num_threads
+
+    with pytest.raises(ValueError):
+        with pool_tc.thread_pool(max_workers=0):
+            pass
@@ -0,0 +1,65 @@
+import itertools
+import json
+
+import pytest
+import torch
+
+from cirkit.backend.torch import profile
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.cost import estimate_flops
+from cirkit.backend.torch.layers import TorchInnerLayer
+from tests.backend.torch.test_evaluation import build_image_circuit
+from tests.floats import allclose
+
+
+@pytest.mark.parametrize(
+    "fold,optimize,codegen", itertools.product([False, True], [False, True], [False, True])
+)
+def test_profile_circuit(fold: bool, optimize: bool, codegen: bool, tmp_path):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize, codegen=codegen)
+    tc: TorchCircuit = compiler.compile(build_image_circuit())
+    x = torch.randint(256, size=(16, tc.num_variables))
+    y = tc(x)
+    with profile(tc) as prof:
+        with torch.enable_grad():
+            prof_y = tc(x)
+            prof_y.sum().backward()
+    assert allclose(prof_y, y)
+    assert (tc.generated_forward is not None) == codegen
+
+    # Every layer is recorded once in the forward pass, and the layers having parameters
+    # or differentiable inputs are recorded once in the backward pass
+    layers = [entry.module for entry in tc.address_book if entry.module is not None]
+    forward_events = [e for e in prof.events if e.phase == "forward"]
+    backward_events = [e for e in prof.events if e.phase == "backward"]
+    assert sorted(e.entry_id for e in forward_events) == list(range(len(layers)))
+    assert sorted(e.entry_id for e in backward_events) == [
+        i
+        for i, layer in enumerate(layers)
+        if isinstance(layer, TorchInnerLayer) or list(layer.parameters())
+    ]
+    for e in forward_events:
+        layer = layers[e.entry_id]
+        assert e.output_shape == (layer.num_folds, 16, layer.num_output_units)
+        assert e.num_folds == layer.num_folds
+        assert e.flops == estimate_flops(layer, 16)
+        assert e.duration_ns >= 0 and e.allocated_bytes > 0
+    stats = prof.stats()
+    assert len(stats) == len(layers)
+    assert all(s.num_calls == 1 and s.total_ns == s.forward_ns + s.backward_ns for s in stats)
+
+    # The events are not recorded outside the context
+    tc(x)
+    assert len(prof.events) == len(forward_events) + len(backward_events)
+
+    table = prof.table("forward_time", limit=3)
+    assert len(table.splitlines()) == 5
+    with pytest.raises(ValueError):
+        prof.table("unknown")
+    trace_path = tmp_path / "trace.json"
+    prof.export_chrome_trace(trace_path)
+    with open(trace_path, encoding="utf-8") as f:
+        trace = json.load(f)
+    assert len(trace["traceEvents"]) == len(prof.events)
+    assert {e["cat"] for e in trace["traceEvents"]} == {"forward", "backward"}
@@ -0,0 +1,106 @@
+import itertools
+
+import pytest
+import torch
+
+import cirkit.symbolic.functional as SF
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.queries import ConditionalQuery, IntegrateQuery
+from cirkit.backend.torch.semiring import LSESumSemiring, SumProductSemiring
+from cirkit.pipeline import PipelineContext
+from cirkit.utils.scope import Scope
+from tests.floats import allclose
+from tests.symbolic.test_utils import build_monotonic_structured_categorical_cpt_pc
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize,input_tensor,chunk_size",
+    itertools.product(
+        ["lse-sum", "sum-product"], [False, True], [False, True], [False, True], [None, 5]
+    ),
+)
+def test_query_conditional_monotonic_pc_categorical(
+    semiring: str, fold: bool, optimize: bool, input_tensor: bool, chunk_size: int | None
+):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+    semiring_cls = LSESumSemiring if semiring == "lse-sum" else SumProductSemiring
+
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    if input_tensor:
+        mask = torch.rand(worlds.shape) < 0.5
+    else:
+        mask = Scope([1, 4])
+    cond_query = ConditionalQuery(tc)
+    cond_scores = cond_query(worlds, target_vars=mask, chunk_size=chunk_size)
+    assert cond_scores.shape == (len(worlds), 1, 1)
+
+    # The conditional log-probabilities are the differences between the joint and
+    # the marginal log-probabilities
+    log_scores = LSESumSemiring.map_from(tc(worlds), semiring_cls)
+    mar_scores = IntegrateQuery(tc)(worlds, integrate_vars=mask)
+    log_mar_scores = LSESumSemiring.map_from(mar_scores, semiring_cls)
+    assert allclose(cond_scores, log_scores - log_mar_scores)
+
+
+@pytest.mark.parametrize("fold,optimize", itertools.product([False, True], [False, True]))
+def test_query_conditional_normalized_monotonic_pc_categorical(fold: bool, optimize: bool):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+
+    # The conditional distribution of the target variables sums up to one
+    # for each assignment to the other variables
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    cond_scores = ConditionalQuery(tc)(worlds, target_vars=Scope([0, 3]))
+    cond_scores = cond_scores.view(2, 2, 2, 2, 2).permute(1, 2, 4, 0, 3).reshape(8, 4)
+    assert allclose(torch.logsumexp(cond_scores, dim=1), torch.zeros(8))
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize,chunk_size",
+    itertools.product(["lse-sum", "sum-product"], [False, True], [False, True], [None, 5]),
+)
+def test_query_conditional_conditional_circuit(
+    semiring: str, fold: bool, optimize: bool, chunk_size: int | None
+):
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    c_sc, gf_specs = SF.condition_circuit(sc, gate_functions={"sum": list(sc.sum_layers)})
+    ctx = PipelineContext(backend="torch", semiring=semiring, fold=fold, optimize=optimize)
+    for gate_function_id, shape in gf_specs.items():
+        ctx.add_gate_function(gate_function_id, lambda x, shape=shape: x.view(-1, *shape))
+    tc: TorchCircuit = ctx.compile(c_sc)
+    semiring_cls = LSESumSemiring if semiring == "lse-sum" else SumProductSemiring
+
+    # The batched arguments of the gate functions are shared by the joint and the marginal
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    gate_function_kwargs = {
+        gate_function_id: {"x": torch.rand(len(worlds), *shape)}
+        for gate_function_id, shape in gf_specs.items()
+    }
+    cond_scores = ConditionalQuery(tc)(
+        worlds,
+        target_vars=Scope([1, 4]),
+        gate_function_kwargs=gate_function_kwargs,
+        chunk_size=chunk_size,
+    )
+    log_scores = LSESumSemiring.map_from(
+        tc(worlds, gate_function_kwargs=gate_function_kwargs), semiring_cls
+    )
+    mar_scores = IntegrateQuery(tc)(
+        worlds, integrate_vars=Scope([1, 4]), gate_function_kwargs=gate_function_kwargs
+    )
+    log_mar_scores = LSESumSemiring.map_from(mar_scores, semiring_cls)
+    assert allclose(cond_scores, log_scores - log_mar_scores)
+
+
+def test_query_conditional_fails_on_wrong_batch_size():
+    compiler = TorchCompiler(semiring="lse-sum", fold=True, optimize=True)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    with pytest.raises(ValueError):
+        ConditionalQuery(tc)(worlds, target_vars=[Scope([0]), Scope([1])])
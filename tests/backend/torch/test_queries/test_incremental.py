@@ -0,0 +1,81 @@
+import itertools
+
+import pytest
+import torch
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.queries import IncrementalQuery
+from cirkit.templates import data_modalities, utils
+from tests.floats import allclose
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize,sum_product_layer",
+    itertools.product(
+        ["lse-sum", "sum-product"], [False, True], [False, True], ["cp", "cp-t", "tucker"]
+    ),
+)
+def test_query_incremental_image_data(
+    semiring: str, fold: bool, optimize: bool, sum_product_layer: str
+):
+    sc = data_modalities.image_data(
+        (1, 4, 4),
+        region_graph="quad-graph",
+        input_layer="categorical",
+        num_input_units=3,
+        sum_product_layer=sum_product_layer,
+        num_sum_units=3,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(sc)
+
+    query = IncrementalQuery(tc)
+    x = torch.randint(256, size=(3, tc.num_variables))
+    assert allclose(query(x), tc(x))
+    for i in range(4):
+        # Change the values of a few variables, which are either given or found
+        changed_vars = torch.randint(tc.num_variables, size=(2,))
+        x = x.clone()
+        x[:, changed_vars] = torch.randint(256, size=(3, 2))
+        scores = query(x, changed_vars=changed_vars) if i % 2 else query(x)
+        assert allclose(scores, tc(x))
+
+    # Changing the parameters or the batch size triggers a full evaluation
+    with torch.no_grad():
+        for p in tc.parameters():
+            p.mul_(0.5)
+    assert allclose(query(x), tc(x))
+    assert allclose(query(x[:2]), tc(x[:2]))
+
+
+def test_query_incremental_evaluates_dirty_folds_only():
+    sc = data_modalities.image_data(
+        (1, 8, 8),
+        region_graph="quad-tree-4",
+        input_layer="categorical",
+        num_input_units=2,
+        sum_product_layer="cp",
+        num_sum_units=2,
+    )
+    compiler = TorchCompiler(semiring="lse-sum", fold=True, optimize=True)
+    tc: TorchCircuit = compiler.compile(sc)
+    query = IncrementalQuery(tc)
+    x = torch.randint(256, size=(2, tc.num_variables))
+    query(x)
+
+    # Only the folds on the path from the changed variable to the output are re-evaluated
+    num_folds = []
+    for layer in tc.layers:
+        select_folds = layer.select_folds
+
+        def _select_folds(fold_idx, *, params=None, select_folds=select_folds):
+            num_folds.append(len(fold_idx))
+            return select_folds(fold_idx, params=params)
+
+        layer.select_folds = _select_folds
+    x = x.clone()
+    x[:, 5] = (x[:, 5] + 1) % 256
+    assert allclose(query(x, changed_vars=[5]), tc(x))
+    assert 0 < sum(num_folds) < sum(layer.num_folds for layer in tc.layers) // 4
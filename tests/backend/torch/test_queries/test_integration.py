@@ -6,7 +6,10 @@ import torch
 import cirkit.symbolic.functional as SF
 from cirkit.backend.torch.circuits import TorchCircuit
 from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.layers import TorchInputLayer
 from cirkit.backend.torch.queries import IntegrateQuery
+from cirkit.templates import utils
+from cirkit.templates.region_graph import RandomBinaryTree
 from cirkit.utils.scope import Scope
 from tests.floats import allclose
 from tests.symbolic.test_utils import build_monotonic_structured_categorical_cpt_pc
@@ -239,3 +242,188 @@ def test_marginalize_batch_fails_on_wrong_tensor_dtype(
     # The second score, should be our precomputed marginal.
     with pytest.raises(ValueError, match="Expected dtype of tensor to be torch.bool"):
         mar_scores = mar_query(inputs, integrate_vars=mask)
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize,input_tensor",
+    itertools.product(["lse-sum", "sum-product"], [False, True], [False, True], [False, True]),
+)
+def test_query_marginalize_chunks_monotonic_pc_categorical(
+    semiring: str, fold: bool, optimize: bool, input_tensor: bool
+):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    if input_tensor:
+        mask = torch.rand(worlds.shape) < 0.5
+    else:
+        mask = Scope([1, 4])
+    mar_query = IntegrateQuery(tc)
+    mar_scores = mar_query(worlds, integrate_vars=mask)
+    chunked_mar_scores = mar_query(worlds, integrate_vars=mask, chunk_size=5)
+    assert chunked_mar_scores.shape == mar_scores.shape
+    assert allclose(chunked_mar_scores, mar_scores)
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize",
+    itertools.product(["lse-sum", "sum-product"], [False, True], [False, True]),
+)
+def test_query_marginalize_shared_mask_monotonic_pc_categorical(
+    semiring: str, fold: bool, optimize: bool, monkeypatch: pytest.MonkeyPatch
+):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+
+    # The same variables are integrated for all the batch elements, which gives the same
+    # result as integrating them by using a mask for each batch element
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    mar_query = IntegrateQuery(tc)
+    mar_scores = mar_query(worlds, integrate_vars=Scope([1, 4]))
+    mask = torch.zeros(worlds.shape, dtype=torch.bool)
+    mask[:, [1, 4]] = True
+    assert allclose(mar_scores, mar_query(worlds, integrate_vars=mask))
+
+    # If all the variables are integrated, then the input layers are not evaluated at all
+    def _forward(*args, **kwargs):
+        raise AssertionError("The input layers should not be evaluated")
+
+    for layer in tc.layers:
+        if isinstance(layer, TorchInputLayer):
+            monkeypatch.setattr(layer, "forward", _forward)
+    mar_scores = mar_query(worlds, integrate_vars=tc.scope)
+    assert mar_scores.shape == (len(worlds), 1, 1)
+    assert allclose(mar_scores, mar_scores[:1])
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize",
+    itertools.product(["lse-sum", "sum-product"], [False, True], [False, True]),
+)
+def test_query_marginalize_cached_integrals_monotonic_pc_categorical(
+    semiring: str, fold: bool, optimize: bool, monkeypatch: pytest.MonkeyPatch
+):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+    mar_tc: TorchCircuit = compiler.compile(SF.integrate(sc, scope=Scope([4])))
+    pf_tc: TorchCircuit = compiler.compile(SF.integrate(sc))
+
+    num_integrate_calls = 0
+
+    def _counting_integrate(layer: TorchInputLayer):
+        def _integrate():
+            nonlocal num_integrate_calls
+            num_integrate_calls += 1
+            return type(layer).integrate(layer)
+
+        return _integrate
+
+    for layer in tc.layers:
+        if isinstance(layer, TorchInputLayer):
+            monkeypatch.setattr(layer, "integrate", _counting_integrate(layer))
+
+    # The integrals of the input layers and the outputs of the constant circuits are
+    # reused across queries, as long as the parameters are not changed
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    mar_query = IntegrateQuery(tc)
+    with torch.no_grad():
+        mar_scores = mar_query(worlds, integrate_vars=Scope([4]))
+        num_calls = num_integrate_calls
+        assert num_calls > 0
+        assert allclose(mar_query(worlds, integrate_vars=Scope([4])), mar_scores)
+        assert num_integrate_calls == num_calls
+        assert allclose(mar_tc(worlds), mar_scores)
+        assert allclose(mar_tc(worlds), mar_scores)
+        log_z = pf_tc()
+        assert pf_tc() is log_z
+
+    # Updating the parameters in-place invalidates the cached integrals and outputs
+    with torch.no_grad():
+        for p in tc.parameters():
+            p.mul_(0.5)
+        mar_scores = mar_query(worlds, integrate_vars=Scope([4]))
+        assert num_integrate_calls > num_calls
+        updated_log_z = pf_tc()
+        assert updated_log_z is not log_z
+        cached_mar_scores = mar_tc(worlds)
+    assert allclose(mar_scores, mar_query(worlds, integrate_vars=Scope([4])))
+    assert allclose(cached_mar_scores, mar_tc(worlds))
+    assert allclose(mar_scores, mar_tc(worlds))
+    assert allclose(updated_log_z, pf_tc())
+    assert not allclose(updated_log_z, log_z)
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize,arena,layout",
+    itertools.product(
+        ["lse-sum", "sum-product"],
+        [False, True],
+        [False, True],
+        [False, True],
+        [torch.sparse_coo, torch.sparse_csr],
+    ),
+)
+def test_query_marginalize_sparse_evidence_monotonic_pc_categorical(
+    semiring: str, fold: bool, optimize: bool, arena: bool, layout: torch.layout
+):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize, arena=arena)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+
+    # The variables that are not specified in the sparse evidence are integrated
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    observed = torch.rand(worlds.shape) < 0.5
+    observed[0] = False
+    observed[1] = True
+    evidence = torch.sparse_coo_tensor(observed.nonzero().T, worlds[observed], worlds.shape)
+    if layout == torch.sparse_csr:
+        evidence = evidence.to_sparse_csr()
+    mar_query = IntegrateQuery(tc)
+    mar_scores = mar_query(worlds, integrate_vars=~observed)
+    with torch.no_grad():
+        assert allclose(tc(evidence), mar_scores)
+    assert allclose(tc(evidence, chunk_size=5), mar_scores)
+    assert allclose(mar_query(evidence), mar_scores)
+    assert allclose(mar_query(evidence, chunk_size=5), mar_scores)
+
+    # Other variables can be integrated as well
+    integrate_vars = Scope([1, 4])
+    mask = ~observed
+    mask[:, [1, 4]] = True
+    mar_scores = mar_query(worlds, integrate_vars=mask)
+    assert allclose(mar_query(evidence, integrate_vars=integrate_vars), mar_scores)
+    with pytest.raises(ValueError):
+        mar_query(worlds)
+
+
+@pytest.mark.parametrize("fold,optimize", itertools.product([False, True], [False, True]))
+def test_query_marginalize_sparse_evidence_repeated_variables(fold: bool, optimize: bool):
+    # Each variable is in the scope of multiple folds, one for each repetition
+    num_variables = 7
+    rg = RandomBinaryTree(num_variables, depth=2, num_repetitions=3)
+    sc = rg.build_circuit(
+        input_factory=utils.name_to_input_layer_factory("categorical", num_categories=3),
+        sum_product="cp",
+        num_input_units=2,
+        num_sum_units=2,
+    )
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(sc)
+    with torch.no_grad():
+        for p in tc.parameters():
+            p.copy_(torch.rand_like(p))
+
+    x = torch.randint(3, size=(6, num_variables))
+    observed = torch.rand(x.shape) < 0.5
+    observed[0] = False
+    evidence = torch.sparse_coo_tensor(observed.nonzero().T, x[observed], x.shape)
+    mar_query = IntegrateQuery(tc)
+    assert allclose(tc(evidence), mar_query(x, integrate_vars=~observed))
+    mask = ~observed
+    mask[:, 2] = True
+    mar_scores = mar_query(evidence, integrate_vars=Scope([2]))
+    assert allclose(mar_scores, mar_query(x, integrate_vars=mask))
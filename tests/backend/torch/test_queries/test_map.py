@@ -7,7 +7,8 @@ import torch
 import cirkit.symbolic.functional as SF
 from cirkit.backend.torch.circuits import TorchCircuit
 from cirkit.backend.torch.compiler import TorchCompiler
-from cirkit.backend.torch.queries import MAPQuery
+from cirkit.backend.torch.layers import TorchInputLayer
+from cirkit.backend.torch.queries import MAPQuery, TopKMAPQuery
 from cirkit.pipeline import PipelineContext
 from cirkit.symbolic.circuit import Circuit
 from cirkit.symbolic.initializers import NormalInitializer
@@ -284,3 +285,160 @@ def test_query_map_marginalized_conditional_circuit_with_evidence(
         evidence_vars=torch.tensor([[False, True], [False, True]]),
         gate_function_kwargs={"sum.weight.0": {"x": torch.rand(2, *gf_specs["sum.weight.0"])}},
     )
+
+
+@pytest.mark.parametrize(
+    "sum_product_layer,fold,optimize",
+    [
+        (sum_product_layer, fold, optimize)
+        for sum_product_layer, fold, optimize in itertools.product(
+            ["cp", "cp-t", "tucker"], [False, True], [False, True]
+        )
+        # Tucker layers (i.e., Kronecker products fused with sums) do not support max
+        if sum_product_layer != "tucker" or not optimize
+    ],
+)
+def test_query_map_max_product_value(sum_product_layer: str, fold: bool, optimize: bool):
+    num_features, num_categories = 4, 3
+    sc = data_modalities.tabular_data(
+        num_features=num_features,
+        input_layers={"name": "categorical", "args": {"num_categories": num_categories}},
+        num_input_units=3,
+        sum_product_layer=sum_product_layer,
+        num_sum_units=3,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    compiler = TorchCompiler(semiring="sum-product", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(sc)
+
+    def max_product_fn(layer, x):
+        return layer(x) if isinstance(layer, TorchInputLayer) else layer.max(x)[1]
+
+    # The assignment found by backtracking must attain the maximum value of the max-product
+    # evaluation of the circuit, which is computed by enumerating all the assignments
+    worlds = torch.tensor(list(itertools.product(range(num_categories), repeat=num_features)))
+    max_value = tc.evaluate(worlds, module_fn=max_product_fn).max()
+    map_value, map_state = MAPQuery(tc)()
+    assert map_state.shape == (1, num_features)
+    assert allclose(map_value, max_value)
+    assert allclose(tc.evaluate(map_state, module_fn=max_product_fn), max_value)
+
+
+def test_query_map_backtrack_plan_device():
+    sc = data_modalities.tabular_data(
+        num_features=4,
+        input_layers={"name": "categorical", "args": {"num_categories": 3}},
+        num_input_units=3,
+        sum_product_layer="cp",
+        num_sum_units=3,
+    )
+    compiler = TorchCompiler(semiring="lse-sum", fold=True, optimize=True)
+    tc: TorchCircuit = compiler.compile(sc)
+
+    # The indices used to backtrack are transferred to the device together with the circuit,
+    # and they are not stored in the state of the circuit
+    address_book = tc.address_book
+    targets = [name for name, _ in address_book.named_buffers() if "_backtrack_" in name]
+    assert targets
+    assert not any("_backtrack_" in name for name in tc.state_dict())
+    tc.to("meta")
+    assert all(getattr(address_book, target).is_meta for target in targets)
+
+
+@pytest.mark.parametrize(
+    "sum_product_layer,fold,optimize",
+    [
+        (sum_product_layer, fold, optimize)
+        for sum_product_layer, fold, optimize in itertools.product(
+            ["cp", "cp-t", "tucker"], [False, True], [False, True]
+        )
+        # Tucker layers (i.e., Kronecker products fused with sums) do not support max
+        if sum_product_layer != "tucker" or not optimize
+    ],
+)
+def test_max_sum_semiring_evaluation(sum_product_layer: str, fold: bool, optimize: bool):
+    num_features, num_categories = 4, 3
+    sc = data_modalities.tabular_data(
+        num_features=num_features,
+        input_layers={"name": "categorical", "args": {"num_categories": num_categories}},
+        num_input_units=3,
+        sum_product_layer=sum_product_layer,
+        num_sum_units=3,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    tc: TorchCircuit = TorchCompiler(semiring="sum-product", fold=fold, optimize=optimize).compile(
+        sc
+    )
+    max_tc: TorchCircuit = TorchCompiler(semiring="max-sum", fold=fold, optimize=optimize).compile(
+        sc
+    )
+    max_tc.load_state_dict(tc.state_dict())
+
+    def max_product_fn(layer, x):
+        return layer(x) if isinstance(layer, TorchInputLayer) else layer.max(x)[1]
+
+    # A forward pass in the max-sum semiring computes the logarithm of the max-product evaluation
+    worlds = torch.tensor(list(itertools.product(range(num_categories), repeat=num_features)))
+    max_value = tc.evaluate(worlds, module_fn=max_product_fn)
+    assert allclose(torch.exp(max_tc.evaluate(worlds)), max_value)
+
+
+@pytest.mark.parametrize(
+    "sum_product_layer,fold,optimize,k",
+    [
+        (sum_product_layer, fold, optimize, k)
+        for sum_product_layer, fold, optimize, k in itertools.product(
+            ["cp", "cp-t", "tucker"], [False, True], [False, True], [1, 5]
+        )
+        if sum_product_layer != "tucker" or not optimize
+    ],
+)
+def test_query_topk_map(sum_product_layer: str, fold: bool, optimize: bool, k: int):
+    num_features, num_categories = 4, 3
+    sc = data_modalities.tabular_data(
+        num_features=num_features,
+        input_layers={"name": "categorical", "args": {"num_categories": num_categories}},
+        num_input_units=3,
+        sum_product_layer=sum_product_layer,
+        num_sum_units=3,
+        sum_weight_param=utils.Parameterization(activation="softmax", initialization="normal"),
+    )
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(sc)
+    query = TopKMAPQuery(tc)
+
+    def max_product_fn(layer, x):
+        return layer(x) if isinstance(layer, TorchInputLayer) else layer.max(x)[1]
+
+    # If all the variables are observed, then the best value is the max-product value
+    worlds = torch.tensor(list(itertools.product(range(num_categories), repeat=num_features)))
+    world_values, world_states = query(
+        k, x=worlds, evidence_vars=torch.ones(1, num_features, dtype=torch.bool)
+    )
+    assert world_values.shape == (len(worlds), k) and world_states.shape == (
+        len(worlds),
+        k,
+        num_features,
+    )
+    assert torch.all(world_states == worlds.unsqueeze(dim=1))
+    assert allclose(world_values[:, 0], tc.evaluate(worlds, module_fn=max_product_fn)[0, :, 0])
+    assert torch.all(world_values[:, :-1] >= world_values[:, 1:])
+
+    # Each state is assigned by a sub-circuit, hence the k best values are the k best values
+    # among the ones of all the states
+    values, states = query(k)
+    assert values.shape == (1, k) and states.shape == (1, k, num_features)
+    assert allclose(values[0], torch.topk(world_values.flatten(), k).values)
+    state_idxs = (states[0] * num_categories ** torch.arange(num_features - 1, -1, -1)).sum(dim=1)
+    assert torch.all(torch.isclose(world_values[state_idxs], values[0].unsqueeze(dim=1)).any(dim=1))
+    map_value, map_state = MAPQuery(tc)()
+    assert torch.all(states[0, 0] == map_state[0]) or allclose(values[0, 0], values[0, 1])
+
+    # The k best states given some evidence are the k best among the states that agree with it
+    evidence = worlds[[0, len(worlds) // 2, len(worlds) - 1]]
+    evidence_vars = torch.tensor([[True, False, True, False]])
+    values, states = query(k, x=evidence, evidence_vars=evidence_vars)
+    assert torch.all(states[..., evidence_vars[0]] == evidence[:, None, evidence_vars[0]])
+    for i in range(len(evidence)):
+        agree = torch.all(worlds[:, evidence_vars[0]] == evidence[i, evidence_vars[0]], dim=1)
+        assert allclose(values[i], torch.topk(world_values[agree].flatten(), k).values)
@@ -0,0 +1,64 @@
+import itertools
+
+import pytest
+import torch
+
+from cirkit.backend.torch.circuits import TorchCircuit
+from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.queries import AllMarginalsQuery, IntegrateQuery
+from cirkit.backend.torch.semiring import LSESumSemiring, SumProductSemiring
+from cirkit.utils.scope import Scope
+from tests.floats import allclose
+from tests.symbolic.test_utils import build_monotonic_structured_categorical_cpt_pc
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize",
+    itertools.product(["lse-sum", "sum-product"], [False, True], [False, True]),
+)
+def test_query_all_marginals_monotonic_pc_categorical(semiring: str, fold: bool, optimize: bool):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+    semiring_cls = LSESumSemiring if semiring == "lse-sum" else SumProductSemiring
+
+    worlds = torch.tensor(list(itertools.product([0, 1], repeat=tc.num_variables)))
+    probs = torch.exp(LSESumSemiring.map_from(tc(worlds), semiring_cls)).view(-1)
+    x = worlds[torch.randint(len(worlds), size=(8,))]
+    evidence_vars = torch.rand(x.shape) < 0.5
+    marginals = AllMarginalsQuery(tc)(x=x, evidence_vars=evidence_vars)
+    assert marginals.shape == (8, tc.num_variables, 2)
+
+    # Compute the marginal of each variable conditioned on the evidence on the other
+    # variables, by brute force
+    for i, d in itertools.product(range(len(x)), range(tc.num_variables)):
+        other_evidence_vars = evidence_vars[i].clone()
+        other_evidence_vars[d] = False
+        consistent = torch.all((worlds == x[i]) | ~other_evidence_vars, dim=1)
+        joint = torch.stack([probs[consistent & (worlds[:, d] == c)].sum() for c in range(2)])
+        assert allclose(marginals[i, d], joint / joint.sum())
+
+
+@pytest.mark.parametrize(
+    "semiring,fold,optimize",
+    itertools.product(["lse-sum", "sum-product"], [False, True], [False, True]),
+)
+def test_query_all_marginals_no_evidence_monotonic_pc_categorical(
+    semiring: str, fold: bool, optimize: bool
+):
+    compiler = TorchCompiler(semiring=semiring, fold=fold, optimize=optimize)
+    sc = build_monotonic_structured_categorical_cpt_pc()
+    tc: TorchCircuit = compiler.compile(sc)
+    semiring_cls = LSESumSemiring if semiring == "lse-sum" else SumProductSemiring
+
+    # Without evidence, the marginals are the ones computed by integrating
+    # all the other variables
+    marginals = AllMarginalsQuery(tc)()
+    assert marginals.shape == (1, tc.num_variables, 2)
+    mar_query = IntegrateQuery(tc)
+    for d in range(tc.num_variables):
+        x = torch.zeros(2, tc.num_variables, dtype=torch.long)
+        x[:, d] = torch.arange(2)
+        mar_scores = mar_query(x, integrate_vars=Scope(set(range(tc.num_variables)) - {d}))
+        log_joint = LSESumSemiring.map_from(mar_scores, semiring_cls).view(-1)
+        assert allclose(marginals[0, d], torch.softmax(log_joint, dim=0))
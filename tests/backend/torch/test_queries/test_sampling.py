@@ -5,7 +5,11 @@ import torch
 
 from cirkit.backend.torch.circuits import TorchCircuit
 from cirkit.backend.torch.compiler import TorchCompiler
+from cirkit.backend.torch.layers import TorchCPTLayer, TorchSumLayer
 from cirkit.backend.torch.queries import SamplingQuery
+from cirkit.backend.torch.utils import gumbel_max_sample
+from cirkit.symbolic.circuit import Circuit
+from cirkit.templates import data_modalities, utils
 from tests.floats import allclose
 from tests.symbolic.test_utils import (
     build_bivariate_monotonic_structured_cpt_pc,
@@ -34,7 +38,7 @@ def test_query_unconditional_sampling(fold: bool, optimize: bool):
     probs = probs.squeeze(dim=2).squeeze(dim=1)
 
     # Sample data points unconditionally
-    num_samples = 1_000_000
+    num_samples = 4_000_000
     query = SamplingQuery(tc)
     # samples: (num_samples, D)
     _, samples = query(num_samples=num_samples)
@@ -116,6 +120,158 @@ def test_query_conditional_sampling(fold: bool, optimize: bool):
     # Sample data points unconditionally
     num_samples = 1_000_000
     query = SamplingQuery(tc)
-    # samples: (num_samples, D)
-    _, samples = query(num_samples=num_samples, x=evidence, evidence_vars=evidence_vars)
-    assert samples.shape == (num_samples, tc.num_variables)
+    # samples: (1, num_samples, D), i.e., the samples of the only row of the evidence
+    samples_p, samples = query(num_samples=num_samples, x=evidence, evidence_vars=evidence_vars)
+    assert samples.shape == (1, num_samples, tc.num_variables)
+    assert samples_p.shape == (1, 1, num_samples, 1)
+
+
+@pytest.mark.parametrize(
+    "fold,optimize",
+    itertools.product([False, True], [False, True]),
+)
+def test_query_unconditional_sampling_top_down(fold: bool, optimize: bool, monkeypatch):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    sc = build_multivariate_monotonic_structured_cpt_pc(
+        num_units=2, input_layer="bernoulli", parameterize=True, normalized=True
+    )
+    tc: TorchCircuit = compiler.compile(sc)
+
+    # The circuit is normalized, hence it is sampled without evaluating the layers bottom-up
+    def _raise_fn(*args, **kwargs):
+        raise AssertionError("The layers should not be evaluated bottom-up")
+
+    monkeypatch.setattr(TorchSumLayer, "sample", _raise_fn)
+    monkeypatch.setattr(TorchCPTLayer, "sample", _raise_fn)
+    query = SamplingQuery(tc)
+    samples_p, samples = query(num_samples=100)
+    assert samples.shape == (100, tc.num_variables)
+    assert torch.all((samples == 0.0) | (samples == 1.0))
+    # The output is the partition function of the circuit
+    assert samples_p.shape == (1, 100, 1)
+    assert allclose(samples_p, 0.0)
+
+
+def _build_categorical_tabular_circuit(normalized: bool) -> Circuit:
+    return data_modalities.tabular_data(
+        num_features=3,
+        input_layers={"name": "categorical", "args": {"num_categories": 3}},
+        num_input_units=3,
+        sum_product_layer="cp",
+        num_sum_units=3,
+        sum_weight_param=(
+            utils.Parameterization(activation="softmax", initialization="normal")
+            if normalized
+            else utils.Parameterization(initialization="uniform")
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "fold,optimize",
+    itertools.product([False, True], [False, True]),
+)
+def test_query_unconditional_sampling_unnormalized(fold: bool, optimize: bool):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(_build_categorical_tabular_circuit(normalized=False))
+    worlds = torch.tensor(list(itertools.product(range(3), repeat=3)))
+    log_probs = tc(worlds).squeeze(dim=2).squeeze(dim=1)
+    probs = torch.softmax(log_probs, dim=0)
+
+    num_samples = 200_000
+    query = SamplingQuery(tc)
+    samples_p, samples = query(num_samples=num_samples)
+    assert samples.shape == (num_samples, 3)
+    assert allclose(samples_p, torch.logsumexp(log_probs, dim=0))
+    counts = torch.bincount((samples * torch.tensor([9, 3, 1])).sum(dim=1).long(), minlength=27)
+    assert allclose(counts / num_samples, probs, atol=1e-2)
+
+
+@pytest.mark.parametrize(
+    "fold,optimize",
+    itertools.product([False, True], [False, True]),
+)
+def test_query_conditional_sampling_batched(fold: bool, optimize: bool):
+    compiler = TorchCompiler(semiring="lse-sum", fold=fold, optimize=optimize)
+    tc: TorchCircuit = compiler.compile(_build_categorical_tabular_circuit(normalized=True))
+    worlds = torch.tensor(list(itertools.product(range(3), repeat=3)))
+    probs = torch.exp(tc(worlds)).squeeze(dim=2).squeeze(dim=1)
+
+    # Each row has a different evidence
+    x = torch.tensor([[0, 2, 0], [1, 0, 0], [0, 0, 0]])
+    evidence_vars = torch.tensor([[True, True, False], [True, False, False], [False] * 3])
+    num_samples = 200_000
+    query = SamplingQuery(tc)
+    samples_p, samples = query(num_samples=num_samples, x=x, evidence_vars=evidence_vars)
+    assert samples.shape == (3, num_samples, 3)
+    assert samples_p.shape == (1, 3, num_samples, 1)
+    for i in range(3):
+        assert torch.all(samples[i][:, evidence_vars[i]] == x[i][evidence_vars[i]])
+        # The samples of each row follow the conditional distribution given its evidence
+        consistent = torch.all((worlds == x[i]) | ~evidence_vars[i], dim=1)
+        cond_probs = torch.where(consistent, probs, 0.0)
+        assert allclose(samples_p[0, i, 0], torch.log(cond_probs.sum()))
+        cond_probs = cond_probs / cond_probs.sum()
+        samples_idx = (samples[i] * torch.tensor([9, 3, 1])).sum(dim=1).long()
+        counts = torch.bincount(samples_idx, minlength=27)
+        assert allclose(counts / num_samples, cond_probs, atol=1e-2)
+
+
+@pytest.mark.parametrize("normalized", [False, True])
+def test_query_iter_samples(normalized: bool):
+    compiler = TorchCompiler(semiring="lse-sum", fold=True, optimize=True)
+    tc: TorchCircuit = compiler.compile(_build_categorical_tabular_circuit(normalized=normalized))
+    query = SamplingQuery(tc)
+
+    chunks = list(query.iter_samples(250, 100, seed=42))
+    assert [chunk.shape for chunk in chunks] == [(100, 3), (100, 3), (50, 3)]
+    # The chunks are reproducible, and they do not depend on the random state between them
+    torch.manual_seed(0)
+    it = query.iter_samples(250, 100, seed=42)
+    for chunk in chunks:
+        torch.rand(10)
+        assert torch.equal(next(it), chunk)
+    assert next(it, None) is None
+    # Different chunks are drawn from different random streams
+    assert not torch.equal(chunks[0][:50], chunks[2])
+    # The chunks drawn with different seeds do not share their random streams
+    chunks_0 = list(query.iter_samples(40, 10, seed=0))
+    chunks_1 = list(query.iter_samples(40, 10, seed=1))
+    assert not any(torch.equal(c0, c1) for c0, c1 in itertools.product(chunks_0, chunks_1))
+
+    # The chunks of conditional samples have one row for each row of the evidence
+    x = torch.tensor([[0, 2, 0], [1, 0, 0]])
+    evidence_vars = torch.tensor([[True, True, False], [True, False, False]])
+    chunks = list(query.iter_samples(30, 20, x=x, evidence_vars=evidence_vars, seed=42))
+    assert [chunk.shape for chunk in chunks] == [(2, 20, 3), (2, 10, 3)]
+    for chunk in chunks:
+        for i in range(2):
+            assert torch.all(chunk[i][:, evidence_vars[i]] == x[i][evidence_vars[i]])
+
+    with pytest.raises(ValueError):
+        next(query.iter_samples(10, 0))
+
+
+@pytest.mark.parametrize("max_numel", [1, 2**24])
+def test_gumbel_max_sample(max_numel: int):
+    # x: (F, B, I), weight: (F, 1, K_o, I), where the weights are not normalized
+    x = torch.rand(2, 3, 4)
+    weight = torch.rand(2, 1, 5, 4)
+    weight[0, 0, 1, 2] = 0.0
+    num_samples = 50_000
+    log_x = torch.log(x).repeat(1, num_samples, 1)
+    idxs, log_values = gumbel_max_sample(log_x, torch.log(weight), max_numel=max_numel)
+    assert idxs.shape == log_values.shape == (2, 3 * num_samples, 5)
+    assert allclose(
+        log_values,
+        torch.log(weight.expand(-1, 3 * num_samples, -1, -1))
+        .gather(dim=3, index=idxs.unsqueeze(dim=3))
+        .squeeze(dim=3)
+        + log_x.gather(dim=2, index=idxs),
+    )
+    # The inputs are sampled proportionally to their weighted values
+    weighted_x = weight * x.unsqueeze(dim=2)
+    probs = weighted_x / weighted_x.sum(dim=3, keepdim=True)
+    counts = torch.nn.functional.one_hot(idxs, 4).unflatten(1, (num_samples, 3)).sum(dim=1)
+    assert allclose(counts / num_samples, probs, atol=1e-2)
+    assert torch.all(idxs[0, :, 1] != 2)
@@ -1,8 +1,16 @@
+import itertools
+
+import pytest
 import torch
 from torch import autograd
 
-from cirkit.backend.torch.semiring import ComplexLSESumSemiring, LSESumSemiring
-from cirkit.backend.torch.utils import csafelog
+from cirkit.backend.torch.semiring import (
+    ComplexLSESumSemiring,
+    LSESumSemiring,
+    MaxSumSemiring,
+    SumProductSemiring,
+)
+from cirkit.backend.torch.utils import csafelog, log_matmul_exp
 from tests.floats import allclose
 
 
@@ -59,3 +67,78 @@ def test_semiring_complex_lse_sum_semiring() -> None:
     assert torch.all(torch.isfinite(y2.real))
     assert torch.all(torch.isfinite(y2.imag))
     assert allclose(y1, y2.real)
+
+
+def test_semiring_max_sum_einsum() -> None:
+    x1, x2 = torch.randn(2, 5, 3), torch.randn(2, 5, 4)
+    w = torch.rand(2, 6, 3, 4)
+
+    # The einsum computed by Tucker layers, i.e., max_{i,j} w_{foij} x1_{fbi} x2_{fbj}
+    y = MaxSumSemiring.einsum(
+        ((0, 1, 2), (0, 1, 3), (0, 4, 2, 3), (0, 1, 4)),
+        inputs=(x1, x2),
+        operands=(w,),
+        dim=-1,
+        keepdim=True,
+    )
+    expected_y = torch.amax(
+        x1[:, :, None, :, None] + x2[:, :, None, None, :] + torch.log(w)[:, None], dim=(3, 4)
+    )
+    assert y.shape == (2, 5, 6)
+    assert allclose(y, expected_y)
+
+    y = MaxSumSemiring.einsum(
+        "fbi,foi->fbo", inputs=(x1,), operands=(w[..., 0],), dim=-1, keepdim=True
+    )
+    assert allclose(y, torch.amax(x1[:, :, None] + torch.log(w[..., 0])[:, None], dim=-1))
+    assert allclose(SumProductSemiring.map_from(y, MaxSumSemiring), torch.exp(y))
+    assert allclose(LSESumSemiring.map_from(y, MaxSumSemiring), y)
+
+
+@pytest.mark.parametrize(
+    "arity,batched_weight,complex_valued,max_numel",
+    itertools.product([1, 2, 3], [False, True], [False, True], [2**24, 7]),
+)
+def test_semiring_log_matmul_exp(
+    arity: int, batched_weight: bool, complex_valued: bool, max_numel: int
+) -> None:
+    torch.set_grad_enabled(True)
+    semiring = ComplexLSESumSemiring if complex_valued else LSESumSemiring
+    dtype = torch.complex128 if complex_valued else torch.float64
+    xs = tuple(torch.randn(2, 5, 3, dtype=dtype, requires_grad=True) for _ in range(arity))
+    w = torch.rand(
+        2, 5 if batched_weight else 1, 4, 3**arity, dtype=torch.float64, requires_grad=True
+    )
+
+    # The einsum computed by sum layers (arity one) and by Tucker layers (arity two or more)
+    equation = (
+        tuple((0, 1, i + 2) for i in range(arity))
+        + ((0, 1, arity + 2, *range(2, arity + 2)),)
+        + ((0, 1, arity + 2),)
+    )
+    expected_y = semiring.einsum(
+        equation,
+        inputs=xs,
+        operands=(w.view(*w.shape[:3], *(3 for _ in range(arity))),),
+        dim=-1,
+        keepdim=True,
+    )
+    y = log_matmul_exp(xs, semiring.cast(w), max_numel=max_numel)
+    assert y.shape == (2, 5, 4)
+    assert allclose(y, expected_y)
+    assert autograd.gradcheck(
+        lambda w, *xs: log_matmul_exp(xs, semiring.cast(w), max_numel=max_numel), (w, *xs)
+    )
+
+
+def test_semiring_log_matmul_exp_zeros() -> None:
+    torch.set_grad_enabled(True)
+    x1 = torch.full((1, 2, 3), -torch.inf, requires_grad=True)
+    x2 = torch.randn(1, 2, 3, requires_grad=True)
+    w = torch.rand(1, 1, 2, 9, requires_grad=True)
+    y = log_matmul_exp((x1, x2), w)
+    assert torch.all(torch.isneginf(y))
+    y.sum().backward()
+    assert x1.grad is not None and x2.grad is not None and w.grad is not None
+    assert torch.all(torch.isfinite(x1.grad)) and torch.all(torch.isfinite(x2.grad))
+    assert torch.all(torch.isfinite(w.grad))
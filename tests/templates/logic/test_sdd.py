@@ -202,4 +202,4 @@ def test_conditional_sample_from_sdd(fold, optimize):
     evidence_vars[:, 1] = True
 
     _, samples = sample_q(num_samples=10_000, x=evidence, evidence_vars=evidence_vars)
-    assert t_c(samples).all()
+    assert t_c(samples[0]).all()